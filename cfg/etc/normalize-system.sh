@@ -93,6 +93,10 @@ fi
 # Reconfigure Postgres without restarting it.
 cp -f /etc/teambox/base-config/pg_hba.conf /etc/postgresql/8.4/teambox/
 cp -f /etc/teambox/base-config/postgresql.conf /etc/postgresql/8.4/teambox/
+
+# Generate and apply the kernel tuning, which depends on the Postgres
+# configuration.
+kplatshell tune
 rm -f /var/log/postgresql/*
 
 # Reconfigure Apache without restarting it.
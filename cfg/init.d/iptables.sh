@@ -1,6 +1,7 @@
 #!/bin/sh
 
 RULE_FILE="/etc/teambox/base/iptables.rules"
+IPSET_FILE="/etc/teambox/base/ipset.sh"
 
 # Exit if the package is not installed or the firewall is not configured.
 [ -x "/sbin/iptables" -a -f $RULE_FILE ] || exit 0
@@ -21,6 +22,10 @@ do_start()
 	#   0 if daemon has been started
 	#   1 if daemon was already running
 	#   2 if daemon could not be started
+        # Load the address sets used by the rules first.
+        if [ -f $IPSET_FILE ]; then
+                sh -e $IPSET_FILE || return 2
+        fi
         iptables-restore < $RULE_FILE
         return 0
 }
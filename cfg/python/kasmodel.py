@@ -1,10 +1,14 @@
 import time, pwd
 from kasmodeltool import *
-from ksort import *
 from kfile import *
 from krun import *
 from kifconfig import *
 
+# Routing protocol number of the routes installed from the interface
+# configurations. Only the routes having this number are removed when they
+# leave the configuration, so the routes added by other means are kept.
+route_proto = "77"
+
 # This class represents a service running on a Teambox server.
 class ServerService:
     
@@ -24,6 +28,14 @@ class ServerService:
         
         # Position of this service in the global order of the services.
         self.pos = -1
+        
+        # Dependency level of this service: 0 if the service has no
+        # dependency, otherwise one more than the level of its deepest
+        # dependency.
+        self.level = -1
+        
+        # List of the TCP ports this service listens to by default.
+        self.port_list = []
     
     # Return the path to the init script symlink specified in /etc/rc2.d/.
     def _get_init_symlink_path(self, name, level):
@@ -52,6 +64,14 @@ class ServerService:
             if pid.isdigit() and os.path.isdir("/proc/" + pid): return 1
         except: return 0
     
+    # Return a value identifying the state of the file specified: its inode,
+    # size and modification time, or None if the file does not exist.
+    def get_file_state_key(self, path):
+        try:
+            st = os.stat(path)
+            return (st.st_ino, st.st_size, st.st_mtime)
+        except OSError: return None
+    
     # This method returns the status of the KCD service using the lock file
     # specified.
     def get_kcd_status_from_lock_file(self, lock_file):
@@ -76,6 +96,12 @@ class ServerService:
         store.run_status = self.run_status()
         return store
     
+    # Return a value that changes when the presence, the enabled status or the
+    # run status of the service changes. This virtual method is used to detect
+    # changes cheaply, it should not spawn processes.
+    def get_state_key(self):
+        return (self.is_present(), self.is_enabled(), self.run_status())
+    
     # This virtual method is called to determine whether the service is
     # installed on the machine.
     def is_present(self):
@@ -114,6 +140,7 @@ class PostgresService(ServerService):
     def __init__(self):
         ServerService.__init__(self, "postgres", [])
         self.pid_file = "/var/run/postgresql/8.4-teambox.pid"
+        self.port_list = [5432]
     
     def is_present(self):
         return os.path.isdir("/usr/lib/postgresql/8.4")
@@ -142,6 +169,7 @@ class PostgresService(ServerService):
 class ApacheService(ServerService):
     def __init__(self):
         ServerService.__init__(self, "apache", ["postgres"])
+        self.port_list = [9000, 9001]
      
     def is_present(self):
         return os.path.isfile("/usr/sbin/apache2")
@@ -188,6 +216,7 @@ class TeamboxService(ServerService):
 class TbxsosdService(TeamboxService):
     def __init__(self):
         TeamboxService.__init__(self, "tbxsosd", ["postgres"])
+        self.port_list = [5000]
     
     def is_present(self):
         return os.path.isfile("/usr/bin/tbxsosd")
@@ -212,6 +241,11 @@ class TbxsosdService(TeamboxService):
 class KcdService(TeamboxService):
     def __init__(self):
         TeamboxService.__init__(self, "kcd", ["postgres"])
+        self.lock_file = "/var/lock/kcd.lock"
+        self.port_list = [443]
+    
+    def get_state_key(self):
+        return (self.is_present(), self.is_enabled(), self.get_file_state_key(self.lock_file))
     
     def is_present(self):
         return os.path.isfile("/usr/bin/kcd")
@@ -220,7 +254,7 @@ class KcdService(TeamboxService):
         return self.is_enabled_according_to_init_script("kcd", 40)
 
     def run_status(self):
-        return self.get_kcd_status_from_lock_file("/var/lock/kcd.lock")
+        return self.get_kcd_status_from_lock_file(self.lock_file)
     
     def set_enabled(self, enabled_flag):
         self.enable_with_init_script("kcd", 40, enabled_flag)
@@ -235,6 +269,10 @@ class KcdService(TeamboxService):
 class KcdNotifService(TeamboxService):
     def __init__(self):
         TeamboxService.__init__(self, "kcdnotif", ["postgres"])
+        self.lock_file = "/var/lock/kcdnotif.lock"
+    
+    def get_state_key(self):
+        return (self.is_present(), self.is_enabled(), self.get_file_state_key(self.lock_file))
     
     def is_present(self):
         return os.path.isfile("/usr/bin/kcd")
@@ -243,7 +281,7 @@ class KcdNotifService(TeamboxService):
         return self.is_enabled_according_to_init_script("kcdnotif", 40)
 
     def run_status(self):
-        return self.get_kcd_status_from_lock_file("/var/lock/kcdnotif.lock")
+        return self.get_kcd_status_from_lock_file(self.lock_file)
     
     def set_enabled(self, enabled_flag):
         self.enable_with_init_script("kcdnotif", 40, enabled_flag)
@@ -417,6 +455,11 @@ class FreemiumWebService(TeamboxService):
     def set_enabled(self, enabled_flag):
         self.set_enabled_in_apache(enabled_flag)
 
+# List of the service classes managed by the service manager.
+service_class_list = [ PostgresService, ApacheService, TbxsosdService, KcdService, KcdNotifService,
+                       KasmondService, KwsfetcherService, TbxsosConfigService, TbxsosConfigdService,
+                       KasCfgService, WebBridgeService, KwmoService, FreemiumWebService ]
+
 # This class manages the server services, including the network.
 class ServiceManager:
     def __init__(self):
@@ -431,23 +474,15 @@ class ServiceManager:
         self.reverse_service_list = None
         
         # Add the services.
-        self._add_service(PostgresService())
-        self._add_service(ApacheService())
-        self._add_service(TbxsosdService())
-        self._add_service(KcdService())
-        self._add_service(KcdNotifService())
-        self._add_service(KasmondService())
-        self._add_service(KwsfetcherService())
-        self._add_service(TbxsosConfigService())
-        self._add_service(TbxsosConfigdService())
-        self._add_service(KasCfgService())
-        self._add_service(WebBridgeService())
-        self._add_service(KwmoService())
-        self._add_service(FreemiumWebService())
+        for service_class in service_class_list: self._add_service(service_class())
         
         # Essential service list.
         self.essential_service_list = [ self.get_service("postgres"), self.get_service("apache") ]
         
+        # Dictionary of the actions deferred since defer_actions() was called,
+        # or None if the actions are run immediately.
+        self.deferred_action_dict = None
+        
         # Resolve the dependencies.
         self._resolve_dependencies()
         
@@ -461,27 +496,75 @@ class ServiceManager:
         self.service_dict[service.name] = service
         service.manager = self
     
-    # Resolve the dependencies.
-    def _resolve_dependencies(self):
+    # Return a value identifying the service dependency graph. This value is
+    # used to validate the precomputed graph module.
+    def get_service_graph_key(self):
+        name_list = self.service_dict.keys()
+        name_list.sort()
+        return tuple([ (name, tuple(self.service_dict[name].dep_name_list)) for name in name_list ])
     
+    # Return the (service order list, service level dictionary) tuple computed
+    # from the service dependencies.
+    def compute_service_graph(self):
+        from ksort import topological_sort
+        
         # Sort by name to get a deterministic behavior.
         name_list = self.service_dict.keys()
         name_list.sort()
-        self.service_list = []
-        for name in name_list: self.service_list.append(self.get_service(name))
+        service_list = []
+        for name in name_list: service_list.append(self.get_service(name))
         
         # Topological sort.
         partial_order_list = []
-        for service in self.service_list:
+        for service in service_list:
             for dep_name in service.dep_name_list:
                 partial_order_list.append([self.get_service(dep_name), service])
-        self.service_list = topological_sort(self.service_list, partial_order_list)
-        if self.service_list == None: raise Exception("dependency loop")
+        service_list = topological_sort(service_list, partial_order_list)
+        if service_list == None: raise Exception("dependency loop")
+        
+        # Compute the levels. The dependencies of a service precede it.
+        level_dict = {}
+        for service in service_list:
+            level = 0
+            for dep_name in service.dep_name_list: level = max(level, level_dict[dep_name] + 1)
+            level_dict[service.name] = level
+        
+        return ([ service.name for service in service_list ], level_dict)
+    
+    # Write the module containing the precomputed service dependency graph. This
+    # is done at install time so that the graph is not computed every time a
+    # service manager is created.
+    def write_service_graph_module(self, path="kservicegraph.py"):
+        (order_list, level_dict) = self.compute_service_graph()
+        s = ""
+        s += "# WARNING: THIS FILE IS AUTO-GENERATED.\n"
+        s += "# Service dependency graph precomputed by kasmodel.\n"
+        s += "\n"
+        s += "service_graph_key = %r\n" % (self.get_service_graph_key(), )
+        s += "service_order_list = %r\n" % (order_list)
+        s += "service_level_dict = %r\n" % (level_dict)
+        write_file_atom(path, s)
+    
+    # Resolve the dependencies. The precomputed graph module is used if it
+    # matches the current services.
+    def _resolve_dependencies(self):
+        try:
+            import kservicegraph
+            if kservicegraph.service_graph_key != self.get_service_graph_key(): raise ImportError
+            order_list = kservicegraph.service_order_list
+            level_dict = kservicegraph.service_level_dict
+        except ImportError:
+            (order_list, level_dict) = self.compute_service_graph()
+        
+        self.service_list = [ self.get_service(name) for name in order_list ]
         self.reverse_service_list = self.service_list[:]
         self.reverse_service_list.reverse()
         
-        # Assign positions.
-        for i in range(0, len(self.service_list)): self.service_list[i].pos = i
+        # Assign positions and levels.
+        for i in range(0, len(self.service_list)):
+            service = self.service_list[i]
+            service.pos = i
+            service.level = level_dict[service.name]
      
     # Return the service having the name specified. An exception is raised if
     # there is no such service.
@@ -489,6 +572,14 @@ class ServiceManager:
         if not self.service_dict.has_key(name): raise Exception("service '%s' does not exist" % (name))
         return self.service_dict[name]
     
+    # Return a dictionary mapping the TCP ports listened to by the services to
+    # the service names.
+    def get_port_service_dict(self):
+        d = {}
+        for service in self.service_list:
+            for port in service.port_list: d[port] = service.name
+        return d
+    
     # Start the services specified in 'start_list'. If 'start_list' is 'None',
     # all the services that are present and enabled are started. If 'force_flag'
     # is true, the services are started even if they seem to be running. If
@@ -536,9 +627,45 @@ class ServiceManager:
             if output_stream: output_stream.write("%s: stopping...\n" % (service.name))
             service.stop_service()
     
+    # Defer the reload and restart actions until run_deferred_actions() is
+    # called.
+    def defer_actions(self):
+        self.deferred_action_dict = {}
+    
+    # Run each action deferred since defer_actions() was called once, in
+    # dependency order, and stop deferring the actions.
+    def run_deferred_actions(self):
+        d = self.deferred_action_dict
+        self.deferred_action_dict = None
+        if d == None: return
+        if d.has_key("hostname"): self.reload_hostname()
+        if d.has_key("sysctl"): self.reload_sysctl(*d["sysctl"])
+        if d.has_key("firewall"): self.reload_firewall_rules()
+        if d.has_key("network"): self.reload_network_iface(*d["network"])
+        if d.has_key("services"): self.restart_services(*d["services"])
+        if d.has_key("apache"): self.reload_apache_config()
+    
+    # Drop the actions deferred since defer_actions() was called and stop
+    # deferring the actions.
+    def discard_deferred_actions(self):
+        self.deferred_action_dict = None
+    
+    # Record the action specified if the actions are deferred. Return true if
+    # the action has been deferred.
+    def _defer_action(self, name, args=()):
+        if self.deferred_action_dict == None: return 0
+        self.deferred_action_dict[name] = args
+        return 1
+    
     # Stop all non-essential or disabled services then start all enabled
     # services.
     def restart_services(self, force_flag=0, output_stream=None):
+        if self.deferred_action_dict != None:
+            # Keep the strongest force flag and the last output stream.
+            prev_force_flag, prev_output_stream = self.deferred_action_dict.get("services", (0, None))
+            self._defer_action("services", (force_flag or prev_force_flag, output_stream or prev_output_stream))
+            return
+        
         stop_list = []
         for service in self.service_list:
             if not service in self.essential_service_list or not service.is_enabled():
@@ -556,36 +683,207 @@ class ServiceManager:
     
     # Update the hostname.
     def reload_hostname(self):
+        if self._defer_action("hostname"): return
         get_cmd_output(["hostname", "--file", "/etc/hostname"])
     
     # Reload the firewall rules.
     def reload_firewall_rules(self):
-        get_cmd_output(["/etc/init.d/iptables.sh", "restart"])
+        if self._defer_action("firewall"): return
+        
+        # Apply only the rules that changed, so that the connections are not
+        # disrupted. Fall back on a full reload if the live rules cannot be
+        # reconciled.
+        from kfirewall import FirewallReconciler
+        try: FirewallReconciler().reconcile()
+        except Exception: get_cmd_output(["/etc/init.d/iptables.sh", "restart"])
+    
+    # Apply the kernel settings of the sysctl file specified.
+    def reload_sysctl(self, path):
+        if self._defer_action("sysctl", (path,)): return
+        get_cmd_output(["/sbin/sysctl", "-q", "-p", path])
     
-    # Reload the network interfaces.
-    def reload_network_iface(self):
+    # Reload Apache configuration.
+    def reload_apache_config(self):
+        if self._defer_action("apache"): return
+        self.get_service("apache").reload_config()
+    
+    # Return the live state of the network interface specified, as a
+    # dictionary containing:
+    # - method: 'dhcp' if a DHCP client is running for the interface, otherwise
+    #   'static'.
+    # - addr: the address with its prefix length, e.g. '10.0.0.5/24'.
+    # - gateway: the gateway of the default route through the interface.
+    # - gateway_proto_flag: true if the default route was installed from the
+    #   configuration, see route_proto.
+    # - gateway_route_flag: true if the host route to the gateway was installed
+    #   from the configuration.
+    # - mtu: the MTU of the interface.
+    # - route_list: the list of the (network, gateway) tuples of the other
+    #   routes through the interface installed from the configuration.
+    # - bond_mode and bond_slave_list: the bonding mode (name and number) and
+    #   the slaves if the interface is a bond.
+    # - vlan_flag: true if the interface is a VLAN interface.
+    # The strings are empty and the lists are empty if there is no value.
+    def get_live_iface_state(self, name):
+        state = { "method" : "static", "addr" : "", "gateway" : "", "gateway_proto_flag" : 0,
+                  "gateway_route_flag" : 0, "mtu" : 0, "route_list" : [], "bond_mode" : "", "bond_slave_list" : [], "vlan_flag" : 0 }
+        
         try:
-            # Work around broken Debian scripts...
-            get_cmd_output(["/sbin/ifdown", "--force", "eth0"])
+            pid = read_file("/var/run/dhclient.%s.pid" % (name)).strip()
+            if pid.isdigit() and os.path.isdir("/proc/" + pid): state["method"] = "dhcp"
+        except: pass
+        
+        state["mtu"] = int(read_file("/sys/class/net/%s/mtu" % (name)).strip())
+        
+        bond_dir = "/sys/class/net/%s/bonding/" % (name)
+        if os.path.isdir(bond_dir):
+            state["bond_mode"] = read_file(bond_dir + "mode").strip()
+            state["bond_slave_list"] = read_file(bond_dir + "slaves").split()
+        
+        state["vlan_flag"] = os.path.exists("/proc/net/vlan/" + name)
+        
+        for line in get_cmd_output(["/sbin/ip", "-o", "-4", "addr", "show", "dev", name]).split("\n"):
+            arr = line.split()
+            if "inet" in arr and not "secondary" in arr:
+                state["addr"] = arr[arr.index("inet") + 1]
+                break
+        
+        host_route_list = []
+        for line in get_cmd_output(["/sbin/ip", "-4", "route", "show", "dev", name]).split("\n"):
+            arr = line.split()
+            if not len(arr): continue
+            proto_flag = "proto" in arr and arr[arr.index("proto") + 1] == route_proto
+            if not "via" in arr:
+                if proto_flag: host_route_list.append(arr[0])
+                continue
+            gateway = arr[arr.index("via") + 1]
+            if arr[0] == "default":
+                state["gateway"] = gateway
+                state["gateway_proto_flag"] = proto_flag
+            elif proto_flag:
+                state["route_list"].append((format_ipv4_cidr(parse_ipv4_cidr(arr[0])), gateway))
+        state["gateway_route_flag"] = state["gateway"] in host_route_list
+        
+        return state
+    
+    # Return true if the configuration of the interface specified can be
+    # applied to the live interface without bringing it down, i.e. if the
+    # method, the bonding and the VLAN settings are unchanged.
+    def _is_iface_update_possible(self, iface, live):
+        if (iface.method == "dhcp") != (live["method"] == "dhcp"): return 0
+        if iface.method == "static" and not live["addr"]: return 0
+        if bool(iface.vlan_id) != bool(live["vlan_flag"]): return 0
+        if iface.bond_mode:
+            if not iface.bond_mode in live["bond_mode"].split(): return 0
+            if list(iface.bond_slave_list) != live["bond_slave_list"]: return 0
+        elif live["bond_mode"]: return 0
+        return 1
+    
+    # Apply the MTU, the address, the gateway and the routes of the interface
+    # specified to the live interface in place, given its live state. The
+    # stale routes are removed before the address changes, while they are
+    # known to exist, so that any failure is reported.
+    def _update_iface(self, iface, live):
+        if iface.mtu and live["mtu"] != iface.mtu:
+            get_cmd_output(["/sbin/ip", "link", "set", "dev", iface.name, "mtu", str(iface.mtu)])
+        
+        # Only the routes installed from the configuration are removed.
+        route_list = iface.get_route_list()
+        for net, gateway in live["route_list"]:
+            if not (net, gateway) in route_list:
+                get_cmd_output(["/sbin/ip", "route", "del", net, "via", gateway, "dev", iface.name])
+        
+        addr_changed_flag = 0
+        if iface.method == "static":
+            # Remove the gateway routes installed from the configuration if the
+            # gateway was changed, or if it was removed and the default route
+            # was installed from the configuration.
+            if live["gateway"] and live["gateway"] != iface.gateway and \
+               (iface.gateway or live["gateway_proto_flag"]):
+                if not iface.gateway:
+                    get_cmd_output(["/sbin/ip", "route", "del", "default", "via", live["gateway"],
+                                    "dev", iface.name])
+                if live["gateway_route_flag"]:
+                    get_cmd_output(["/sbin/ip", "route", "del", live["gateway"], "dev", iface.name])
+            
+            addr = "%s/%i" % (iface.ip, get_ipv4_prefix_len(iface.netmask))
+            if live["addr"] != addr:
+                addr_changed_flag = 1
+                
+                # A new address in the subnet of the old one is added as a
+                # secondary address, which the kernel deletes along with the
+                # old primary address unless it is promoted.
+                if live["addr"]:
+                    write_file("/proc/sys/net/ipv4/conf/%s/promote_secondaries" % (iface.name), "1\n")
+                get_cmd_output(["/sbin/ip", "addr", "add", addr, "dev", iface.name])
+                if live["addr"]:
+                    get_cmd_output(["/sbin/ip", "addr", "del", live["addr"], "dev", iface.name])
+                if self.get_live_iface_state(iface.name)["addr"] != addr:
+                    raise Exception("address %s was not kept on %s" % (addr, iface.name))
             
-            # The 'ifup' script sucks, we have to try to detect errors manually.
-            proc = Popen(args = ["/sbin/ifup", "--force", "eth0"], stdout = PIPE, stderr = PIPE, shell = False)
-            (out_text, err_text) = proc.communicate()
-            if proc.returncode != 0: raise Exception(err_text.strip().rstrip('.'))
-            res_text = out_text + err_text
-            if res_text.find("Failed") != -1: raise Exception(res_text)
+            # Removing the old address may remove the routes, so always make
+            # sure the gateway routes are present when the address changed. Add
+            # the host route first to support a gateway on a different subnet.
+            if iface.gateway and (addr_changed_flag or live["gateway"] != iface.gateway):
+                get_cmd_output(["/sbin/ip", "route", "replace", iface.gateway, "dev", iface.name,
+                                "proto", route_proto])
+                get_cmd_output(["/sbin/ip", "route", "replace", "default", "via", iface.gateway,
+                                "proto", route_proto])
+        
+        for net, gateway in route_list:
+            if addr_changed_flag or not (net, gateway) in live["route_list"]:
+                get_cmd_output(["/sbin/ip", "route", "replace", net, "via", gateway, "dev", iface.name,
+                                "proto", route_proto])
+    
+    # Reload the network interfaces. If the list of the interface
+    # configurations is specified, each interface is compared to its live
+    # state: nothing is done if they match and the MTU, the address and the
+    # routes are updated in place if the method, the bonding and the VLAN
+    # settings did not change. Otherwise, the interface is brought down and
+    # up, which drops its connections. If no list is specified, eth0 is brought
+    # down and up and the networking is restarted.
+    def reload_network_iface(self, iface_list=None):
+        if self.deferred_action_dict != None:
+            # A full reload requested by any caller wins.
+            if self.deferred_action_dict.get("network", (iface_list,))[0] == None: iface_list = None
+            self._defer_action("network", (iface_list,))
+            return
+        
+        try:
+            # Find the interfaces to bring down and up. An interface whose live
+            # state cannot be read is brought down and up.
+            if iface_list == None:
+                cycle_list = ["eth0"]
+            else:
+                cycle_list = []
+                for iface in iface_list:
+                    try: live = self.get_live_iface_state(iface.name)
+                    except Exception: live = None
+                    if live and self._is_iface_update_possible(iface, live): self._update_iface(iface, live)
+                    else: cycle_list.append(iface.name)
+            
+            for name in cycle_list:
+                # Work around broken Debian scripts...
+                get_cmd_output(["/sbin/ifdown", "--force", name])
+                
+                # The 'ifup' script sucks, we have to try to detect errors manually.
+                proc = Popen(args = ["/sbin/ifup", "--force", name], stdout = PIPE, stderr = PIPE, shell = False)
+                (out_text, err_text) = proc.communicate()
+                if proc.returncode != 0: raise Exception(err_text.strip().rstrip('.'))
+                res_text = out_text + err_text
+                if res_text.find("Failed") != -1: raise Exception(res_text)
             
             # Try to restart networking by the official way.
-            get_cmd_output(["/etc/init.d/networking", "restart"])
+            if iface_list == None: get_cmd_output(["/etc/init.d/networking", "restart"])
         
         except Exception, e:
             raise Exception("failed to configure network interfaces: " + str(e))
     
     # Call reload_hostname(), reload_firewall_rules() and reload_network_iface().
-    def restart_network(self):
+    def restart_network(self, iface_list=None):
         self.reload_hostname()
         self.reload_firewall_rules()
-        self.reload_network_iface()
+        self.reload_network_iface(iface_list)
     
 # This class represents a network interface.
 class NetworkInterfaceConfig(AbstractConfigNode):
@@ -594,7 +892,68 @@ class NetworkInterfaceConfig(AbstractConfigNode):
     prop_set.add_prop('method', "dhcp", "Method used to assign an IP address to the interface: 'dhcp' or\n'static'.")
     prop_set.add_prop('ip', "", "Static IP address associated to the interface, if any.")
     prop_set.add_prop('netmask', "", "Netmask associated to the IP address, if any.")
-    prop_set.add_prop('gateway', "", "Gateway associated to the interface, if any.")
+    prop_set.add_prop('gateway', "", "Gateway associated to the interface, if any. The default route goes through\n"
+                                     "this gateway, so only one interface should have one.")
+    prop_set.add_prop('mtu', 0, "MTU of the interface, e.g. 9000 for jumbo frames. 0 to use the default.")
+    prop_set.add_prop('bond_mode', "", "Bonding mode, e.g. 'active-backup' or '802.3ad', if the interface is a bond.")
+    prop_set.add_model_prop('bond_slave_list', ConfigList, [str],
+                            doc="Names of the interfaces enslaved to the bond, if the interface is a bond.")
+    prop_set.add_prop('vlan_raw_device', "", "Interface carrying the VLAN, if the interface is a VLAN interface.")
+    prop_set.add_prop('vlan_id', 0, "VLAN ID, if the interface is a VLAN interface. The interface name must be\n"
+                                    "'<raw device>.<VLAN ID>' or 'vlan<VLAN ID>'.")
+    prop_set.add_model_prop('route_list', ConfigList, [str],
+                            doc="Static routes through the interface, in the form '<network>/<prefix> <gateway>'.")
+    
+    # Return the static routes of the interface as a list of (network,
+    # gateway) tuples. The networks are in CIDR notation.
+    def get_route_list(self):
+        l = []
+        for route in self.route_list:
+            arr = route.split()
+            if len(arr) != 2: raise Exception("invalid route '%s' for interface %s" % (route, self.name))
+            parse_ipv4_cidr(arr[1])
+            l.append((format_ipv4_cidr(parse_ipv4_cidr(arr[0])), arr[1]))
+        return l
+    
+    # Raise an exception if the interface configuration is invalid.
+    def check_config(self):
+        if not self.method in ("dhcp", "static", "manual"):
+            raise Exception("invalid method '%s' for interface %s" % (self.method, self.name))
+        if self.method == "static":
+            parse_ipv4_cidr(self.ip)
+            get_ipv4_prefix_len(self.netmask)
+            if self.gateway: parse_ipv4_cidr(self.gateway)
+        if bool(self.bond_mode) != bool(len(self.bond_slave_list)):
+            raise Exception("interface %s must have both a bonding mode and slaves" % (self.name))
+        if self.vlan_id:
+            if self.vlan_id < 1 or self.vlan_id > 4094 or not self.vlan_raw_device:
+                raise Exception("invalid VLAN configuration for interface %s" % (self.name))
+            if not self.name in ("%s.%i" % (self.vlan_raw_device, self.vlan_id), "vlan%i" % (self.vlan_id)):
+                raise Exception("the name of VLAN interface %s does not match its VLAN ID" % (self.name))
+        self.get_route_list()
+    
+    # Return the stanza of the interface in /etc/network/interfaces.
+    def get_interfaces_stanza(self):
+        s = "iface %s inet %s\n" % (self.name, self.method)
+        if self.method == "static":
+            s += "\taddress " + self.ip + "\n"
+            s += "\tnetmask " + self.netmask + "\n"
+        if self.bond_mode:
+            s += "\tbond-slaves " + " ".join(self.bond_slave_list) + "\n"
+            s += "\tbond-mode " + self.bond_mode + "\n"
+            s += "\tbond-miimon 100\n"
+        if self.vlan_id:
+            s += "\tvlan-raw-device " + self.vlan_raw_device + "\n"
+        if self.mtu:
+            s += "up /sbin/ip link set dev %s mtu %i\n" % (self.name, self.mtu)
+        if self.method == "static" and self.gateway:
+            # We have to add the gateway in this fashion to support a gateway on
+            # a different subnet.
+            s += "up /sbin/ip route add %s dev %s proto %s\n" % (self.gateway, self.name, route_proto)
+            s += "up /sbin/ip route add default via %s proto %s\n" % (self.gateway, route_proto)
+        for net, gateway in self.get_route_list():
+            s += "up /sbin/ip route add %s via %s dev %s proto %s\n" % (net, gateway, self.name, route_proto)
+        return s
 
 # Represent the root configuration node.
 class RootConfigNode(AbstractConfigNode):
@@ -603,22 +962,20 @@ class RootConfigNode(AbstractConfigNode):
     # Local host information.
     prop_set.add_prop('admin_pwd', '', "Local host administration password.")
     prop_set.add_prop('eth0', NetworkInterfaceConfig, "eth0 network interface")
-    prop_set.add_prop('dns_addr_list',
-                      Prop(model = PropModel(cls=ConfigList, cls_args=[str]),
-                           doc = "DNS server addresses. Leave empty if using DHCP."))
+    prop_set.add_model_prop('iface_list', ConfigList, [NetworkInterfaceConfig],
+                            doc="Network interfaces other than eth0, e.g. a dedicated storage interface.")
+    prop_set.add_model_prop('dns_addr_list', ConfigList, [str],
+                            doc = "DNS server addresses. Leave empty if using DHCP.")
     prop_set.add_prop("hostname", 'localhost', "Hostname of the machine. This does not include the domain.")
     prop_set.add_prop("domain", '', "Domain of the machine.")
-    prop_set.add_prop('all_port_addr_list',
-                      Prop(model = PropModel(cls=ConfigList, cls_args=[str, ['0.0.0.0/0']]),
-                           doc = "List of IP addresses of the form X.X.X.X/X that have access " +
-                                 "to all ports of this server."))
-    prop_set.add_prop('config_port_addr_list',
-                      Prop(model = PropModel(cls=ConfigList, cls_args=[str, ['0.0.0.0/0']]),
-                           doc = "List of IP addresses of the form X.X.X.X/X that have access " +
-                                 "to the configuration ports of this server."))
-    prop_set.add_prop('sshd_line_list',
-                      Prop(model = PropModel(cls=ConfigList, cls_args=[str]),
-                           doc = "List of custom lines to insert into /etc/ssh/sshd_config."))
+    prop_set.add_model_prop('all_port_addr_list', ConfigList, [str, ['0.0.0.0/0']],
+                            doc = "List of IP addresses of the form X.X.X.X/X that have access " +
+                                  "to all ports of this server.")
+    prop_set.add_model_prop('config_port_addr_list', ConfigList, [str, ['0.0.0.0/0']],
+                            doc = "List of IP addresses of the form X.X.X.X/X that have access " +
+                                  "to the configuration ports of this server.")
+    prop_set.add_model_prop('sshd_line_list', ConfigList, [str],
+                            doc = "List of custom lines to insert into /etc/ssh/sshd_config.")
     prop_set.add_prop('tbxsos_service', 0, "True if the TBXSOS service has been enabled by the user.")
     prop_set.add_prop('freemium_service', 0, "True if the Freemium service has been enabled by the user.")
     prop_set.add_prop('mas_service', 0, "True if the MAS service has been enabled by the user.")
@@ -702,12 +1059,10 @@ class RootConfigNode(AbstractConfigNode):
         "Time we well spend waiting for the sendmail program. If you feel the need to\n"
         + "touch that, then there is probably a problem on your system.")
 
-    prop_set.add_prop('kcd_organizations', 
-                      Prop(model = PropModel(cls=ConfigDict, 
-                                             cls_args=[long, str],
-                                             cls_kwargs={'import_key_call':convert_int_to_long}),
-                           doc = 'Organization list. This is used by KCD when it is running in KANP mode.\n'
-                           + 'key_id = org_name'))
+    prop_set.add_model_prop('kcd_organizations', ConfigDict, [long, str],
+                            {'import_key_call':convert_int_to_long},
+                            doc = 'Organization list. This is used by KCD when it is running in KANP mode.\n'
+                            + 'key_id = org_name')
 
     prop_set.add_prop('kcd_kfs_mode', 'local', 
         'Location where the KFS files are stored:\n'
@@ -765,10 +1120,32 @@ class RootConfigNode(AbstractConfigNode):
     # Path to the master config file.
     master_file_path = '/etc/teambox/base/master.cfg'
     
+    # Path to the kernel tuning file, see write_tuning_config().
+    sysctl_file_path = '/etc/sysctl.d/60-teambox.conf'
+    
+    # Limits file written by the previous versions. It is only read by
+    # pam_limits, so it never applied to the services started at boot.
+    old_limits_file_path = '/etc/security/limits.d/teambox.conf'
+    
+    # Markers of the block setting the open files limit in the files sourced
+    # by the init scripts.
+    limits_begin_marker = '# BEGIN TEAMBOX LIMITS - AUTO-GENERATED, DO NOT EDIT.'
+    limits_end_marker = '# END TEAMBOX LIMITS'
+    
+    # Lock protecting the master config file and the files generated from it.
+    # The lock is shared by all the nodes of the process.
+    master_config_lock = KFileLock('/var/lock/teambox-master.lock')
+    
+    # Address lists with more networks than this are matched with an ipset set
+    # instead of one iptables rule per network.
+    ipset_threshold = 16
     
     def __init__(self):
         AbstractConfigNode.__init__(self)
-        
+        self._init_node()
+    
+    # Initialize the non-property instance attributes.
+    def _init_node(self):
         def ret_true(): return 1
     
         # Dictionary mapping user service names to formatted service names.
@@ -797,6 +1174,10 @@ class RootConfigNode(AbstractConfigNode):
         self.server_service_run_dict["kwmo"] = self.must_run_kwmo
         self.server_service_run_dict["freemium_web"] = self.must_run_freemium_web
         
+        # Dictionary of the writes deferred since defer_writes() was called, or
+        # None if the files are written immediately.
+        self.deferred_write_dict = None
+        
     # Return true if the following user-visible service configuration is
     # complete.
     def is_tbxsos_config_complete(self):
@@ -891,9 +1272,31 @@ class RootConfigNode(AbstractConfigNode):
             else:
                 if enabled_flag: return "%s is enabled but it should be disabled" % (name)
                 if run_status != 0: return "%s is running but it should be stopped" % (name)
+        
+        # Check that the network interfaces are configured correctly and have a
+        # link.
+        from knetinfo import get_iface_link_flag
+        try: iface_list = self.get_iface_list()
+        except Exception, e: return "the network configuration is invalid: %s" % (str(e))
+        for iface in iface_list:
+            if not get_iface_link_flag(iface.name): return "network interface %s has no link" % (iface.name)
          
         return ""
         
+    # Return the list of the configured network interfaces, eth0 first. Raise
+    # an exception if the configuration of the interfaces is invalid.
+    def get_iface_list(self):
+        iface_list = [ self.eth0 ] + list(self.iface_list)
+        name_list = []
+        gateway_count = 0
+        for iface in iface_list:
+            iface.check_config()
+            if iface.name in name_list: raise Exception("interface %s is configured twice" % (iface.name))
+            name_list.append(iface.name)
+            if iface.method == "static" and iface.gateway: gateway_count += 1
+        if gateway_count > 1: raise Exception("only one interface can have a gateway")
+        return iface_list
+    
     # Load a master config file.
     def load_master_config(self, path=master_file_path, update=False):
         if os.path.isfile(path): content = read_file(path)
@@ -901,9 +1304,49 @@ class RootConfigNode(AbstractConfigNode):
         if content == "": content = "(())"
         self.load_from_kserialized_obj(eval(content), update=update)
 
+    # Lock the master config file and the files generated from it. A shared
+    # lock is sufficient to read the configuration, an exclusive lock is
+    # required to modify it. If the lock cannot be obtained within 'timeout'
+    # seconds, an exception describing the holders is raised.
+    def lock_master_config(self, exclusive_flag=0, timeout=60, desc=""):
+        self.master_config_lock.acquire(exclusive_flag, timeout, desc)
+    
+    # Release the lock obtained with lock_master_config().
+    def unlock_master_config(self):
+        self.master_config_lock.release()
+    
     # Save to a master config file.
     def save_master_config(self, path=master_file_path):
-        write_file_atom(path, Dumper().dump_config_to_kserialized_string(self))
+        if self.deferred_write_dict != None and path == self.master_file_path:
+            self.deferred_write_dict["master"] = 1
+            return
+        write_file_atom(path, self.get_master_config_string())
+    
+    # Return the content of the master config file for the current
+    # configuration.
+    def get_master_config_string(self):
+        return Dumper().dump_config_to_kserialized_string(self)
+    
+    # Defer the writes of the master config file, the service configuration
+    # and the network configuration until run_deferred_writes() is called.
+    def defer_writes(self):
+        self.deferred_write_dict = {}
+    
+    # Perform each write deferred since defer_writes() was called once, from
+    # the current configuration, and stop deferring the writes.
+    def run_deferred_writes(self):
+        d = self.deferred_write_dict
+        self.deferred_write_dict = None
+        if d == None: return
+        if d.has_key("master"): self.save_master_config()
+        if d.has_key("service"): self.write_service_config()
+        if d.has_key("network"): self.write_network_config()
+        if d.has_key("tuning"): self.write_tuning_config()
+    
+    # Drop the writes deferred since defer_writes() was called and stop
+    # deferring the writes.
+    def discard_deferred_writes(self):
+        self.deferred_write_dict = None
 
     # Read and return the (major, minor) product version tuple contained in the
     # product version file.
@@ -1008,7 +1451,7 @@ class RootConfigNode(AbstractConfigNode):
         service_manager.restart_services(force_flag, output_stream)
         
         # Reload Apache configuration.
-        service_manager.get_service("apache").reload_config()
+        service_manager.reload_apache_config()
     
     # Switch to production mode.
     def switch_to_production_mode(self, service_manager, force_flag=0, output_stream=None):
@@ -1018,19 +1461,18 @@ class RootConfigNode(AbstractConfigNode):
     def switch_to_maintenance_mode(self, service_manager, force_flag=0, output_stream=None):
         self._switch_mode_helper(service_manager, 0, force_flag, output_stream)
     
+    # Change keys in a tbxsosd-style configuration file. The keys are specified
+    # as a list of (key, value) pairs. The file is read and written once. Return
+    # true if the file was changed.
+    def change_keys_tbxsosd_config(self, file_path, item_list):
+        config = KTbxsosdConfig(file_path)
+        config.read()
+        config.set_list(item_list)
+        return config.write()
+
     # Change a key in a tbxsosd-style configuration file.
     def change_key_tbxsosd_config(self, file_path, key, val):
-        out_lines = []
-        changed_line = '%s = "%s";' % (key, val)
-        found = 0
-        for line in read_file(file_path).split("\n"):
-            if line.strip() == "": continue
-            if line.startswith(key):
-                line = changed_line
-                found = 1
-            out_lines.append(line)
-        if not found: out_lines.append(changed_line)
-        write_file_atom(file_path, "\n".join(out_lines) + "\n")
+        return self.change_keys_tbxsosd_config(file_path, [(key, val)])
     
     # Bind an INI file to this node and define some methods for convenience.
     def bind_ini_file(self):
@@ -1049,14 +1491,18 @@ class RootConfigNode(AbstractConfigNode):
                 
         return BoundIniFile()
     
-    # Write configuration to /etc/teambox/tbxsosd/web.conf.
+    # Write configuration to /etc/teambox/tbxsosd/web.conf. Return true if the
+    # file was changed.
     def update_tbxsosd_web_conf(self, file_path="/etc/teambox/tbxsosd/web.conf"):
-        self.change_key_tbxsosd_config(file_path, "server.listen_on", "0.0.0.0:5000")
-        self.change_key_tbxsosd_config(file_path, "server.ssl_listen_on", "")
-        self.change_key_tbxsosd_config(file_path, "server.kas_address", self.kcd_host)
-        self.change_key_tbxsosd_config(file_path, "server.kas_port", 443)
-        
-    # Write configuration to kcd.ini.
+        return self.change_keys_tbxsosd_config(file_path,
+                                               [ ("server.listen_on", "0.0.0.0:5000"),
+                                                 ("server.ssl_listen_on", ""),
+                                                 ("server.kas_address", self.kcd_host),
+                                                 ("server.kas_port", 443) ])
+        
+    # Write configuration to kcd.ini. The file is only rewritten if its content
+    # changed. Return the keys added, removed and changed in each section, as
+    # per KIniFile.patch(), so that kcd can be told which keys moved.
     def write_kcd_ini(self, file_path='/etc/teambox/kcd/kcd.ini'):
         ini_file = self.bind_ini_file()
 
@@ -1076,14 +1522,16 @@ class RootConfigNode(AbstractConfigNode):
         for key, org in self.kcd_organizations.items():
             ini_file.set('organizations', str(key), org)
 
-        write_file_atom(file_path, ini_file.write_to_string())
+        diff = ini_file.write_to_file_if_changed(file_path)
         
         # Restriction hack.
         restriction_path = "/etc/freemium"
         if self.kcd_enforce_restriction: write_file(restriction_path, "")
         else: delete_file(restriction_path)
+
+        return diff
     
-    # Write configuration to kfs.ini.
+    # Write configuration to kfs.ini. See write_kcd_ini().
     def write_kfs_ini(self, file_path='/etc/teambox/kcd/kfs.ini'):
         ini_file = self.bind_ini_file()
         ini_file.add_section('config')
@@ -1094,7 +1542,7 @@ class RootConfigNode(AbstractConfigNode):
             ini_file.prop_key('config', name, 'kcd_' + name)
 
         # Write file.
-        write_file_atom(file_path, ini_file.write_to_string())
+        return ini_file.write_to_file_if_changed(file_path)
     
     # Write configuration to /etc/ssmtp/ssmtp.conf.
     def write_ssmtp_conf_file(self, path="/etc/ssmtp/ssmtp.conf"):
@@ -1123,21 +1571,11 @@ class RootConfigNode(AbstractConfigNode):
     
     # Write configuration to /etc/network/interfaces.
     def write_etc_network_file(self):
+        iface_list = self.get_iface_list()
         s = ""
-        s += "auto lo eth0\n"
+        s += "auto lo " + " ".join([ iface.name for iface in iface_list ]) + "\n"
         s += "iface lo inet loopback\n"
-        
-        if self.eth0.method == "dhcp":
-            s += "iface eth0 inet dhcp\n"
-        else:
-            s += "iface eth0 inet static\n"
-            s += "\taddress " + self.eth0.ip + "\n"
-            s += "\tnetmask " + self.eth0.netmask + "\n"
-            
-            # We have to add the gateway in this fashion to support a gateway on
-            # a different subnet.
-            s += "up route add -host " + self.eth0.gateway + " eth0\n"
-            s += "up route add default gw " + self.eth0.gateway + "\n"
+        for iface in iface_list: s += iface.get_interfaces_stanza()
         s += "\n"
         
         write_file_atom("/etc/network/interfaces", s)
@@ -1160,6 +1598,12 @@ class RootConfigNode(AbstractConfigNode):
         for line in self.sshd_line_list: s += line + "\n"
         write_file_atom("/etc/ssh/sshd_config", s)
     
+    # Return true if the ipset 4 tool and kernel module shipped by
+    # xtables-addons are available. The sets use the ipset 4 syntax.
+    def has_ipset(self):
+        try: return get_cmd_output(["ipset", "-V"]).startswith("ipset v4.")
+        except: return 0
+    
     # Write the content of /etc/teambox/base/iptables.rules.
     def write_iptables_config_file(self):
         s = ""
@@ -1186,13 +1630,30 @@ class RootConfigNode(AbstractConfigNode):
         s += "-A INPUT -p tcp -m tcp --dport 22 -j ACCEPT\n"
         s += "-A INPUT -p tcp -m tcp --dport 443 -j ACCEPT\n"
         
-        # Allow access to all ports to the specified addresses.
-        for line in self.all_port_addr_list:
-            s += "-A INPUT -s %s -p tcp -m tcp -j ACCEPT\n" % (line)
-        
-        # Allow access to configuration ports to the specified addresses.
-        for line in self.config_port_addr_list:
-            s += "-A INPUT -s %s -p tcp -m tcp --dport 9000:9001 -j ACCEPT\n" % (line)
+        # Allow access to all ports and to the configuration ports to the
+        # specified addresses. The addresses are merged into the smallest list
+        # of networks. Large lists are matched by ipset sets when ipset is
+        # available, so that the cost per packet does not depend on their
+        # size. The networks and the single addresses go in separate sets.
+        ipset_list = []
+        ipset_flag = None
+        for set_name, addr_list, dport in [ ("teambox_all_port", self.all_port_addr_list, ""),
+                                            ("teambox_config_port", self.config_port_addr_list,
+                                             " --dport 9000:9001") ]:
+            net_list = collapse_ipv4_cidr_list(addr_list)
+            if len(net_list) > self.ipset_threshold and ipset_flag == None: ipset_flag = self.has_ipset()
+            if len(net_list) > self.ipset_threshold and ipset_flag:
+                host_list = [n[:-3] for n in net_list if n.endswith("/32")]
+                net_list = [n for n in net_list if not n.endswith("/32")]
+                for suffix, set_type, entry_list in [ ("_net", "nethash", net_list),
+                                                      ("_ip", "iphash", host_list) ]:
+                    if not len(entry_list): continue
+                    ipset_list.append(get_ipset_load_string(set_name + suffix, set_type, entry_list))
+                    s += "-A INPUT -m set --match-set %s src -p tcp -m tcp%s -j ACCEPT\n" % \
+                         (set_name + suffix, dport)
+            else:
+                for net in net_list:
+                    s += "-A INPUT -s %s -p tcp -m tcp%s -j ACCEPT\n" % (net, dport)
         
         # Accept incoming pings.
         s += "-A INPUT -p icmp -m icmp --icmp-type 8 -m state --state NEW -j ACCEPT\n"
@@ -1211,17 +1672,155 @@ class RootConfigNode(AbstractConfigNode):
         # Commit the changes.
         s += "COMMIT\n"
         
+        # The sets must be loaded before the rules that use them. The loading
+        # script is run with 'sh -e'.
+        if len(ipset_list): write_file_atom("/etc/teambox/base/ipset.sh", "".join(ipset_list))
+        else: delete_file("/etc/teambox/base/ipset.sh")
         write_file_atom("/etc/teambox/base/iptables.rules", s)
     
     # Write the service configuration.
     def write_service_config(self):
+        if self.deferred_write_dict != None:
+            self.deferred_write_dict["service"] = 1
+            return
         self.update_tbxsosd_web_conf()
         self.write_kcd_ini()
         self.write_kfs_ini()
         self.write_ssmtp_conf_file()
    
+    # Return the settings of the postgresql.conf file specified as a dictionary
+    # mapping the setting names to their value, as strings.
+    def get_postgres_setting_dict(self, path="/etc/postgresql/8.4/teambox/postgresql.conf"):
+        d = {}
+        if not os.path.isfile(path): return d
+        for line in read_file(path).split("\n"):
+            line = line.split("#", 1)[0].strip()
+            if line.find("=") == -1: continue
+            key, value = line.split("=", 1)
+            d[key.strip()] = value.strip().strip("'")
+        return d
+    
+    # Return the amount of memory of the host, in bytes.
+    def get_mem_total(self):
+        for line in read_file("/proc/meminfo").split("\n"):
+            if line.startswith("MemTotal:"): return long(line.split()[1]) * 1024
+        raise Exception("cannot read the amount of memory")
+    
+    # Return the kernel tuning profile of the host, as a tuple containing the
+    # list of (sysctl key, value, comment) tuples and the list of (file, open
+    # files limit, comment) tuples. The files are sourced by the init scripts
+    # of the services, so the limit is set with 'ulimit -n' before the service
+    # is started. Postgres needs no limit: it opens at most
+    # max_files_per_process files per backend and lowers that value to the
+    # limit it gets. The values are derived from the Postgres
+    # settings, the configured network interfaces and the amount of memory of
+    # the host. 'pg_setting_dict' and 'mem_total' can be specified to override
+    # the values read from the host.
+    def get_tuning_profile(self, pg_setting_dict=None, mem_total=None):
+        if pg_setting_dict == None: pg_setting_dict = self.get_postgres_setting_dict()
+        if mem_total == None: mem_total = self.get_mem_total()
+        page_size = 4096
+        
+        # Postgres settings. The shared_buffers value is a number of 8kB blocks
+        # unless it has a unit.
+        max_conn = int(pg_setting_dict.get("max_connections", "100"))
+        max_locks = int(pg_setting_dict.get("max_locks_per_transaction", "64"))
+        max_files = int(pg_setting_dict.get("max_files_per_process", "1000"))
+        match = re.match("^(\d+)\s*(kB|MB|GB)?$", pg_setting_dict.get("shared_buffers", "32MB"))
+        if not match: raise Exception("invalid Postgres shared_buffers setting")
+        shared_buffers = long(match.group(1)) * { None : 8192, "kB" : 1024, "MB" : 1024 ** 2,
+                                                 "GB" : 1024 ** 3 }[match.group(2)]
+        
+        # Shared memory needed by Postgres 8.4, per the sizing table of its
+        # documentation, with a 25% margin. Keep the historical 512MB minimum
+        # and never exceed the memory of the host.
+        pg_shm = shared_buffers * 8300 / 8192 + (1800 + 270 * max_locks) * max_conn + 16 * 1024 ** 2
+        shmmax = max(512 * 1024 ** 2, pg_shm * 5 / 4)
+        shmmax = min(shmmax, mem_total) / page_size * page_size
+        
+        # Postgres uses one semaphore set of 17 semaphores per 16 processes,
+        # counting the autovacuum workers.
+        sem_set_count = (max_conn + 3 + 15) / 16
+        semmni = max(128, sem_set_count * 5 / 4)
+        semmns = max(32000, semmni * 17)
+        
+        # Accept queues sized for the connection load. The local port range
+        # starts above the ports the services listen to.
+        somaxconn = min(65535, max(1024, max_conn))
+        iface_count = len(self.get_iface_list())
+        
+        # Open files: one file per connection for the frontends, and the open
+        # files of every Postgres backend, with the kernel default as minimum.
+        frontend_nofile = 65536
+        file_max = max(mem_total / 1024 / 10, max_conn * max_files / 4 + 4 * frontend_nofile)
+        
+        sysctl_list = [
+            ("kernel.shmmax", str(shmmax), "Largest shared memory segment, for the Postgres shared memory."),
+            ("kernel.shmall", str(max(2097152, shmmax / page_size)),
+             "Total shared memory, in pages. The kernel default is never lowered."),
+            ("kernel.sem", "250 %i 32 %i" % (semmns, semmni),
+             "Semaphores: %i Postgres connections need %i sets." % (max_conn, sem_set_count)),
+            ("net.core.somaxconn", str(somaxconn), "Maximum accept queue length of a listening socket."),
+            ("net.ipv4.tcp_max_syn_backlog", str(min(65536, somaxconn * 2)),
+             "Maximum number of half-open connections."),
+            ("net.core.netdev_max_backlog", str(min(65536, 4096 * iface_count)),
+             "Packets queued per CPU when the interfaces receive faster than the kernel processes."),
+            ("net.ipv4.ip_local_port_range", "10240 65535",
+             "Ports used for outgoing connections, above the ports the services listen to."),
+            ("fs.file-max", str(file_max), "Maximum number of open files of the host.") ]
+        
+        nofile_list = [
+            ("/etc/apache2/envvars", frontend_nofile, "Apache and the web applications."),
+            ("/etc/default/tbxsosd", frontend_nofile, "TBXSOSD client connections."),
+            ("/etc/default/kcd", frontend_nofile, "KCD client connections."),
+            ("/etc/default/kcdnotif", frontend_nofile, "KCD notification connections.") ]
+        
+        return (sysctl_list, nofile_list)
+    
+    # Return the content of the sysctl file and the list of (file, limits
+    # block) pairs for the tuning profile specified, see get_tuning_profile().
+    def get_tuning_file_content(self, profile):
+        sysctl_list, nofile_list = profile
+        s = "# WARNING: THIS FILE IS AUTO-GENERATED.\n"
+        for key, value, comment in sysctl_list: s += "\n# %s\n%s = %s\n" % (comment, key, value)
+        block_list = []
+        for path, nofile, comment in nofile_list:
+            block = "%s\n# %s\nulimit -n %i\n%s\n" % (self.limits_begin_marker, comment, nofile, self.limits_end_marker)
+            block_list.append((path, block))
+        return (s, block_list)
+    
+    # Replace the limits block of the file specified, or append it. The rest
+    # of the file is kept.
+    def write_limits_block(self, path, block):
+        content = ""
+        if os.path.isfile(path): content = read_file(path)
+        start = content.find(self.limits_begin_marker)
+        end = content.find(self.limits_end_marker)
+        if start != -1 and end > start:
+            end = content.find("\n", end)
+            if end == -1: end = len(content)
+            else: end += 1
+            content = content[:start] + block + content[end:]
+        else:
+            if content != "" and not content.endswith("\n"): content += "\n"
+            content += block
+        write_file_atom(path, content)
+    
+    # Write the kernel tuning files.
+    def write_tuning_config(self):
+        if self.deferred_write_dict != None:
+            self.deferred_write_dict["tuning"] = 1
+            return
+        s, block_list = self.get_tuning_file_content(self.get_tuning_profile())
+        write_file_atom(self.sysctl_file_path, s)
+        for path, block in block_list: self.write_limits_block(path, block)
+        delete_file(self.old_limits_file_path)
+    
     # Write the network configuration.
     def write_network_config(self):
+        if self.deferred_write_dict != None:
+            self.deferred_write_dict["network"] = 1
+            return
         self.write_etc_hostname_file()
         self.write_etc_hosts_file()
         self.write_etc_network_file()
@@ -1229,3 +1828,10 @@ class RootConfigNode(AbstractConfigNode):
         self.write_sshd_config_file()
         self.write_iptables_config_file()
 
+# Compiled versions of the configuration nodes. They have the same interface as
+# the regular nodes but they are faster and smaller, which matters when many
+# configuration snapshots are kept in memory. The classes are compiled on first
+# use and cached, so that importing this module stays cheap.
+def get_compiled_root_config_node_class():
+    return compile_config_node_class(RootConfigNode)
+
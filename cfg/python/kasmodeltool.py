@@ -1,4 +1,4 @@
-import os, types
+import os, re, dis, types, time, errno, fcntl, operator
 from kfile import read_file, write_file_atom, read_ini_file, write_ini_file
 from kodict import odict
 from kproperty import PropContainer, PropSet, PropModel, Prop, IntProp, LongProp, StrProp
@@ -13,6 +13,94 @@ def convert_int_to_long(value):
 def escape_string(value):
     return "'" + value.replace("\\", "\\\\").replace("'", "\\'") + "'"
 
+# Parse an IPv4 address or network in CIDR notation, e.g. '10.0.0.0/8'. An
+# address without prefix length is a /32 network. The host bits are cleared.
+# Return a (network, prefix length) tuple where the network is a long.
+def parse_ipv4_cidr(s):
+    arr = s.strip().split('/')
+    if len(arr) > 2: raise Exception("Invalid network address '%s'." % (s))
+    octet_list = arr[0].split('.')
+    if len(octet_list) != 4: raise Exception("Invalid network address '%s'." % (s))
+    try:
+        addr = 0L
+        for octet in octet_list:
+            if not octet.isdigit() or int(octet) > 255: raise ValueError
+            addr = (addr << 8) | int(octet)
+        prefix_len = 32
+        if len(arr) == 2:
+            if not arr[1].isdigit(): raise ValueError
+            prefix_len = int(arr[1])
+            if prefix_len > 32: raise ValueError
+    except ValueError:
+        raise Exception("Invalid network address '%s'." % (s))
+    mask = (0xffffffffL << (32 - prefix_len)) & 0xffffffffL
+    return (addr & mask, prefix_len)
+
+# Return the prefix length corresponding to a dotted netmask, e.g. 24 for
+# '255.255.255.0'.
+def get_ipv4_prefix_len(netmask):
+    mask = parse_ipv4_cidr(netmask)[0]
+    prefix_len = 0
+    while prefix_len < 32 and mask & (1L << (31 - prefix_len)): prefix_len += 1
+    if mask != (0xffffffffL << (32 - prefix_len)) & 0xffffffffL:
+        raise Exception("Invalid netmask '%s'." % (netmask))
+    return prefix_len
+
+# Format a (network, prefix length) tuple in CIDR notation.
+def format_ipv4_cidr(net):
+    addr, prefix_len = net
+    return "%d.%d.%d.%d/%d" % ((addr >> 24) & 0xff, (addr >> 16) & 0xff,
+                               (addr >> 8) & 0xff, addr & 0xff, prefix_len)
+
+# Return the smallest list of CIDR networks that covers exactly the same
+# addresses as the list of addresses and networks specified. Duplicate,
+# overlapping and adjacent networks are merged. The result is sorted.
+def collapse_ipv4_cidr_list(addr_list):
+    # Convert the networks to sorted [first, last] address ranges and merge them.
+    range_list = []
+    for s in addr_list:
+        addr, prefix_len = parse_ipv4_cidr(s)
+        range_list.append((addr, addr + (1L << (32 - prefix_len)) - 1))
+    range_list.sort()
+    merged_list = []
+    for first, last in range_list:
+        if len(merged_list) and first <= merged_list[-1][1] + 1:
+            if last > merged_list[-1][1]: merged_list[-1][1] = last
+        else:
+            merged_list.append([first, last])
+
+    # Split every range in the largest aligned networks it contains.
+    res = []
+    for first, last in merged_list:
+        while first <= last:
+            prefix_len = 32
+            while prefix_len > 0:
+                size = 1L << (32 - prefix_len + 1)
+                if first % size or first + size - 1 > last: break
+                prefix_len -= 1
+            res.append(format_ipv4_cidr((first, prefix_len)))
+            first += 1L << (32 - prefix_len)
+    return res
+
+# Return the shell commands that set the content of the ipset 4 set specified
+# to the list of entries specified. The set type is 'nethash' for networks and
+# 'iphash' for single addresses, since nethash cannot store a /32. The new
+# content is restored in a temporary set which is then swapped with the set,
+# so that the rules using the set never see it partially loaded. ipset 4 has
+# no equivalent of '-exist', hence the explicit checks.
+def get_ipset_load_string(set_name, set_type, entry_list):
+    tmp_name = set_name + "_tmp"
+    l = [ "ipset -X %s 2>/dev/null || true\n" % (tmp_name),
+          "ipset -L %s >/dev/null 2>&1 || ipset -N %s %s\n" % (set_name, set_name, set_type),
+          "ipset -R <<EOF\n",
+          "-N %s %s\n" % (tmp_name, set_type) ]
+    for entry in entry_list: l.append("-A %s %s\n" % (tmp_name, entry))
+    l += [ "COMMIT\n",
+           "EOF\n",
+           "ipset -W %s %s\n" % (tmp_name, set_name),
+           "ipset -X %s\n" % (tmp_name) ]
+    return "".join(l)
+
 # Represents a configuration node that contains configuration properties.
 class AbstractConfigNode(PropContainer):
     # Import configurations from a kserialized python object.
@@ -46,6 +134,97 @@ class AbstractConfigNode(PropContainer):
                         # Set property value directly.
                         prop.__set__(self, value)
 
+# Reader/writer lock on a file, based on flock(). Any number of shared locks can
+# be held at once while an exclusive lock excludes all other locks. The holders
+# register themselves in a directory next to the lock file so that they can be
+# reported when a lock cannot be obtained in time.
+class KFileLock(object):
+    def __init__(self, path):
+        
+        # Path to the lock file.
+        self.path = path
+        
+        # Directory containing one file per holder, named after its PID.
+        self.holder_dir = path + ".holders/"
+        
+        # Lock file object, if the lock is held.
+        self.lock_file = None
+        
+        # True if the lock held is exclusive.
+        self.exclusive_flag = 0
+    
+    # Acquire the lock. If the lock cannot be obtained within 'timeout' seconds,
+    # an exception describing the current holders is raised. 'desc' describes
+    # this holder to the other processes.
+    def acquire(self, exclusive_flag=0, timeout=60, desc=""):
+        if self.lock_file: raise Exception("lock %s is already held" % (self.path))
+        
+        if exclusive_flag: op = fcntl.LOCK_EX
+        else: op = fcntl.LOCK_SH
+        
+        f = open(self.path, "a")
+        deadline = time.time() + timeout
+        delay = 0.01
+        while 1:
+            try:
+                fcntl.flock(f.fileno(), op | fcntl.LOCK_NB)
+                break
+            except IOError, e:
+                if e.errno != errno.EAGAIN and e.errno != errno.EACCES:
+                    f.close()
+                    raise
+                if time.time() >= deadline:
+                    f.close()
+                    raise Exception("timed out waiting for lock %s, held by %s" % (self.path, self.format_holders()))
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
+        
+        self.lock_file = f
+        self.exclusive_flag = exclusive_flag
+        
+        # Register this holder.
+        if not os.path.isdir(self.holder_dir): os.makedirs(self.holder_dir)
+        if exclusive_flag: mode = "exclusive"
+        else: mode = "shared"
+        write_file_atom(self.holder_dir + str(os.getpid()), "%s %i %s\n" % (mode, int(time.time()), desc))
+    
+    # Release the lock, if it is held.
+    def release(self):
+        if not self.lock_file: return
+        try: os.unlink(self.holder_dir + str(os.getpid()))
+        except OSError: pass
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+        self.lock_file.close()
+        self.lock_file = None
+    
+    # Return the list of (pid, mode, start time, description) tuples describing
+    # the processes holding the lock. The entries of dead processes are
+    # removed.
+    def get_holder_list(self):
+        holder_list = []
+        if not os.path.isdir(self.holder_dir): return holder_list
+        for name in os.listdir(self.holder_dir):
+            if not name.isdigit(): continue
+            path = self.holder_dir + name
+            if not os.path.isdir("/proc/" + name):
+                try: os.unlink(path)
+                except OSError: pass
+                continue
+            try: fields = read_file(path).strip().split(" ", 2)
+            except IOError: continue
+            while len(fields) < 3: fields.append("")
+            holder_list.append((int(name), fields[0], int(fields[1] or 0), fields[2]))
+        holder_list.sort()
+        return holder_list
+    
+    # Return a string describing the processes holding the lock.
+    def format_holders(self):
+        l = []
+        for pid, mode, start_time, desc in self.get_holder_list():
+            l.append("PID %i (%s since %s: %s)" % (pid, mode, time.strftime("%H:%M:%S", time.localtime(start_time)), desc))
+        if not len(l): return "an unregistered process"
+        return ", ".join(l)
+
 # Validating list object.
 class ModeledList(list):
     def __init__(self, value_model, *args, **kwargs):
@@ -236,21 +415,217 @@ class ConfigDict(ModeledDict):
 
 # Property set.
 class ConfigPropSet(PropSet):
+    def __init__(self, *args, **kwargs):
+        PropSet.__init__(self, *args, **kwargs)
+
+        # Dictionary mapping property names to the (kind, argument) tuples used
+        # by compile_config_node_class(). The kind is 'str', 'int' or 'long'
+        # with the default value as argument, 'node' with the node class as
+        # argument, 'model' with the (cls, cls_args, cls_kwargs) tuple as
+        # argument or 'prop' for opaque properties that cannot be compiled.
+        self.compile_spec_dict = {}
+
     # Add a property.
     def add_prop(self, name, value, doc=''):
         if isinstance(value, basestring):
             self[name] = StrProp(default=value, doc=doc)
+            self.compile_spec_dict[name] = ('str', value)
         elif isinstance(value, int):
             self[name] = IntProp(default=value, doc=doc, convert_from_string=True)
+            self.compile_spec_dict[name] = ('int', value)
         elif isinstance(value, long):
             self[name] = LongProp(default=value, doc=doc, convert_from_string=True)
+            self.compile_spec_dict[name] = ('long', value)
         elif isinstance(value, Prop):
             self[name] = value
+            self.compile_spec_dict[name] = ('prop', None)
         elif type(value) == types.TypeType:
             self[name] = Prop(model = PropModel(cls=value), doc=doc)
+            self.compile_spec_dict[name] = ('node', value)
         else:
             raise Exception("invalid type for %s in property set" % (name))
 
+    # Add a property whose value is an instance of 'cls', created with the
+    # arguments specified.
+    def add_model_prop(self, name, cls, cls_args=[], cls_kwargs={}, doc=''):
+        self.add_prop(name, Prop(model = PropModel(cls=cls, cls_args=cls_args, cls_kwargs=cls_kwargs), doc=doc))
+        self.compile_spec_dict[name] = ('model', (cls, cls_args, cls_kwargs))
+
+# Base class of the node classes generated by compile_config_node_class(). The
+# property values are stored in slots and accessed as plain attributes.
+class CompiledConfigNode(object):
+    __slots__ = ()
+
+    def __getitem__(self, name):
+        if not name in self.prop_set: raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if not name in self.prop_set: raise KeyError(name)
+        setattr(self, name, value)
+
+# Dictionary mapping config node classes to their compiled counterpart.
+compiled_node_class_dict = {}
+
+# Return the names of the attributes assigned through 'self' by the code
+# specified, e.g. 'foo' for 'self.foo = 1', including in the nested functions
+# that use 'self' from the enclosing scope. The 'self' argument of a nested
+# method refers to another object and is ignored, unless 'own_flag' is true.
+def get_code_self_attr_list(code, own_flag=1):
+    l = []
+    var_list = code.co_cellvars + code.co_freevars
+    op_code = code.co_code
+    self_flag = 0
+    i = 0
+    while i < len(op_code):
+        op = ord(op_code[i])
+        arg = None
+        if op >= dis.HAVE_ARGUMENT:
+            arg = ord(op_code[i + 1]) + ord(op_code[i + 2]) * 256
+            i += 3
+        else:
+            i += 1
+        if op == dis.opmap['STORE_ATTR'] and self_flag: l.append(code.co_names[arg])
+        if op == dis.opmap['LOAD_FAST']: self_flag = own_flag and code.co_varnames[arg] == 'self'
+        elif op == dis.opmap['LOAD_DEREF']: self_flag = var_list[arg] == 'self' and (own_flag or 'self' in code.co_freevars)
+        else: self_flag = 0
+    for const in code.co_consts:
+        if isinstance(const, types.CodeType): l.extend(get_code_self_attr_list(const, 0))
+    return l
+
+# Return true if the object specified is a config node class that
+# compile_config_node_class() accepts.
+def is_compilable_node_class(obj):
+    return isinstance(obj, type) and issubclass(obj, AbstractConfigNode) and \
+           isinstance(getattr(obj, 'prop_set', None), ConfigPropSet)
+
+# Return a specialized version of the config node class specified. The returned
+# class has the same properties and methods, but the properties are stored in
+# __slots__, their defaults are precomputed and the loader and the item list
+# used by the dumper are generated code without per-property indirection. The
+# string and integer properties are read directly from their slot through a
+# C-level getter and validated by a generated setter, like the StrProp and
+# IntProp descriptors do.
+#
+# The methods of the class are copied as-is, except __init__(). Non-property
+# instance state must be created by an '_init_node' method. The other methods
+# may assign it too: the attributes assigned through 'self' by the methods get
+# a slot, and an exception is raised if one of them is a class attribute.
+# Nested node properties and the lists of nodes use the compiled version of the
+# node class.
+def compile_config_node_class(node_class):
+    if compiled_node_class_dict.has_key(node_class): return compiled_node_class_dict[node_class]
+
+    prop_set = node_class.prop_set
+    if not isinstance(prop_set, ConfigPropSet):
+        raise Exception("%s: property set cannot be compiled" % (node_class.__name__))
+
+    # Namespace of the generated code.
+    env = { 'doc_list' : [] }
+
+    reset_lines = []
+    load_lines = []
+    set_lines = []
+    item_list = []
+    slot_list = []
+    value_prop_list = []
+    for name, prop in prop_set.items():
+        if not re.match("^[a-zA-Z_][a-zA-Z0-9_]*$", name):
+            raise Exception("%s: invalid property name '%s'" % (node_class.__name__, name))
+        kind, arg = prop_set.compile_spec_dict.get(name, ('prop', None))
+
+        # The value properties are stored in the '_v_<name>' slot.
+        slot = name
+        if kind in ('str', 'int', 'long'):
+            slot = '_v_' + name
+            value_prop_list.append(name)
+            reset_lines.append("    self.%s = %r" % (slot, arg))
+        elif kind == 'node':
+            env['cls_' + name] = compile_config_node_class(arg)
+            reset_lines.append("    self.%s = cls_%s()" % (name, name))
+        elif kind == 'model':
+            cls, cls_args, cls_kwargs = arg
+            cls_args = [ compile_config_node_class(a) if is_compilable_node_class(a) else a for a in cls_args ]
+            env['cls_' + name], env['args_' + name], env['kwargs_' + name] = cls, cls_args, cls_kwargs
+            reset_lines.append("    self.%s = cls_%s(*args_%s, **kwargs_%s)" % (name, name, name, name))
+        else:
+            raise Exception("%s: property '%s' cannot be compiled" % (node_class.__name__, name))
+
+        slot_list.append(slot)
+
+        if kind == 'str':
+            set_lines.append("def set_%s(self, value):" % (name))
+            set_lines.append("    if not isinstance(value, basestring): raise Exception(\"%s: bad value\")" % (name))
+            set_lines.append("    self.%s = value" % (slot))
+        elif kind in ('int', 'long'):
+            set_lines.append("def set_%s(self, value):" % (name))
+            set_lines.append("    if isinstance(value, bool) or not isinstance(value, (int, long, basestring)):")
+            set_lines.append("        raise Exception(\"%s: bad value\")" % (name))
+            set_lines.append("    try: self.%s = %s(value)" % (slot, kind))
+            set_lines.append("    except ValueError: raise Exception(\"%s: bad value\")" % (name))
+
+        load_lines.append("def load_%s(self, value, update):" % (name))
+        if kind in ('str', 'int', 'long'):
+            load_lines.append("    set_%s(self, value)" % (name))
+        else:
+            load_lines.append("    self.%s.load_from_kserialized_obj(value, update)" % (name))
+
+        item_list.append("(%r, self.%s, doc_list[%i])" % (name, slot, len(env['doc_list'])))
+        env['doc_list'].append(prop.doc)
+
+    init_extra = ""
+    if hasattr(node_class, '_init_node'): init_extra = "    self._init_node()\n"
+
+    src = ""
+    src += "def reset_props(self):\n" + "\n".join(reset_lines) + "\n    pass\n"
+    src += "def __init__(self):\n" + "\n".join(reset_lines) + "\n" + init_extra + "    pass\n"
+    src += "\n".join(set_lines) + "\n"
+    src += "\n".join(load_lines) + "\n"
+    src += "load_dict = {" + ", ".join(["%r: load_%s" % (n, n) for n in prop_set.keys()]) + "}\n"
+    src += "def load_from_kserialized_obj(self, data, update=False):\n"
+    src += "    if not update: self.reset_props()\n"
+    src += "    for key, value in data:\n"
+    src += "        load = load_dict.get(key)\n"
+    src += "        if load != None: load(self, value, update)\n"
+    src += "def get_item_list(self):\n"
+    src += "    return (" + "".join([i + ", " for i in item_list]) + ")\n"
+    exec src in env
+
+    # Copy the methods and class attributes of the node class and its config
+    # node base classes.
+    ns = {}
+    for cls in reversed(node_class.__mro__):
+        if not issubclass(cls, AbstractConfigNode) or cls is AbstractConfigNode: continue
+        for key, value in cls.__dict__.items():
+            if key in ('__dict__', '__weakref__', '__init__'): continue
+            ns[key] = value
+
+    # Add a slot for each non-property attribute assigned by the methods.
+    extra_slot_list = []
+    for key, value in ns.items():
+        if not isinstance(value, types.FunctionType): continue
+        for attr in get_code_self_attr_list(value.func_code):
+            if attr in prop_set or attr in extra_slot_list: continue
+            if attr in ns:
+                raise Exception("%s: %s() assigns class attribute '%s'" % (node_class.__name__, key, attr))
+            extra_slot_list.append(attr)
+    extra_slot_list.sort()
+
+    for key in ('reset_props', '__init__', 'load_from_kserialized_obj', 'get_item_list'):
+        ns[key] = env[key]
+    for name in value_prop_list:
+        ns[name] = property(operator.attrgetter('_v_' + name), env['set_' + name], None, prop_set[name].doc)
+    ns['__slots__'] = tuple(slot_list) + tuple(extra_slot_list)
+
+    compiled_class = type('Compiled' + node_class.__name__, (CompiledConfigNode,), ns)
+    compiled_node_class_dict[node_class] = compiled_class
+    return compiled_class
+
+# Return the list of (name, value, doc) tuples of the config node specified.
+def get_config_node_item_list(node):
+    if isinstance(node, CompiledConfigNode): return node.get_item_list()
+    return [ (name, prop.__get__(node), prop.doc) for name, prop in node.prop_set.items() ]
+
 # Recursively dump config to a kserialized string, with comments. Output is then
 # parsable by python (eval) and can be imported again.
 class Dumper(object):
@@ -337,11 +712,16 @@ class Dumper(object):
         container_start_char = '('
         container_stop_char = ')'
 
+        # Property comments, if any.
+        comments = None
+
         # Extract data from object.
-        if isinstance(obj, AbstractConfigNode):
-            length = len(obj.prop_set)
-            keys = obj.prop_set.keys()
-            values = obj.prop_set.values()
+        if isinstance(obj, AbstractConfigNode) or isinstance(obj, CompiledConfigNode):
+            item_list = get_config_node_item_list(obj)
+            length = len(item_list)
+            keys = [ item[0] for item in item_list ]
+            values = [ item[1] for item in item_list ]
+            comments = [ item[2] for item in item_list ]
 
         elif isinstance(obj, dict):
             length = len(obj)
@@ -370,14 +750,9 @@ class Dumper(object):
             # Get next value.
             value = values[i]
 
+            # Get property comment.
             comment = None
-
-            if isinstance(value, Prop):
-                # Get property comment.
-                comment = value.doc
-
-                # Get real value from property.
-                value = value.__get__(obj)
+            if comments: comment = comments[i]
 
             if key:
                 # Dictionary-like - begin tuple.
@@ -465,10 +840,10 @@ class Dumper(object):
 
 # Convert master config to regular python format.
 def convert_mc_to_python(data):
-    if isinstance(data, AbstractConfigNode):
+    if isinstance(data, AbstractConfigNode) or isinstance(data, CompiledConfigNode):
         d = odict()
-        for key, prop in data.prop_set.items():
-            d[key] = convert_mc_to_python(prop.__get__(data))
+        for key, value, doc in get_config_node_item_list(data):
+            d[key] = convert_mc_to_python(value)
         return d
     if isinstance(data, tuple):
         d = odict()
@@ -506,37 +881,110 @@ class KIniValue(object):
         self.value = value
         self.doc = doc
 
-# INI config section.
-class KIniSection(odict):
+# INI config section. The keys are kept in insertion order. Setting a key is
+# done in constant time so that large sections can be built quickly.
+class KIniSection(dict):
     def __init__(self, doc=None):
-        odict.__init__(self)
+        dict.__init__(self)
         self.doc = doc
+        self.key_list = []
+
+    def __setitem__(self, key, value):
+        if not dict.has_key(self, key): self.key_list.append(key)
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.key_list.remove(key)
+
+    def __iter__(self):
+        return iter(self.key_list)
+
+    # Remove the keys listed. The key order is rebuilt once, so that removing
+    # many keys takes linear time.
+    def remove_keys(self, key_list):
+        if not len(key_list): return
+        key_set = set(key_list)
+        for key in key_set: dict.__delitem__(self, key)
+        self.key_list = [ key for key in self.key_list if not key in key_set ]
+
+    def clear(self):
+        dict.clear(self)
+        self.key_list = []
+
+    def update(self, data=(), **kwargs):
+        if hasattr(data, 'keys'): data = [ (key, data[key]) for key in data.keys() ]
+        for key, value in data: self[key] = value
+        for key, value in kwargs.items(): self[key] = value
+
+    def setdefault(self, key, value=None):
+        if not dict.has_key(self, key): self[key] = value
+        return dict.__getitem__(self, key)
+
+    def pop(self, key, *args):
+        if dict.has_key(self, key): self.key_list.remove(key)
+        return dict.pop(self, key, *args)
+
+    def popitem(self):
+        if not len(self.key_list): raise KeyError('popitem(): dictionary is empty')
+        key = self.key_list.pop()
+        return (key, dict.pop(self, key))
+
+    def copy(self):
+        section = KIniSection(self.doc)
+        section.update(self)
+        return section
+
+    def keys(self):
+        return self.key_list[:]
+
+    def values(self):
+        return [ dict.__getitem__(self, key) for key in self.key_list ]
+
+    def items(self):
+        return [ (key, dict.__getitem__(self, key)) for key in self.key_list ]
+
+# Cache of the comments formatted by KIniFile.format_comment(), indexed by
+# comment.
+ini_comment_cache = {}
 
 # INI config file.
 class KIniFile(object):
+    # Maximum length of a comment line.
+    comment_max_length = 115
+
     def __init__(self, doc=None):
         self.doc = doc
         self.sections = odict()
 
     # Format comments so that lines longer than 115 characters are split, and
-    # insert '# ' before every line.
+    # insert '# ' before every line. The continuation lines of a split line
+    # start with '#+' instead, so that read_from_string() can join them back.
+    # The result is cached.
     # Note: Use comments that already contain \n to avoid this method cutting
     # words appropriately.
     def format_comment(self, comment):
-        max_length = 115
+        res = ini_comment_cache.get(comment)
+        if res != None: return res
+
+        max_length = self.comment_max_length
         lines = []
         arr = comment.split('\n')
         for line in arr:
-            while len(line) >= max_length:
-                lines.append(line[:max_length])
+            prefix = "# "
+            while len(line) > max_length:
+                lines.append(prefix + line[:max_length])
                 line = line[max_length:]
-            lines.append(line)
-        return ''.join(map(lambda x: "# "+x+'\n', lines))
+                prefix = "#+"
+            lines.append(prefix + line)
+        res = ''.join(map(lambda x: x+'\n', lines))
+        ini_comment_cache[comment] = res
+        return res
 
     # Add a section. 
     def add_section(self, name, section=None, doc=None):
         # Make sure section doesn't already exist.
-        if name in self.sections.keys():
+        if self.sections.has_key(name):
             raise Exception("Section '%s' already exists." % ( name ) )
 
         # Make sure section is a KIniSection object.
@@ -555,7 +1003,7 @@ class KIniFile(object):
     def set(self, sname, key, value='', doc=None):
         # Make sure the section exists.
         if not sname in self.sections:
-            raise Exception("Section '%s' does not exists." % ( name ) )
+            raise Exception("Section '%s' does not exists." % ( sname ) )
 
         # Make sure the key is a string.
         if not isinstance(key, basestring):
@@ -570,20 +1018,222 @@ class KIniFile(object):
             ini_value = KIniValue(value, doc)
             self.sections[sname][key] = ini_value
 
-    # Write to a string.
-    def write_to_string(self):
-        s = "# WARNING: THIS FILE IS AUTO-GENERATED.\n\n"
+    # Write to a stream. Only the 'write' method of the stream is used. The
+    # keys are written in chunks so that the number of writes does not grow
+    # with the number of keys.
+    def write_to_stream(self, stream, chunk_size=1024):
+        stream.write("# WARNING: THIS FILE IS AUTO-GENERATED.\n\n")
 
         # Insert the file main comment, if any.
-        if self.doc: s += self.format_comment(self.doc) + '\n\n'
+        if self.doc: stream.write(self.format_comment(self.doc) + '\n\n')
 
         for name, section in self.sections.items():
-            if section.doc: s += self.format_comment(section.doc)
-            s += '[' + name + ']\n'
+            chunk = []
+            if section.doc: chunk.append(self.format_comment(section.doc))
+            chunk.append('[' + name + ']\n')
             for key, kinivalue in section.items():
-                if kinivalue.doc: s += self.format_comment(kinivalue.doc)
-                s += str(key) + '=' + str(kinivalue.value) + '\n\n'
-            s += '\n'
+                if kinivalue.doc: chunk.append(self.format_comment(kinivalue.doc))
+                chunk.append(str(key) + '=' + str(kinivalue.value) + '\n\n')
+                if len(chunk) >= chunk_size:
+                    stream.write(''.join(chunk))
+                    chunk = []
+            chunk.append('\n')
+            stream.write(''.join(chunk))
+
+    # Parse the content of a file written by write_to_stream() and replace the
+    # content of this object with it. The comments are kept as docs.
+    def read_from_string(self, data, name="<string>"):
+        self.doc = None
+        self.sections = odict()
+        section = None
+        comment_list = []
+        line_list = data.split('\n')
+        if len(line_list) and line_list[0] == "# WARNING: THIS FILE IS AUTO-GENERATED.":
+            line_list = line_list[1:]
+
+        for i in range(len(line_list)):
+            line = line_list[i].rstrip('\r')
+
+            # Comment. A line split by format_comment() continues on the lines
+            # starting with '#+'.
+            if line.startswith('#+') and len(comment_list):
+                comment_list[-1] += line[2:]
+            elif line.startswith('#'):
+                if line.startswith('# '): comment_list.append(line[2:])
+                else: comment_list.append(line[1:])
+
+            # Blank line. A comment followed by a blank line before the first
+            # section is the file main comment.
+            elif line.strip() == '':
+                if section == None and len(comment_list):
+                    self.doc = '\n'.join(comment_list)
+                    comment_list = []
+
+            # Section.
+            elif line.startswith('[') and line.endswith(']'):
+                section = line[1:-1]
+                doc = None
+                if len(comment_list): doc = '\n'.join(comment_list)
+                self.add_section(section, doc=doc)
+                comment_list = []
+
+            # Value.
+            elif section != None and line.find('=') > 0:
+                key, value = line.split('=', 1)
+                doc = None
+                if len(comment_list): doc = '\n'.join(comment_list)
+                self.set(section, key, value, doc)
+                comment_list = []
+
+            else:
+                raise Exception("Invalid line %i in INI file '%s'." % (i + 1, name))
+
+    # Parse a file. See read_from_string().
+    def read_from_file(self, path):
+        self.read_from_string(read_file(path), path)
+
+    # Update this file so that it has the same content as the file specified.
+    # The order of the existing sections and keys is kept. The docs are kept
+    # unless the file specified provides new ones. Return the differences
+    # between the two files as a dictionary mapping the name of each section
+    # whose keys differ to a tuple (added keys, removed keys, changed keys).
+    # The docs are not compared.
+    def patch(self, other):
+        diff = {}
+        if other.doc: self.doc = other.doc
+        for name in self.sections.keys():
+            if not other.sections.has_key(name):
+                removed_list = self.sections[name].keys()
+                if len(removed_list): diff[name] = ([], removed_list, [])
+                del self.sections[name]
+
+        for name, new_section in other.sections.items():
+            if not self.sections.has_key(name):
+                self.add_section(name, doc=new_section.doc)
+            section = self.sections[name]
+            if new_section.doc: section.doc = new_section.doc
+
+            removed_list = [ key for key in section.keys() if not new_section.has_key(key) ]
+            section.remove_keys(removed_list)
+
+            added_list = []
+            changed_list = []
+            for key, new_value in new_section.items():
+                if section.has_key(key):
+                    if str(section[key].value) != str(new_value.value): changed_list.append(key)
+                    section[key].value = new_value.value
+                    if new_value.doc: section[key].doc = new_value.doc
+                else:
+                    added_list.append(key)
+                    self.set(name, key, new_value.value, new_value.doc)
+
+            if len(added_list) or len(removed_list) or len(changed_list):
+                diff[name] = (added_list, removed_list, changed_list)
+
+        return diff
+
+    # Write the content of this object to the file specified, if the content
+    # differs from the current content of the file. The existing file is read
+    # back and patched so that its comments and ordering are preserved. A
+    # missing or unparseable file is written from scratch. Return the
+    # differences between the old and the new content, as per patch().
+    def write_to_file_if_changed(self, path):
+        old_data = None
+        old_file = KIniFile()
+        if os.path.exists(path):
+            old_data = read_file(path)
+            try: old_file.read_from_string(old_data, path)
+            except Exception:
+                old_data = None
+                old_file = KIniFile()
+
+        diff = old_file.patch(self)
+        if old_data == None or not old_file.is_same_as_string(old_data): old_file.write_to_file_atom(path)
+        return diff
+
+    # Return true if the content of this object is the string specified. The
+    # content is compared chunk by chunk as it is streamed, so it is never held
+    # in memory.
+    def is_same_as_string(self, data):
+        class CompareStream:
+            def __init__(self):
+                self.pos = 0
+                self.same_flag = 1
+            def write(self, chunk):
+                if self.same_flag and not data.startswith(chunk, self.pos): self.same_flag = 0
+                self.pos += len(chunk)
+        stream = CompareStream()
+        self.write_to_stream(stream)
+        return stream.same_flag and stream.pos == len(data)
 
-        return s
+    # Write to a string.
+    def write_to_string(self):
+        l = []
+        class ListStream:
+            def write(self, data): l.append(data)
+        self.write_to_stream(ListStream())
+        return ''.join(l)
+
+    # Write to a file atomically. The content is streamed to a temporary file
+    # which then replaces the file specified.
+    def write_to_file_atom(self, path):
+        tmp_path = "%s.tmp.%i" % (path, os.getpid())
+        f = open(tmp_path, "wb")
+        try:
+            self.write_to_stream(f)
+            f.flush()
+            os.fsync(f.fileno())
+            f.close()
+            os.rename(tmp_path, path)
+        except:
+            f.close()
+            try: os.unlink(tmp_path)
+            except OSError: pass
+            raise
+
+# tbxsosd-style configuration file. The values are specified by lines of the
+# form 'key = "value";'. The other lines are preserved as-is.
+class KTbxsosdConfig(object):
+    key_re = re.compile(r'^\s*([^\s=]+)\s*=')
+
+    def __init__(self, path):
+        self.path = path
+        self.line_list = []
+        self.key_dict = {}
+        self.changed_flag = 0
+
+    # Read the file.
+    def read(self):
+        self.line_list = read_file(self.path).split("\n")
+        if len(self.line_list) and self.line_list[-1] == "": self.line_list.pop()
+        self.key_dict = {}
+        self.changed_flag = 0
+        for i in range(len(self.line_list)):
+            m = self.key_re.match(self.line_list[i])
+            if m: self.key_dict.setdefault(m.group(1), []).append(i)
+
+    # Set the value of a key. The key must match exactly. Every line of the key
+    # is changed if the key is repeated.
+    def set(self, key, val):
+        line = '%s = "%s";' % (key, val)
+        if self.key_dict.has_key(key):
+            for i in self.key_dict[key]:
+                if self.line_list[i] == line: continue
+                self.line_list[i] = line
+                self.changed_flag = 1
+        else:
+            self.key_dict[key] = [len(self.line_list)]
+            self.line_list.append(line)
+            self.changed_flag = 1
+
+    # Set the values of the keys specified as a list of (key, value) pairs.
+    def set_list(self, item_list):
+        for key, val in item_list: self.set(key, val)
+
+    # Write the file if it was changed. Return true if it was changed.
+    def write(self):
+        if not self.changed_flag: return 0
+        write_file_atom(self.path, "\n".join(self.line_list) + "\n")
+        self.changed_flag = 0
+        return 1
 
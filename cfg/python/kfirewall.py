@@ -0,0 +1,216 @@
+import os, shlex, difflib
+from kfile import read_file
+from krun import get_cmd_output
+
+# Options moved to the beginning of a rule by iptables-save, in that order.
+iptables_head_opt_list = [ "-s", "-d", "-i", "-o", "-p" ]
+
+# Return the canonical form of an iptables rule specification, as a list of
+# arguments. The canonical form is the one printed by iptables-save, so that
+# the generated rules and the live rules can be compared.
+def normalize_iptables_rule(arg_list):
+    head_dict = {}
+    tail_list = []
+    i = 0
+    while i < len(arg_list):
+        negate_list = []
+        if arg_list[i] == "!" and i + 1 < len(arg_list):
+            negate_list = ["!"]
+            i += 1
+        opt = arg_list[i]
+        if opt in iptables_head_opt_list and i + 1 < len(arg_list):
+            value = arg_list[i + 1]
+            if opt in ("-s", "-d") and value.find("/") == -1 and value.replace(".", "").isdigit():
+                value += "/32"
+            if not (opt in ("-s", "-d") and value == "0.0.0.0/0" and not negate_list):
+                head_dict[opt] = negate_list + [opt, value]
+            i += 2
+        else:
+            tail_list.extend(negate_list + [opt])
+            i += 1
+
+    # iptables-save prints the default rejection type.
+    if tail_list[-2:] == ["-j", "REJECT"]: tail_list.extend(["--reject-with", "icmp-port-unreachable"])
+
+    res = []
+    for opt in iptables_head_opt_list:
+        if head_dict.has_key(opt): res.extend(head_dict[opt])
+    return res + tail_list
+
+# Format a list of arguments for iptables-restore.
+def format_iptables_args(arg_list):
+    l = []
+    for arg in arg_list:
+        if arg == "" or arg.find(" ") != -1: arg = '"%s"' % (arg.replace('"', '\\"'))
+        l.append(arg)
+    return " ".join(l)
+
+# Represent the filter table of an iptables ruleset.
+class IptablesRuleset(object):
+    def __init__(self):
+        # Chain names, in order.
+        self.chain_list = []
+
+        # Dictionary mapping chain names to their policy. The policy is '-' for
+        # user-defined chains.
+        self.policy_dict = {}
+
+        # Dictionary mapping chain names to their list of normalized rules. A
+        # rule is a string.
+        self.rule_dict = {}
+
+    # Add a chain if it does not exist.
+    def add_chain(self, name, policy="-"):
+        if not self.policy_dict.has_key(name):
+            self.chain_list.append(name)
+            self.rule_dict[name] = []
+        self.policy_dict[name] = policy
+
+    # Parse the filter table in the output of iptables-save or in an
+    # iptables-restore file. The other tables are ignored.
+    def parse(self, data):
+        table = None
+        for line in data.split("\n"):
+            line = line.strip()
+            if line == "" or line.startswith("#"): continue
+            if line.startswith("*"): table = line[1:]
+            elif table != "filter": continue
+            elif line == "COMMIT": table = None
+            elif line.startswith(":"):
+                arr = line[1:].split()
+                if len(arr) < 2: raise Exception("Invalid chain line '%s'." % (line))
+                self.add_chain(arr[0], arr[1])
+            else:
+                arg_list = shlex.split(line)
+                if len(arg_list) < 2 or arg_list[0] != "-A":
+                    raise Exception("Invalid rule line '%s'." % (line))
+                chain = arg_list[1]
+                if not self.rule_dict.has_key(chain):
+                    raise Exception("Rule line '%s' references an undeclared chain." % (line))
+                self.rule_dict[chain].append(format_iptables_args(normalize_iptables_rule(arg_list[2:])))
+
+    # Return the iptables-restore --noflush input that transforms this ruleset
+    # into the ruleset specified, or None if they are the same. Only the chains
+    # of the ruleset specified are considered. Within a chain the rules that
+    # did not change are left in place, so the established state and the
+    # counters are preserved.
+    def get_delta(self, desired):
+        line_list = []
+        for chain in desired.chain_list:
+            policy = desired.policy_dict[chain]
+            if not self.policy_dict.has_key(chain) or self.policy_dict[chain] != policy:
+                line_list.append(":%s %s" % (chain, policy))
+
+        for chain in desired.chain_list:
+            old_list = self.rule_dict.get(chain, [])
+            new_list = desired.rule_dict[chain]
+            opcode_list = difflib.SequenceMatcher(None, old_list, new_list).get_opcodes()
+
+            # Apply the changes from the end of the chain so that the rule
+            # numbers of the earlier changes stay valid.
+            opcode_list.reverse()
+            for tag, i1, i2, j1, j2 in opcode_list:
+                if tag == "equal": continue
+                for i in range(i2, i1, -1): line_list.append("-D %s %i" % (chain, i))
+                for j in range(j1, j2):
+                    line_list.append("-I %s %i %s" % (chain, i1 + 1 + j - j1, new_list[j]))
+
+        if not len(line_list): return None
+        return "*filter\n" + "\n".join(line_list) + "\nCOMMIT\n"
+
+    # Apply iptables-restore --noflush input to this ruleset. This mirrors what
+    # iptables-restore does for the commands produced by get_delta().
+    def apply_delta(self, data):
+        for line in data.split("\n"):
+            line = line.strip()
+            if line == "" or line.startswith("*") or line == "COMMIT": continue
+            if line.startswith(":"):
+                arr = line[1:].split()
+                self.add_chain(arr[0], arr[1])
+                continue
+            arg_list = shlex.split(line)
+            cmd, chain, pos = arg_list[0], arg_list[1], int(arg_list[2]) - 1
+            if cmd == "-D": del self.rule_dict[chain][pos]
+            elif cmd == "-I": self.rule_dict[chain].insert(pos, format_iptables_args(arg_list[3:]))
+            else: raise Exception("Unsupported command '%s'." % (line))
+
+# This class reconciles the live firewall with the generated rules files. Only
+# the rules that changed are deleted or inserted, in a single iptables-restore
+# transaction that does not flush the tables.
+class FirewallReconciler(object):
+    def __init__(self, rules_path="/etc/teambox/base/iptables.rules",
+                 ipset_path="/etc/teambox/base/ipset.sh"):
+        self.rules_path = rules_path
+        self.ipset_path = ipset_path
+
+    # Return the output of iptables-save for the filter table.
+    def get_live_rules(self):
+        return get_cmd_output(["iptables-save", "-t", "filter"])
+
+    # Apply iptables-restore --noflush input.
+    def apply_delta(self, delta):
+        get_cmd_output(["iptables-restore", "--noflush"], input_str=delta)
+
+    # Load the ipset sets by running the loading script. This is atomic per
+    # set.
+    def load_ipset_rules(self):
+        if os.path.isfile(self.ipset_path): get_cmd_output(["sh", "-e", self.ipset_path])
+
+    # Return the content of the generated rules file.
+    def get_desired_rules(self):
+        return read_file(self.rules_path)
+
+    # Return the delta to apply to the live firewall, or None. The delta is
+    # first applied to the live ruleset in memory, and an exception is raised
+    # if it does not produce the generated rules.
+    def get_delta(self):
+        live = IptablesRuleset()
+        live.parse(self.get_live_rules())
+        desired = IptablesRuleset()
+        desired.parse(self.get_desired_rules())
+        delta = live.get_delta(desired)
+        if delta != None:
+            live.apply_delta(delta)
+            if live.get_delta(desired) != None:
+                raise Exception("The firewall delta does not produce the generated rules.")
+        return delta
+
+    # Bring the live firewall in line with the rules files. Return true if the
+    # rules were changed.
+    def reconcile(self):
+        self.load_ipset_rules()
+        delta = self.get_delta()
+        if delta == None: return 0
+        self.apply_delta(delta)
+        return 1
+
+# Stand-in for the live firewall, used to exercise the reconciler without
+# touching the system. The live ruleset and the generated rules are kept in
+# memory. See the check-firewall target of the Makefile.
+class FirewallReconcilerStandIn(FirewallReconciler):
+    def __init__(self, live_rules="", desired_rules=""):
+        FirewallReconciler.__init__(self)
+        self.live = IptablesRuleset()
+        self.live.parse(live_rules)
+        self.desired_rules = desired_rules
+        self.delta_list = []
+
+    def get_desired_rules(self):
+        return self.desired_rules
+
+    def get_live_rules(self):
+        l = [ "*filter" ]
+        for chain in self.live.chain_list:
+            l.append(":%s %s [0:0]" % (chain, self.live.policy_dict[chain]))
+        for chain in self.live.chain_list:
+            for rule in self.live.rule_dict[chain]: l.append("-A %s %s" % (chain, rule))
+        l.append("COMMIT")
+        return "\n".join(l) + "\n"
+
+    def apply_delta(self, delta):
+        self.delta_list.append(delta)
+        self.live.apply_delta(delta)
+
+    def load_ipset_rules(self):
+        pass
+
@@ -0,0 +1,311 @@
+import os, socket, struct, fcntl
+
+# Names of the TCP states, indexed by the state number used in /proc/net/tcp.
+tcp_state_name_list = [ "", "ESTABLISHED", "SYN_SENT", "SYN_RECV", "FIN_WAIT1", "FIN_WAIT2",
+                        "TIME_WAIT", "CLOSE", "CLOSE_WAIT", "LAST_ACK", "LISTEN", "CLOSING" ]
+
+# TCP state number of the listening sockets.
+TCP_LISTEN = 10
+
+# Interface ioctls, from <linux/sockios.h>.
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFBRDADDR = 0x8919
+SIOCGIFNETMASK = 0x891b
+SIOCGIFMTU = 0x8921
+SIOCGIFHWADDR = 0x8927
+
+# Interface flags, from <net/if.h>, in the order printed by ifconfig.
+iface_flag_list = [ (0x1, "UP"), (0x2, "BROADCAST"), (0x8, "LOOPBACK"), (0x10, "POINTOPOINT"),
+                    (0x40, "RUNNING"), (0x100, "PROMISC"), (0x1000, "MULTICAST") ]
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+
+# Hardware types, from <linux/if_arp.h>.
+iface_encap_dict = { 1 : "Ethernet", 772 : "Local Loopback", 65534 : "UNSPEC" }
+
+# Convert an address as printed in /proc/net/tcp or /proc/net/tcp6 to a string.
+# The address is made of 32 bits words in host byte order.
+def parse_proc_net_addr(s):
+    if len(s) == 8:
+        return socket.inet_ntop(socket.AF_INET, struct.pack("=I", int(s, 16)))
+    packed = "".join([ struct.pack("=I", int(s[i:i+8], 16)) for i in range(0, 32, 8) ])
+
+    # Show IPv4-mapped addresses in their IPv4 form.
+    if packed[:12] == "\0" * 10 + "\xff\xff": return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+# Format an address/port pair like netstat(8).
+def format_addr_port(addr, port):
+    return "%s:%i" % (addr, port)
+
+# Represent a TCP socket read from /proc/net/tcp or /proc/net/tcp6.
+class TcpSocket(object):
+    __slots__ = ("local_addr", "local_port", "remote_addr", "remote_port", "state", "tx_queue",
+                 "rx_queue", "uid", "inode")
+
+    def get_state_name(self):
+        if self.state < len(tcp_state_name_list): return tcp_state_name_list[self.state]
+        return str(self.state)
+
+# Yield the TCP sockets listed in the files specified, one at a time. The files
+# that do not exist, e.g. when IPv6 is disabled, are skipped. If state is
+# specified, only the sockets in that state are decoded.
+def iter_tcp_sockets(path_list=("/proc/net/tcp", "/proc/net/tcp6"), state=None):
+    if state != None: state_hex = "%02X" % (state)
+    for path in path_list:
+        try: f = open(path)
+        except IOError: continue
+        try:
+            f.readline()
+            for line in f:
+                fields = line.split()
+                if len(fields) < 10: continue
+                if state != None and fields[3] != state_hex: continue
+                sock = TcpSocket()
+                addr, port = fields[1].split(":")
+                sock.local_addr, sock.local_port = parse_proc_net_addr(addr), int(port, 16)
+                addr, port = fields[2].split(":")
+                sock.remote_addr, sock.remote_port = parse_proc_net_addr(addr), int(port, 16)
+                sock.state = int(fields[3], 16)
+                tx_queue, rx_queue = fields[4].split(":")
+                sock.tx_queue, sock.rx_queue = int(tx_queue, 16), int(rx_queue, 16)
+                sock.uid = int(fields[7])
+                sock.inode = int(fields[9])
+                yield sock
+        finally:
+            f.close()
+
+# TCP connection statistics aggregated by local port, see get_tcp_conn_stats().
+class TcpConnStats(object):
+    def __init__(self):
+        # Dictionary mapping the listening ports to (accept queue length,
+        # backlog) tuples. The values of the IPv4 and IPv6 sockets are added.
+        self.listen_dict = {}
+
+        # Dictionary mapping the listening ports to dictionaries mapping TCP
+        # state numbers to socket counts. The other sockets, e.g. outgoing
+        # connections, are counted under the None port.
+        self.port_state_dict = {}
+
+        # Dictionary mapping the remote addresses of the connections to the
+        # listening ports to their number of sockets.
+        self.peer_dict = {}
+
+        # Dictionary mapping TCP state numbers to socket counts.
+        self.state_dict = {}
+
+    # Return the number of sockets of the port and state specified.
+    def get_count(self, port, state):
+        return self.port_state_dict.get(port, {}).get(state, 0)
+
+    # Return the list of the (count, address) tuples of the remote addresses
+    # having the most sockets, largest first.
+    def get_top_peer_list(self, count):
+        l = [ (n, addr) for addr, n in self.peer_dict.items() ]
+        l.sort()
+        l.reverse()
+        return l[:count]
+
+# Return the TCP connection statistics, as a TcpConnStats object. The files are
+# streamed and only the fields needed are looked at on each line. The addresses
+# and ports are decoded once per distinct value, so the cost stays low with a
+# large number of sockets.
+def get_tcp_conn_stats(path_list=("/proc/net/tcp", "/proc/net/tcp6")):
+    listen_dict = {}
+    port_state_count_dict = {}
+    port_peer_count_dict = {}
+    for path in path_list:
+        try: f = open(path)
+        except IOError: continue
+        try:
+            f.readline()
+            for line in f:
+                fields = line.split(None, 5)
+                local, remote, state = fields[1], fields[2], fields[3]
+                port = local[-4:]
+                if state == "0A":
+                    tx_queue, rx_queue = fields[4].split(":")
+                    queue, backlog = listen_dict.get(port, (0, 0))
+                    listen_dict[port] = (queue + int(rx_queue, 16), backlog + int(tx_queue, 16))
+                key = (port, state)
+                port_state_count_dict[key] = port_state_count_dict.get(key, 0) + 1
+                if state != "0A":
+                    key = (port, remote[:-5])
+                    port_peer_count_dict[key] = port_peer_count_dict.get(key, 0) + 1
+        finally:
+            f.close()
+
+    stats = TcpConnStats()
+    for port, value in listen_dict.items(): stats.listen_dict[int(port, 16)] = value
+    for (port, state), n in port_state_count_dict.items():
+        state = int(state, 16)
+        port = int(port, 16)
+        stats.state_dict[state] = stats.state_dict.get(state, 0) + n
+        if not stats.listen_dict.has_key(port): port = None
+        d = stats.port_state_dict.setdefault(port, {})
+        d[state] = d.get(state, 0) + n
+    for (port, addr), n in port_peer_count_dict.items():
+        if not stats.listen_dict.has_key(int(port, 16)): continue
+        addr = parse_proc_net_addr(addr)
+        stats.peer_dict[addr] = stats.peer_dict.get(addr, 0) + n
+    return stats
+
+# Return a dictionary containing the TCP counters of the 'Tcp' section of
+# /proc/net/snmp and of the 'TcpExt' section of /proc/net/netstat, e.g.
+# 'PassiveOpens' or 'ListenOverflows'.
+def read_tcp_counters(path_list=("/proc/net/snmp", "/proc/net/netstat")):
+    res = {}
+    for path in path_list:
+        try: f = open(path)
+        except IOError: continue
+        try: line_list = f.readlines()
+        finally: f.close()
+        for i in range(0, len(line_list) - 1, 2):
+            name_list = line_list[i].split()
+            value_list = line_list[i + 1].split()
+            if not name_list[0] in ("Tcp:", "TcpExt:") or name_list[0] != value_list[0]: continue
+            for j in range(1, min(len(name_list), len(value_list))):
+                res[name_list[j]] = long(value_list[j])
+    return res
+
+# Return a dictionary mapping socket inodes to (pid, process name) tuples, by
+# scanning the file descriptors of all processes once. If inode_set is
+# specified, only these inodes are reported. The processes that cannot be
+# inspected are skipped.
+def get_socket_pid_dict(inode_set=None):
+    res = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit(): continue
+        fd_dir = "/proc/%s/fd" % (pid)
+        try: fd_list = os.listdir(fd_dir)
+        except OSError: continue
+        name = None
+        for fd in fd_list:
+            try: target = os.readlink(fd_dir + "/" + fd)
+            except OSError: continue
+            if not target.startswith("socket:["): continue
+            inode = int(target[8:-1])
+            if inode_set != None and not inode in inode_set: continue
+            if name == None: name = get_process_name(pid)
+            res[inode] = (int(pid), name)
+    return res
+
+# Return the name of the process specified, as found in /proc/<pid>/stat.
+def get_process_name(pid):
+    try:
+        f = open("/proc/%s/stat" % (pid))
+        try: data = f.read()
+        finally: f.close()
+        return data[data.index("(") + 1:data.rindex(")")]
+    except (IOError, ValueError):
+        return "?"
+
+# Return the list of the network interfaces and their counters from
+# /proc/net/dev, as (name, counter dictionary) tuples. The counters are
+# rx_bytes, rx_packets, rx_errors, rx_dropped, tx_bytes, tx_packets, tx_errors
+# and tx_dropped.
+def read_iface_stats(path="/proc/net/dev"):
+    res = []
+    f = open(path)
+    try: line_list = f.readlines()[2:]
+    finally: f.close()
+    for line in line_list:
+        name, data = line.split(":", 1)
+        fields = data.split()
+        res.append((name.strip(), { "rx_bytes" : long(fields[0]), "rx_packets" : long(fields[1]),
+                                    "rx_errors" : long(fields[2]), "rx_dropped" : long(fields[3]),
+                                    "tx_bytes" : long(fields[8]), "tx_packets" : long(fields[9]),
+                                    "tx_errors" : long(fields[10]), "tx_dropped" : long(fields[11]) }))
+    return res
+
+# Perform an interface ioctl and return the result buffer, or None if the
+# ioctl failed, e.g. when the interface has no address.
+def iface_ioctl(sock, req, name):
+    try: return fcntl.ioctl(sock.fileno(), req, struct.pack("256s", name[:15]))
+    except IOError: return None
+
+# Return a dictionary describing the interface specified: flags, mtu, encap,
+# hwaddr, and the IPv4 addr, broadcast and netmask. The addresses are empty
+# strings if they are not set.
+def get_iface_info(name):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        info = { "name" : name, "flags" : 0, "mtu" : 0, "encap" : "UNSPEC", "hwaddr" : "",
+                 "addr" : "", "broadcast" : "", "netmask" : "" }
+        buf = iface_ioctl(sock, SIOCGIFFLAGS, name)
+        if buf: info["flags"] = struct.unpack("H", buf[16:18])[0]
+        buf = iface_ioctl(sock, SIOCGIFMTU, name)
+        if buf: info["mtu"] = struct.unpack("i", buf[16:20])[0]
+        buf = iface_ioctl(sock, SIOCGIFHWADDR, name)
+        if buf:
+            family = struct.unpack("H", buf[16:18])[0]
+            info["encap"] = iface_encap_dict.get(family, str(family))
+            if family == 1: info["hwaddr"] = ":".join([ "%02x" % ord(c) for c in buf[18:24] ])
+        for key, req in (("addr", SIOCGIFADDR), ("broadcast", SIOCGIFBRDADDR),
+                         ("netmask", SIOCGIFNETMASK)):
+            buf = iface_ioctl(sock, req, name)
+            if buf: info[key] = socket.inet_ntoa(buf[20:24])
+        return info
+    finally:
+        sock.close()
+
+# Return true if the network interface specified exists and has a link.
+def get_iface_link_flag(name):
+    try:
+        f = open("/sys/class/net/%s/carrier" % (name))
+        try: return f.read().strip() == "1"
+        finally: f.close()
+    except IOError:
+        return 0
+
+# This class provides the network information, cached. Create a new instance
+# to get fresh information.
+class NetInfo(object):
+    def __init__(self):
+        self.cache = {}
+
+    def _get(self, key, func, *args):
+        if not self.cache.has_key(key): self.cache[key] = func(*args)
+        return self.cache[key]
+
+    # Return the list of the listening TCP sockets.
+    def get_listen_socket_list(self):
+        return self._get("listen", lambda: list(iter_tcp_sockets(state=TCP_LISTEN)))
+
+    # Return a dictionary mapping the inodes of the listening sockets to (pid,
+    # process name) tuples.
+    def get_listen_pid_dict(self):
+        def func():
+            inode_set = set([ sock.inode for sock in self.get_listen_socket_list() ])
+            return get_socket_pid_dict(inode_set)
+        return self._get("listen_pid", func)
+
+    # Return the interface statistics, see read_iface_stats().
+    def get_iface_stats(self):
+        return self._get("stats", read_iface_stats)
+
+    # Return the list of the interface names.
+    def get_iface_name_list(self):
+        return [ name for name, stats in self.get_iface_stats() ]
+
+    # Return the interface information, see get_iface_info().
+    def get_iface_info(self, name):
+        return self._get("iface " + name, get_iface_info, name)
+
+    # Return the IPv4 address of the server: the address of eth0 if it has one,
+    # otherwise the address of the first interface that is up and is not a
+    # loopback interface. Return an empty string if there is none.
+    def get_server_address(self):
+        def func():
+            name_list = self.get_iface_name_list()
+            if "eth0" in name_list:
+                name_list.remove("eth0")
+                name_list.insert(0, "eth0")
+            for name in name_list:
+                info = self.get_iface_info(name)
+                if info["addr"] and info["flags"] & IFF_UP and not info["flags"] & IFF_LOOPBACK:
+                    return info["addr"]
+            return ""
+        return self._get("server_addr", func)
+
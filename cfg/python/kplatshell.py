@@ -1,9 +1,277 @@
 #!/usr/bin/env python
 
-import getpass, getopt, syslog
-from kprompt import *
+import sys, os, getopt, time
+
+# Path to the issue file and to the file containing the fingerprints of the
+# inputs used to render it.
+issue_path = "/etc/issue"
+issue_key_path = "/var/cache/teambox/issue.key"
+
+# Maximum age of the rendered issue file, in seconds. The file is rendered
+# again past that delay even if no input has changed, to catch the changes the
+# fingerprints cannot see cheaply.
+issue_max_age = 300
+
+# Paths whose state is part of the quick key of the issue file. The
+# directories change when a pid file, a lock file or an init script link is
+# created or removed.
+issue_watch_path_list = [ "/etc/teambox/base/master.cfg", "/etc/teambox/product_version", "/etc/rc2.d",
+                          "/var/run", "/var/run/postgresql", "/var/lock", "/var/lock/kcd.lock",
+                          "/var/lock/kcdnotif.lock" ]
+
+# Return the quick key of the inputs of the issue file: the state of the
+# watched paths, the liveness of the processes of the pid files, the server
+# address and a time bucket. It only needs stat() calls and ioctls, so that it
+# can be checked before the configuration is loaded. The full fingerprint is
+# computed only when the quick key changed.
+def get_issue_quick_key():
+    import hashlib
+    from knetinfo import NetInfo
+    
+    key_list = []
+    for path in issue_watch_path_list:
+        try:
+            st = os.stat(path)
+            key_list.append((st.st_ino, st.st_size, st.st_mtime))
+        except OSError: key_list.append(None)
+    for dir_path in ("/var/run", "/var/run/postgresql"):
+        try: name_list = sorted(os.listdir(dir_path))
+        except OSError: continue
+        for name in name_list:
+            if not name.endswith(".pid"): continue
+            try: pid = open(os.path.join(dir_path, name)).read().strip()
+            except IOError: continue
+            key_list.append((name, pid.isdigit() and os.path.isdir("/proc/" + pid)))
+    key_list.append(NetInfo().get_server_address())
+    key_list.append(int(time.time() / issue_max_age))
+    return hashlib.md5(repr(key_list)).hexdigest()
+
+# Return true if the issue file exists and its quick key has not changed.
+def is_issue_fresh():
+    try: key_list = open(issue_key_path).read().split()
+    except IOError: return 0
+    return os.path.isfile(issue_path) and len(key_list) == 2 and key_list[1] == get_issue_quick_key()
+
 from kasmodel import *
 
+# Global help string.
+global_help_str = (
+    "Teambox platform shell.\n"
+    "\n"
+    "Commands:\n"
+    "  help               Show help about a command.\n"
+    "  info               Show the configuration summary.\n"
+    "  health             Show the server health status.\n"
+    "  ifconfig           Show the status of the network interfaces.\n"
+    "  netstat            Show the addresses and ports being listened to.\n"
+    "  conns              Show the TCP connection statistics per port.\n"
+    "  services           Show the status of the services.\n"
+    "  setup              Change the basic configuration.\n"
+    "  production         Switch to production mode.\n"
+    "  maintenance        Switch to maintenance mode.\n"
+    "  update             Update the machine.\n"
+    "  enable             Enable the specified service.\n"
+    "  disable            Disable the specified service.\n"
+    "  start              Start the specified services.\n"
+    "  stop               Stop the specified services.\n"
+    "  set-host           Set the fully qualifed host name.\n"
+    "  set-root-pwd       Set the UNIX root account password.\n"
+    "  set-admin-pwd      Set the administration password.\n"
+    "  write-service-cfg  Update the service configuration.\n"
+    "  write-network-cfg  Update the network configuration.\n"
+    "  write-issue        Update the content of /etc/issue.\n"
+    "  restart-services   Restart the Teambox services.\n"
+    "  restart-network    Restart the network interfaces.\n"
+    "  tune               Update the kernel tuning.\n"
+    "  batch              Run several commands in a single pass.\n"
+    "  locks              Show the processes holding the configuration lock.\n"
+    "\n"
+    "Global options:\n"
+    "  -h, --help [cmd]     Print help and exit.\n"
+    "  -s, --syslog         Log output to syslog.\n"
+    "  -e, --echo           Echo the name of every command run.\n"
+    "  -w, --wait <secs>    Maximum time to wait for the configuration lock.\n")
+
+# Dictionary mapping the command names to their help string.
+cmd_help_dict = {
+    "help" :
+        "help [command]\n"
+        "\n"
+        "Show help about a command, or list the commands supported.\n",
+
+    "info" :
+        "info\n"
+        "\n"
+        "Show the configuration summary, including the server health and the enabled\n"
+        "user services.\n",
+
+    "health" :
+        "health\n"
+        "\n"
+        "Show the server health status. The first error detected is displayed.\n",
+
+    "ifconfig" :
+        "ifconfig\n"
+        "\n"
+        "Display the status of the network interfaces, like 'ifconfig -a'.\n",
+
+    "netstat" :
+        "netstat\n"
+        "\n"
+        "Display the TCP addresses and ports being listened to and the processes\n"
+        "listening to them, like 'netstat -nltp'.\n",
+
+    "conns" :
+        "conns [-n,--top <count>] [-i,--interval <secs> [-c,--count <count>]]\n"
+        "\n"
+        "Show the number of TCP sockets in the ESTABLISHED, SYN_RECV, TIME_WAIT and\n"
+        "CLOSE_WAIT states for each port listened to, with the service listening to it\n"
+        "and the length and maximum length of its accept queue. The other sockets are\n"
+        "counted on the 'other' line. The remote addresses with the most connections\n"
+        "to the ports listened to are also shown, 10 by default. If --interval is\n"
+        "specified, the statistics are shown every <secs> seconds, 1 time by default,\n"
+        "along with the rate of connections accepted, opened, failed and reset, the\n"
+        "rate of retransmitted segments and the rate of accept queue overflows.\n",
+
+    "services" :
+        "services\n"
+        "\n"
+        "Show the status of all services.\n",
+
+    "setup" :
+        "setup\n"
+        "\n"
+        "Run the wizard to change the basic configuration of the machine.\n",
+
+    "production" :
+        "production\n"
+        "\n"
+        "Switch to production mode. All enabled services are started and remote database\n"
+        "access to the machine is allowed.\n",
+
+    "maintenance" :
+        "maintenance\n"
+        "\n"
+        "Switch to maintenance mode. All non-essential services are stopped and remote\n"
+        "database access to the machine is disabled.\n",
+
+    "update" :
+        "update\n"
+        "\n"
+        "Update the software of the machine. The machine is put in maintenance mode.\n"
+        "It must be put back in production mode manually once all the machines in the\n"
+        "server pool have been updated.\n",
+
+    "enable" :
+        "enable [-f,--force] <service>\n"
+        "\n"
+        "Mark the service specified as enabled. Nothing is done if the service is not\n"
+        "present or cannot be enabled. No attempt is made to start the service. If\n"
+        " --force is specified, the service is enabled even if it seems to be already\n"
+        "enabled.\n",
+
+    "disable" :
+        "disable [-f,--force] <service>\n"
+        "\n"
+        "Mark the service specified as disabled. Nothing is done if the service is not\n"
+        "present or cannot be disabled. No attempt is made to stop the service. If\n"
+        " --force is specified, the service is disabled even if it seems to be already\n"
+        "disabled.\n",
+
+    "start" :
+        "start [-f,--force] [service1, service2, ...]\n"
+        "\n"
+        "Start the services specified. If no service is specified, all configured\n"
+        "services are started. If --force is specified, the start-up scripts are invoked\n"
+        "even if the services seem to be running.\n",
+
+    "stop" :
+        "stop [-f,--force] [service1, service2, ...]\n"
+        "\n"
+        "Stop the services specified. If no service is specified, all services are\n"
+        "stopped. If --force is specified, the start-up scripts are invoked even if the\n"
+        "services seem to be stopped.\n",
+
+    "set-host" :
+        "set-host <name>\n"
+        "\n"
+        "Set the fully qualified host name.\n",
+
+    "set-root-pwd" :
+        "set-root-pwd <password>\n"
+        "\n"
+        "Set the UNIX root account password.\n",
+
+    "set-admin-pwd" :
+        "set-admin-pwd <password>\n"
+        "\n"
+        "Set the administration password used by the Teambox services. Postgres must\n"
+        "be running for that command to succeed.\n",
+
+    "write-service-cfg" :
+        "write-service-config\n"
+        "\n"
+        "Update the configuration files of the Teambox services. The services are\n"
+        "not restarted. The configuration is normalized prior to being written.\n",
+
+    "write-network-cfg" :
+        "write-network-cfg\n"
+        "\n"
+        "Update the network configurition files. The network interfaces are not\n"
+        "restarted.\n",
+
+    "write-issue" :
+        "write-issue [-f,--force]\n"
+        "\n"
+        "Update the '/etc/issue' file with the configuration information. The file is\n"
+        "rendered again only if the configuration, the services or the address of the\n"
+        "machine have changed, unless --force is specified.\n",
+
+    "restart-services" :
+        "restart-services\n"
+        "\n"
+        "Stop all non-essential or disabled services then start all enabled services. The\n"
+        "service configuration files are updated.\n",
+
+    "restart-network" :
+        "restart-network\n"
+        "\n"
+        "Reload the hostname and the firewall rules, and restart the network interfaces.\n"
+        "The network configuration files are updated.\n",
+
+    "tune" :
+        "tune [-s,--show]\n"
+        "\n"
+        "Generate the kernel tuning of the host from the Postgres settings, the network\n"
+        "interfaces and the amount of memory: shared memory and semaphore limits,\n"
+        "accept queue lengths, local port range and open files limits. The kernel\n"
+        "settings are written to /etc/sysctl.d/60-teambox.conf and applied. The open\n"
+        "files limits of Apache, TBXSOSD and KCD are set with 'ulimit -n' in the files\n"
+        "sourced by their init scripts (/etc/apache2/envvars, /etc/default/<service>)\n"
+        "and apply when these services are next started. Postgres adjusts its open\n"
+        "files to its own limit. If --show is specified, the settings are displayed and\n"
+        "nothing is changed.\n",
+
+    "batch" :
+        "batch [-k,--keep-going] [-r,--results <file>] [file]\n"
+        "\n"
+        "Run the commands listed in the file specified, or read from the standard input\n"
+        "if no file is specified, one command per line. Empty lines and lines starting\n"
+        "with '#' are ignored. The configuration is loaded once for all commands, and\n"
+        "the configuration files, the network and the services are updated once after\n"
+        "the last command. The batch stops at the first failed command and none of the\n"
+        "changes are applied, unless --keep-going is specified, in which case the\n"
+        "changes of the commands that succeeded are applied. If --results is specified,\n"
+        "the result of every command is written to the file specified ('-' for the\n"
+        "standard output) as one JSON object per line.\n",
+
+    "locks" :
+        "locks\n"
+        "\n"
+        "Show the processes holding the configuration lock. Read-only commands share the\n"
+        "lock, the other commands hold it exclusively.\n",
+}
+
 # Platform shell class.
 class PlatShell:
     def __init__(self):
@@ -14,6 +282,9 @@ class PlatShell:
         # Instance of the root configuration node.
         self.config = RootConfigNode()
         
+        # Network information of the current command, see get_net_info().
+        self.net_info = None
+        
         # Standard output stream. Only the 'write' method is supported.
         self.stdout = sys.stdout
         
@@ -23,209 +294,91 @@ class PlatShell:
         # True if the commands run must be echo'ed.
         self.echo_cmd_flag = 0
         
+        # True if the commands are run by the 'batch' command. The master
+        # configuration is then loaded once for all commands.
+        self.batch_flag = 0
+        
         # Trapped exception list.
         self.trapped_exception_list = (KeyboardInterrupt, EOFError, SystemExit, Exception)
         
-        # Help strings.
-        self.global_help_str = \
-            "Teambox platform shell.\n" +\
-            "\n" +\
-            "Commands:\n" +\
-            "  help               Show help about a command.\n" +\
-            "  info               Show the configuration summary.\n" +\
-            "  health             Show the server health status.\n" +\
-            "  ifconfig           Show the status of the network interfaces.\n" +\
-            "  netstat            Show the addresses and ports being listened to.\n" +\
-            "  services           Show the status of the services.\n" +\
-            "  setup              Change the basic configuration.\n" +\
-            "  production         Switch to production mode.\n" +\
-            "  maintenance        Switch to maintenance mode.\n" +\
-            "  update             Update the machine.\n" +\
-            "  enable             Enable the specified service.\n" +\
-            "  disable            Disable the specified service.\n" +\
-            "  start              Start the specified services.\n" +\
-            "  stop               Stop the specified services.\n" +\
-            "  set-host           Set the fully qualifed host name.\n" +\
-            "  set-root-pwd       Set the UNIX root account password.\n" +\
-            "  set-admin-pwd      Set the administration password.\n" +\
-            "  write-service-cfg  Update the service configuration.\n" +\
-            "  write-network-cfg  Update the network configuration.\n" +\
-            "  write-issue        Update the content of /etc/issue.\n" +\
-            "  restart-services   Restart the Teambox services.\n" +\
-            "  restart-network    Restart the network interfaces.\n" +\
-            "\n" +\
-            "Global options:\n" +\
-            "  -h, --help [cmd]     Print help and exit.\n" +\
-            "  -s, --syslog         Log output to syslog.\n" +\
-            "  -e, --echo           Echo the name of every command run.\n"
-
-        self.help_help_str = \
-            "help [command]\n" +\
-            "\n" +\
-            "Show help about a command, or list the commands supported.\n"
-
-        self.info_help_str = \
-            "info\n" +\
-            "\n" +\
-            "Show the configuration summary, including the server health and the enabled\n" +\
-            "user services.\n"
-        
-        self.health_help_str = \
-            "health\n" +\
-            "\n" +\
-            "Show the server health status. The first error detected is displayed.\n"
-         
-        self.ifconfig_help_str = \
-            "ifconfig\n" +\
-            "\n" +\
-            "Display the stripped output of 'ifconfig -a'.\n"
-
-        self.netstat_help_str = \
-            "netstat\n" +\
-            "\n" +\
-            "Display the stripped output of 'netstat -nltp'.\n"
-            
-        self.services_help_str = \
-            "services\n" +\
-            "\n" +\
-            "Show the status of all services.\n"
-        
-        self.setup_help_str = \
-            "setup\n" +\
-            "\n" +\
-            "Run the wizard to change the basic configuration of the machine.\n"
-        
-        self.production_help_str = \
-            "production\n" +\
-            "\n" +\
-            "Switch to production mode. All enabled services are started and remote database\n" +\
-            "access to the machine is allowed.\n"
-
-        self.maintenance_help_str = \
-            "maintenance\n" +\
-            "\n" +\
-            "Switch to maintenance mode. All non-essential services are stopped and remote\n" +\
-            "database access to the machine is disabled.\n"
-        
-        self.update_help_str = \
-            "update\n" +\
-            "\n" +\
-            "Update the software of the machine. The machine is put in maintenance mode.\n" +\
-            "It must be put back in production mode manually once all the machines in the\n" +\
-            "server pool have been updated.\n"
-        
-        self.enable_help_str = \
-            "enable [-f,--force] <service>\n" +\
-            "\n" +\
-            "Mark the service specified as enabled. Nothing is done if the service is not\n" +\
-            "present or cannot be enabled. No attempt is made to start the service. If\n" +\
-            " --force is specified, the service is enabled even if it seems to be already\n" +\
-            "enabled.\n"
-
-        self.disable_help_str = \
-            "disable [-f,--force] <service>\n" +\
-            "\n" +\
-            "Mark the service specified as disabled. Nothing is done if the service is not\n" +\
-            "present or cannot be disabled. No attempt is made to stop the service. If\n" +\
-            " --force is specified, the service is disabled even if it seems to be already\n" +\
-            "disabled.\n"
-
-        self.start_help_str = \
-            "start [-f,--force] [service1, service2, ...]\n" +\
-            "\n" +\
-            "Start the services specified. If no service is specified, all configured\n" +\
-            "services are started. If --force is specified, the start-up scripts are invoked\n" +\
-            "even if the services seem to be running.\n"
-
-        self.stop_help_str = \
-            "stop [-f,--force] [service1, service2, ...]\n" +\
-            "\n" +\
-            "Stop the services specified. If no service is specified, all services are\n" +\
-            "stopped. If --force is specified, the start-up scripts are invoked even if the\n" +\
-            "services seem to be stopped.\n"
-
-        self.set_host_help_str = \
-            "set-host <name>\n" +\
-            "\n" +\
-            "Set the fully qualified host name.\n"
-
-        self.set_root_pwd_help_str = \
-            "set-root-pwd <password>\n" +\
-            "\n" +\
-            "Set the UNIX root account password.\n"
-        
-        self.set_admin_pwd_help_str = \
-            "set-admin-pwd <password>\n" +\
-            "\n" +\
-            "Set the administration password used by the Teambox services. Postgres must\n" +\
-            "be running for that command to succeed.\n"
-        
-        self.write_service_cfg_help_str = \
-            "write-service-config\n" +\
-            "\n" +\
-            "Update the configuration files of the Teambox services. The services are\n" +\
-            "not restarted. The configuration is normalized prior to being written.\n"
-
-        self.write_network_cfg_help_str = \
-            "write-network-cfg\n" +\
-            "\n" +\
-            "Update the network configurition files. The network interfaces are not\n" +\
-            "restarted.\n"
-
-        self.write_issue_help_str = \
-            "write-issue\n" +\
-            "\n" +\
-            "Update the '/etc/issue' file with the configuration information.\n"
-
-        self.restart_services_help_str = \
-            "restart-services\n" +\
-            "\n" +\
-            "Stop all non-essential or disabled services then start all enabled services. The\n" +\
-            "service configuration files are updated.\n"
-        
-        self.restart_network_help_str = \
-            "restart-network\n" +\
-            "\n" +\
-            "Reload the hostname and the firewall rules, and restart the network interfaces.\n" +\
-            "The network configuration files are updated.\n"
-        
         # Command dispatch table. The first column is the command name, the
         # second is the number of arguments, the third is the short options
         # accepted, the fourth is the long options accepted, the fifth is the
-        # handler function to call, the sixth is the help string. 'None' can be
-        # specified for the number of arguments when the command takes a
-        # variable number of arguments. The arguments supplied to the handler
-        # are the values returned by getopt().
+        # handler function to call. The help string of the command is returned
+        # by get_cmd_help_str(). 'None' can be specified for the number of
+        # arguments when the command takes a variable number of arguments. The
+        # arguments supplied to the handler are the values returned by
+        # getopt().
         self.cmd_dispatch_table = \
-            (("help", None, "", [], self.handle_help, self.help_help_str),
-             ("info", 0, "", [], self.handle_info, self.info_help_str),
-             ("health", 0, "", [], self.handle_health, self.health_help_str),
-             ("ifconfig", 0, "", [], self.handle_ifconfig, self.ifconfig_help_str),
-             ("netstat", 0, "", [], self.handle_netstat, self.netstat_help_str),
-             ("services", 0, "", [], self.handle_services, self.services_help_str),
-             ("setup", 0, "", [], self.handle_setup, self.setup_help_str),
-             ("production", 0, "", [], self.handle_production, self.production_help_str),
-             ("maintenance", 0, "", [], self.handle_maintenance, self.maintenance_help_str),
-             ("update", 0, "", [], self.handle_update, self.update_help_str),
-             ("enable", 1, "f", ["force"], self.handle_enable, self.enable_help_str),
-             ("disable", 1, "f", ["force"], self.handle_disable, self.disable_help_str),
-             ("start", None, "f", ["force"], self.handle_start, self.start_help_str),
-             ("stop", None, "f", ["force"], self.handle_stop, self.stop_help_str),
-             ("set-host", 1, "", [], self.handle_set_host, self.set_host_help_str),
-             ("set-root-pwd", 1, "", [], self.handle_set_root_pwd, self.set_root_pwd_help_str),
-             ("set-admin-pwd", 1, "", [], self.handle_set_admin_pwd, self.set_admin_pwd_help_str),
-             ("write-service-cfg", 0, "", [], self.handle_write_service_cfg, self.write_service_cfg_help_str),
-             ("write-network-cfg", 0, "", [], self.handle_write_network_cfg, self.write_network_cfg_help_str),
-             ("write-issue", 0, "", [], self.handle_write_issue, self.write_issue_help_str),
-             ("restart-services", 0, "", [], self.handle_restart_services, self.restart_services_help_str),
-             ("restart-network", 0, "", [], self.handle_restart_network, self.restart_network_help_str))
+            (("help", None, "", [], self.handle_help),
+             ("info", 0, "", [], self.handle_info),
+             ("health", 0, "", [], self.handle_health),
+             ("ifconfig", 0, "", [], self.handle_ifconfig),
+             ("netstat", 0, "", [], self.handle_netstat),
+             ("conns", 0, "n:i:c:", ["top=", "interval=", "count="], self.handle_conns),
+             ("services", 0, "", [], self.handle_services),
+             ("setup", 0, "", [], self.handle_setup),
+             ("production", 0, "", [], self.handle_production),
+             ("maintenance", 0, "", [], self.handle_maintenance),
+             ("update", 0, "", [], self.handle_update),
+             ("enable", 1, "f", ["force"], self.handle_enable),
+             ("disable", 1, "f", ["force"], self.handle_disable),
+             ("start", None, "f", ["force"], self.handle_start),
+             ("stop", None, "f", ["force"], self.handle_stop),
+             ("set-host", 1, "", [], self.handle_set_host),
+             ("set-root-pwd", 1, "", [], self.handle_set_root_pwd),
+             ("set-admin-pwd", 1, "", [], self.handle_set_admin_pwd),
+             ("write-service-cfg", 0, "", [], self.handle_write_service_cfg),
+             ("write-network-cfg", 0, "", [], self.handle_write_network_cfg),
+             ("write-issue", 0, "f", ["force"], self.handle_write_issue),
+             ("restart-services", 0, "", [], self.handle_restart_services),
+             ("restart-network", 0, "", [], self.handle_restart_network),
+             ("tune", 0, "s", ["show"], self.handle_tune),
+             ("batch", None, "kr:", ["keep-going", "results="], self.handle_batch),
+             ("locks", 0, "", [], self.handle_locks))
+        
+        # Issue file parameters, see issue_path and issue_max_age.
+        self.issue_path = issue_path
+        self.issue_key_path = issue_key_path
+        self.issue_max_age = issue_max_age
+        
+        # Commands that change the inputs of the issue file: the configuration,
+        # the services, the server mode or the network. The issue file is
+        # refreshed after they complete.
+        self.issue_input_cmd_list = ["setup", "production", "maintenance", "update", "enable", "disable",
+                                     "start", "stop", "set-host", "write-service-cfg", "write-network-cfg",
+                                     "restart-services", "restart-network", "batch"]
+        
+        # Maximum time to wait for the configuration lock, in seconds.
+        self.lock_timeout = 60
+        
+        # Commands that do not lock the configuration. 'setup' locks it
+        # itself around each change, not while it prompts the user.
+        self.no_lock_cmd_list = ["help", "locks", "conns", "setup"]
+        
+        # Commands that only read the configuration. They share the lock, the
+        # other commands hold it exclusively.
+        self.read_only_cmd_list = ["info", "health", "ifconfig", "netstat", "services"]
+        
+        # Commands that only read the configuration when one of the options
+        # listed is specified.
+        self.read_only_opt_dict = { "tune" : ["-s", "--show"] }
+        
+        # Commands that cannot be run by the 'batch' command.
+        self.no_batch_cmd_list = ["setup", "batch"]
 
     # Print the program usage.
     def print_usage(self, stream):
-        stream.write(self.global_help_str)
+        stream.write(global_help_str)
+    
+    # Return the help string of the command specified.
+    def get_cmd_help_str(self, cmd):
+        return cmd_help_dict[cmd[0]]
 
     # Enable logging to syslog.
     def enable_syslog(self):
+        import syslog
+        
         class SyslogStream:
             def write(self, msg):
                 syslog.syslog(syslog.LOG_INFO, msg)
@@ -235,6 +388,14 @@ class PlatShell:
         self.stdout = stream
         self.stderr = stream
     
+    # Return true if the command specified only reads the configuration with
+    # the options specified.
+    def is_read_only_cmd(self, name, opts):
+        if name in self.read_only_cmd_list: return 1
+        for k, v in opts:
+            if k in self.read_only_opt_dict.get(name, []): return 1
+        return 0
+    
     # Return the list of commands matching the name specified.
     def get_cmd_list_from_name(self, name):
         l = []
@@ -244,41 +405,84 @@ class PlatShell:
 
     # Setup readline.
     def setup_readline(self):
+        import readline, kprompt
+        
         cmd_name_list = []
         for entry in self.cmd_dispatch_table: cmd_name_list.append(entry[0])
-        completer = readline_completer(cmd_name_list)
+        completer = kprompt.readline_completer(cmd_name_list)
         readline.set_completer_delims("")
         readline.parse_and_bind("tab: complete")
         readline.set_completer(completer.complete)
 
-    # Return the parsed output of nestat(1) describing the address/port pairs
-    # being listened to.
+    # Return the network information of the current command. The information
+    # is read once per command.
+    def get_net_info(self):
+        if self.net_info == None:
+            from knetinfo import NetInfo
+            self.net_info = NetInfo()
+        return self.net_info
+    
+    # Return the address/port pairs being listened to and the processes
+    # listening to them, in the format of netstat(8).
     def get_netstat_output(self):
+        net_info = self.get_net_info()
+        pid_dict = net_info.get_listen_pid_dict()
         s = ""
         s += "Address:port          pid/process\n"
         s += "---------------------------------\n"
-        for line in get_cmd_output(["/bin/netstat", "-nltp"]).splitlines():
-            fields = line.split()
-            if len(fields) < 7 or not fields[0].startswith("tcp"): continue
-            s += "%s%s\n" % (fields[3].ljust(22), fields[6])
+        for sock in net_info.get_listen_socket_list():
+            if pid_dict.has_key(sock.inode): proc = "%i/%s" % pid_dict[sock.inode]
+            else: proc = "-"
+            s += "%s%s\n" % ((sock.local_addr + ":" + str(sock.local_port)).ljust(22), proc)
         return s
     
-    # Return the parsed output of ifconfig(1) describing the status of the
-    # network interfaces
+    # Return the status of the network interfaces, in the format of the
+    # stripped output of ifconfig(8).
     def get_ifconfig_output(self):
-        s = ""
-        remaining = 0
-        for line in get_cmd_output(["/sbin/ifconfig", "-a"]).splitlines():
-            if line == "":
-                s += "\n"
-                remaining = 0
-            elif not line[0].isspace():
-                remaining = 2
-                s += line + "\n"
-            elif remaining:
-                s += line + "\n"
-                remaining -= 1
-        return s.strip() + "\n"
+        from knetinfo import iface_flag_list
+        net_info = self.get_net_info()
+        l = []
+        for name, stats in net_info.get_iface_stats():
+            info = net_info.get_iface_info(name)
+            s = "%sLink encap:%s" % (name.ljust(10), info["encap"])
+            if info["hwaddr"]: s += "  HWaddr " + info["hwaddr"]
+            s += "\n"
+            if info["addr"]:
+                s += "          inet addr:" + info["addr"]
+                if info["broadcast"] and info["broadcast"] != "0.0.0.0": s += "  Bcast:" + info["broadcast"]
+                s += "  Mask:" + info["netmask"] + "\n"
+            flag_str = " ".join([ flag_name for flag, flag_name in iface_flag_list if info["flags"] & flag ])
+            s += "          %s  MTU:%i\n" % (flag_str, info["mtu"])
+            s += "          RX bytes:%i  TX bytes:%i\n" % (stats["rx_bytes"], stats["tx_bytes"])
+            l.append(s)
+        return "\n".join(l)
+    
+    # Return the TCP connection statistics specified as a table, see
+    # knetinfo.get_tcp_conn_stats(). 'port_service_dict' maps the ports to the
+    # name of the services listening to them.
+    def get_conns_output(self, stats, port_service_dict, top_count):
+        # ESTABLISHED, SYN_RECV, TIME_WAIT and CLOSE_WAIT.
+        state_list = [1, 3, 6, 8]
+        
+        l = []
+        l.append("Port   Service         Queue/Backlog  ESTABLISHED  SYN_RECV  TIME_WAIT  CLOSE_WAIT\n")
+        l.append("--------------------------------------------------------------------------------\n")
+        def add_line(port_str, service, queue_str, count_list):
+            l.append("%-7s%-16s%-15s%-13i%-10i%-11i%i\n" % tuple([port_str, service, queue_str] + count_list))
+        
+        port_list = stats.listen_dict.keys()
+        port_list.sort()
+        for port in port_list:
+            add_line(str(port), port_service_dict.get(port, "-"), "%i/%i" % stats.listen_dict[port],
+                     [ stats.get_count(port, state) for state in state_list ])
+        add_line("other", "-", "-", [ stats.get_count(None, state) for state in state_list ])
+        add_line("total", "", "", [ stats.state_dict.get(state, 0) for state in state_list ])
+        
+        peer_list = stats.get_top_peer_list(top_count)
+        if len(peer_list):
+            l.append("\nTop remote addresses:\n")
+            for n, addr in peer_list: l.append("  %-40s%i\n" % (addr, n))
+        return "".join(l)
     
     # Return a string containing the server service state.
     def get_server_service_summary_string(self):
@@ -329,7 +533,7 @@ class PlatShell:
     def get_formatted_web_config_url(self):
         if not len(self.config.admin_pwd) or self.service_manager.get_service("apache").run_status() != 2:
             return ""
-        return "Web configuration URL: \033[35mhttps://" + get_current_server_address() + ":9001\033[0m"
+        return "Web configuration URL: \033[35mhttps://" + self.get_net_info().get_server_address() + ":9001\033[0m"
     
     # Return a formatted string for the configuration information.
     def get_formatted_config_info(self, status_flag=1, bar_flag=1):
@@ -339,7 +543,7 @@ class PlatShell:
         url = self.get_formatted_web_config_url()
         user_summary = self.get_user_service_summary_string()
         eth0 = self.config.eth0
-        cur_addr = get_current_server_address()
+        cur_addr = self.get_net_info().get_server_address()
         s = ""
         
         if bar_flag:
@@ -360,6 +564,11 @@ class PlatShell:
         else:
             s += "(dhcp)\n"
         
+        for iface in self.config.iface_list:
+            s += "Interface %s: " % (iface.name)
+            if iface.method == "static": s += "%s/%s (static)\n" % (iface.ip, iface.netmask)
+            else: s += "(%s)\n" % (iface.method)
+        
         s += "Fully qualified domain name: " + self.config.get_fqdn() + "\n"
         s += "\n"
         
@@ -392,80 +601,146 @@ class PlatShell:
         
         return s
     
+    # Return the fingerprint of the inputs used to render the issue file. The
+    # fingerprint is computed without spawning processes. The configuration is
+    # taken from memory rather than from the master config file, which is not
+    # written yet while a batch is running.
+    def get_issue_fingerprint(self):
+        import hashlib
+        
+        key_list = [ hashlib.md5(self.config.get_master_config_string()).hexdigest() ]
+        path = "/etc/teambox/product_version"
+        if os.path.isfile(path): key_list.append(hashlib.md5(read_file(path)).hexdigest())
+        else: key_list.append(None)
+        for service in self.service_manager.service_list:
+            key_list.append((service.name, service.get_state_key()))
+        key_list.append(self.get_net_info().get_server_address())
+        key_list.append(int(time.time() / self.issue_max_age))
+        return hashlib.md5(repr(key_list)).hexdigest()
+    
+    # Return the content of the issue file.
+    def render_issue(self):
+        def act(action_text): return "\033[1;36m" + action_text + "\033[0m"
+        
+        product = self.get_formatted_product_name_and_version()
+        mode = self.get_formatted_server_mode()
+        banner = self.get_formatted_error_banner()
+        url = self.get_formatted_web_config_url()
+        
+        s = ""
+        s += "\033\133\110\033\133\062\112"
+        s += product + "  " + mode
+        if banner: s += "  " + banner
+        s += "\n"
+        s += " Type " + act("setup") + " to setup the machine.\n"
+        s += " Type " + act("login") + " to login as root on the machine.\n"
+        s += " Type " + act("info") + " to display the basic configuration.\n"
+        s += " Type " + act("maintenance") + " or " + act("production") + " to switch the server mode.\n"
+        s += " Type " + act("update") + " to update the software.\n"
+        if url: s += "\n" + url + "\n"
+        s += s
+        return s
+    
     # This method prompts the user for one or several IP addresses. If the
     # address supplied is incorrect, a ValueError exception is raised.
     def prompt_for_ip(self, prompt, multi_flag=0):
+        import kprompt
+        
         while 1:
             try:
-                res = prompt_string(prompt)
+                res = kprompt.prompt_string(prompt)
                 if multi_flag:
                     addr_list = res.split()
                     if not len(addr_list): raise ValueError
-                    for addr in addr_list: parse_dotted_ip(addr)
+                    for addr in addr_list: kprompt.parse_dotted_ip(addr)
                     return addr_list
                 else:
-                    parse_dotted_ip(res)
+                    kprompt.parse_dotted_ip(res)
                     return res
             except ValueError:
                 print "The address you have specified is invalid.\n"
-                if not get_confirm("Try again?"): raise ValueError
+                if not kprompt.get_confirm("Try again?"): raise ValueError
     
     # Helper method for _configure_dhcp() and _configure_static_ip().
     def _configure_iface_helper(self):
         try:
             self.config.save_master_config()
             self.config.write_network_config()
-            self.service_manager.restart_network()
-            print("Reconfiguration successful. Current address: " + get_current_server_address())
+            self.service_manager.restart_network(self.config.get_iface_list())
+            self.net_info = None
+            print("Reconfiguration successful. Current address: " + self.get_net_info().get_server_address())
         except Exception, e:
             self.stderr.write("Error: " + str(e) + ".\n")
             return
     
+    # Call the function specified with the configuration locked exclusively
+    # and freshly loaded. The setup prompts are answered without holding the
+    # lock, so that the other commands are not blocked meanwhile.
+    def _run_locked(self, func):
+        try:
+            self.config.lock_master_config(1, self.lock_timeout, "kplatshell setup")
+            try:
+                self.config.load_master_config()
+                func()
+                self.refresh_issue()
+            finally:
+                self.config.unlock_master_config()
+        except Exception, e:
+            self.stderr.write("Error: " + str(e) + ".\n")
+    
     # This method configures the machine to use DHCP.
     def _configure_dhcp(self):
-        eth0 = self.config.eth0
-        eth0.method = "dhcp"
-        self._configure_iface_helper()
+        def apply():
+            self.config.eth0.method = "dhcp"
+            self._configure_iface_helper()
+        self._run_locked(apply)
 
     # This method configures the machine to use a static IP.
     def _configure_static_ip(self):
         try:
+            ip = self.prompt_for_ip("Static IP address:")
+            netmask = self.prompt_for_ip("Static IP netmask:")
+            gateway = self.prompt_for_ip("Gateway IP address:")
+            dns_addr_list = self.prompt_for_ip("Nameserver IP list:", 1)
+        except ValueError: return
+        
+        def apply():
             eth0 = self.config.eth0
             eth0.method = "static"
-            eth0.ip = self.prompt_for_ip("Static IP address:")
-            eth0.netmask = self.prompt_for_ip("Static IP netmask:")
-            eth0.gateway = self.prompt_for_ip("Gateway IP address:")
-            self.config.dns_addr_list = self.prompt_for_ip("Nameserver IP list:", 1)
-        except ValueError: return
-        self._configure_iface_helper()
+            eth0.ip = ip
+            eth0.netmask = netmask
+            eth0.gateway = gateway
+            self.config.dns_addr_list = dns_addr_list
+            self._configure_iface_helper()
+        self._run_locked(apply)
     
     # This method changes the FQDN of the machine.
     def _configure_fqdn(self):
+        import kprompt
+        
         print("")
-        try:
-            host = prompt_string("Host:")
-            self.config.set_host(self.service_manager, host, self.stdout)
-        except Exception, e:
-            self.stderr.write("Error: " + str(e) + ".\n")
-            return
+        host = kprompt.prompt_string("Host:")
+        self._run_locked(lambda: self.config.set_host(self.service_manager, host, self.stdout))
     
     # Handle the change password loop. Return the password if provided, or "" if
     # the user aborted the operation.
     def _configure_pwd_helper(self):
+        import getpass, kprompt
+        
         print("")
         while 1:
             pwd1 = getpass.getpass("Enter password: ")
             
             if pwd1 == "":
                 print "You did not provide a password.\n"
-                if not get_confirm("Try again?"): return ""
+                if not kprompt.get_confirm("Try again?"): return ""
                 continue
             
             pwd2 = getpass.getpass("Confirm password: ")
             
             if pwd1 != pwd2:
                 print "Sorry, the passwords do not match.\n"
-                if not get_confirm("Try again?"): return ""
+                if not kprompt.get_confirm("Try again?"): return ""
                 continue
         
             return pwd1
@@ -474,15 +749,19 @@ class PlatShell:
     def _configure_root_pwd(self):
         pwd = self._configure_pwd_helper()
         if pwd:
-            self.config.set_root_pwd(pwd)
-            print "The root account password has been changed."
+            def apply():
+                self.config.set_root_pwd(pwd)
+                print "The root account password has been changed."
+            self._run_locked(apply)
 
     # Change the administration password.
     def _configure_admin_pwd(self):
         pwd = self._configure_pwd_helper()
         if pwd:
-            self.config.set_admin_pwd(pwd)
-            print "The administration password has been changed."
+            def apply():
+                self.config.set_admin_pwd(pwd)
+                print "The administration password has been changed."
+            self._run_locked(apply)
     
     # Command handlers.
     def handle_help(self, opts, args):
@@ -497,7 +776,7 @@ class PlatShell:
                 first = 1
                 for cmd in l:
                     if not first: self.stdout.write("\n")
-                    self.stdout.write(cmd[5])
+                    self.stdout.write(self.get_cmd_help_str(cmd))
                     first = 0
         
         # Print global help.
@@ -519,6 +798,49 @@ class PlatShell:
     def handle_netstat(self, opts, args):
         self.stdout.write(self.get_netstat_output())
         
+    def handle_conns(self, opts, args):
+        import knetinfo
+        
+        top_count = 10
+        interval = None
+        count = 1
+        try:
+            for k, v in opts:
+                if k == "-n" or k == "--top": top_count = int(v)
+                elif k == "-i" or k == "--interval": interval = float(v)
+                elif k == "-c" or k == "--count": count = int(v)
+        except ValueError:
+            raise Exception("invalid option value")
+        
+        port_service_dict = self.service_manager.get_port_service_dict()
+        port_service_dict[self.config.kcd_listen_port] = "kcd"
+        
+        if interval == None:
+            self.stdout.write(self.get_conns_output(knetinfo.get_tcp_conn_stats(), port_service_dict,
+                                                    top_count))
+            return
+        
+        # Sample the TCP counters and report their rate over every interval.
+        rate_list = [ ("accepted", "PassiveOpens"), ("opened", "ActiveOpens"),
+                      ("failed", "AttemptFails"), ("reset", "EstabResets"),
+                      ("retransmitted segments", "RetransSegs"),
+                      ("accept queue overflows", "ListenOverflows") ]
+        prev_counters = knetinfo.read_tcp_counters()
+        prev_time = time.time()
+        for i in range(count):
+            time.sleep(interval)
+            counters = knetinfo.read_tcp_counters()
+            now = time.time()
+            elapsed = max(now - prev_time, 0.001)
+            s = time.strftime("%H:%M:%S", time.localtime(now)) + " rates per second:"
+            s += ",".join([ " %s %.1f" % (desc, (counters.get(name, 0) - prev_counters.get(name, 0)) / elapsed)
+                            for desc, name in rate_list ])
+            self.stdout.write(s + "\n\n")
+            self.stdout.write(self.get_conns_output(knetinfo.get_tcp_conn_stats(), port_service_dict,
+                                                    top_count) + "\n")
+            prev_counters = counters
+            prev_time = now
+    
     def handle_services(self, opts, args):
         s = ""
         s += "=== User services ===\n"
@@ -529,6 +851,7 @@ class PlatShell:
         self.stdout.write(s)
      
     def handle_setup(self, opts, args):
+        import kprompt
         
         # Show the configuration to the user.
         self.stdout.write(self.get_formatted_config_info(0, 1))
@@ -544,14 +867,16 @@ class PlatShell:
             print "  f) Show the current configuration."
             print "  *) Exit."
             
-            choice = prompt_string("\nChoice:")
+            choice = kprompt.prompt_string("\nChoice:")
             
             if choice == "a": self._configure_dhcp()
             elif choice == "b": self._configure_static_ip()
             elif choice == "c": self._configure_fqdn()
             elif choice == "d": self._configure_root_pwd()
             elif choice == "e": self._configure_admin_pwd()
-            elif choice == "f": self.stdout.write(self.get_formatted_config_info(0, 1))
+            elif choice == "f":
+                self.config.load_master_config()
+                self.stdout.write(self.get_formatted_config_info(0, 1))
             else: break
             
         # Show the info about the web interface if required.
@@ -638,27 +963,34 @@ class PlatShell:
         self.config.write_network_config()
         
     def handle_write_issue(self, opts, args):
-        def act(action_text): return "\033[1;36m" + action_text + "\033[0m"
+        force_flag = 0
+        for k, v in opts:
+            if k == "-f" or k == "--force": force_flag = 1
         
-        product = self.get_formatted_product_name_and_version()
-        mode = self.get_formatted_server_mode()
-        banner = self.get_formatted_error_banner()
-        url = self.get_formatted_web_config_url()
+        # Skip the rendering if the inputs have not changed. The key file
+        # holds the full fingerprint and the quick key checked by the issue
+        # script before the configuration is loaded.
+        quick_key = get_issue_quick_key()
+        key = self.get_issue_fingerprint()
+        if not force_flag and os.path.isfile(self.issue_path) and os.path.isfile(self.issue_key_path):
+            key_list = read_file(self.issue_key_path).split()
+            if len(key_list) and key_list[0] == key:
+                if key_list[1:] != [quick_key]: write_file_atom(self.issue_key_path, "%s\n%s\n" % (key, quick_key))
+                return
         
-        s = ""
-        s += "\033\133\110\033\133\062\112"
-        s += product + "  " + mode
-        if banner: s += "  " + banner
-        s += "\n"
-        s += " Type " + act("setup") + " to setup the machine.\n"
-        s += " Type " + act("login") + " to login as root on the machine.\n"
-        s += " Type " + act("info") + " to display the basic configuration.\n"
-        s += " Type " + act("maintenance") + " or " + act("production") + " to switch the server mode.\n"
-        s += " Type " + act("update") + " to update the software.\n"
-        if url: s += "\n" + url + "\n"
-        s += s
+        write_file_atom(self.issue_path, self.render_issue())
         
-        write_file("/etc/issue", s)
+        key_dir = os.path.dirname(self.issue_key_path)
+        if not os.path.isdir(key_dir): os.makedirs(key_dir)
+        write_file_atom(self.issue_key_path, "%s\n%s\n" % (key, quick_key))
+    
+    # Render the issue file again if its inputs changed. This is called with
+    # the configuration locked after the commands that change the inputs, so
+    # that the issue file is up to date when the getty displays it. A failure
+    # is reported without failing the command.
+    def refresh_issue(self):
+        try: self.handle_write_issue([], [])
+        except Exception, e: self.stderr.write("Warning: cannot refresh %s: %s.\n" % (self.issue_path, str(e)))
         
     def handle_restart_services(self, opts, args):
         self.config.normalize_service_config()
@@ -667,8 +999,115 @@ class PlatShell:
     
     def handle_restart_network(self, opts, args):
         self.config.write_network_config()
-        self.service_manager.restart_network()
+        self.service_manager.restart_network(self.config.get_iface_list())
+    
+    def handle_tune(self, opts, args):
+        show_flag = 0
+        for k, v in opts:
+            if k == "-s" or k == "--show": show_flag = 1
+        
+        if show_flag:
+            sysctl_str, block_list = self.config.get_tuning_file_content(self.config.get_tuning_profile())
+            self.stdout.write("==> %s <==\n%s" % (self.config.sysctl_file_path, sysctl_str))
+            for path, block in block_list: self.stdout.write("\n==> %s <==\n%s" % (path, block))
+            return
+        
+        self.config.write_tuning_config()
+        self.service_manager.reload_sysctl(self.config.sysctl_file_path)
+    
+    def handle_batch(self, opts, args):
+        import json, shlex
+        
+        keep_going_flag = 0
+        results_path = None
+        for k, v in opts:
+            if k == "-k" or k == "--keep-going": keep_going_flag = 1
+            elif k == "-r" or k == "--results": results_path = v
+        
+        if len(args) > 1: raise Exception("too many arguments")
+        if len(args) and args[0] != "-": line_list = read_file(args[0]).splitlines()
+        else: line_list = sys.stdin.readlines()
+        
+        results_file = None
+        if results_path == "-": results_file = self.stdout
+        elif results_path: results_file = open(results_path, "wb")
+        
+        # Write the result of a command.
+        def write_result(line_no, arg_list, error, start_time):
+            if not results_file: return
+            result = { "line" : line_no, "command" : arg_list, "time" : time.time() - start_time }
+            if error == None: result["status"] = "ok"
+            else:
+                result["status"] = "error"
+                result["error"] = error
+            results_file.write(json.dumps(result) + "\n")
+        
+        # Defer the writes and the service actions until all commands are run.
+        self.batch_flag = 1
+        self.config.defer_writes()
+        self.service_manager.defer_actions()
+        
+        failed_flag = 0
+        commit_flag = 0
+        try:
+            try:
+                line_no = 0
+                for line in line_list:
+                    line_no += 1
+                    arg_list = shlex.split(line, comments=True)
+                    if not len(arg_list): continue
+                    
+                    start_time = time.time()
+                    error = None
+                    try:
+                        if self.run_command(arg_list): error = "invalid command"
+                    except Exception, e:
+                        self.stderr.write("Error: " + str(e) + ".\n")
+                        error = str(e)
+                    write_result(line_no, arg_list, error, start_time)
+                    
+                    if error != None:
+                        failed_flag = 1
+                        if not keep_going_flag: break
+                
+                # Apply the changes only if all the commands succeeded, unless
+                # --keep-going was specified.
+                commit_flag = keep_going_flag or not failed_flag
+            
+            # Drop the changes if they are not applied.
+            finally:
+                self.batch_flag = 0
+                if not commit_flag:
+                    self.config.discard_deferred_writes()
+                    self.service_manager.discard_deferred_actions()
+            
+            # Apply the changes made by the commands that were run.
+            if commit_flag:
+                start_time = time.time()
+                error = None
+                try:
+                    self.config.run_deferred_writes()
+                    self.service_manager.run_deferred_actions()
+                except Exception, e:
+                    error = str(e)
+                    failed_flag = 1
+                    raise
+                finally:
+                    write_result(None, ["commit"], error, start_time)
+        
+        finally:
+            if results_file and results_file != self.stdout: results_file.close()
+        
+        return failed_flag
 
+    def handle_locks(self, opts, args):
+        holder_list = self.config.master_config_lock.get_holder_list()
+        if not len(holder_list):
+            self.stdout.write("The configuration is not locked.\n")
+            return
+        for pid, mode, start_time, desc in holder_list:
+            self.stdout.write("%-8i%-11s%s  %s\n" % (pid, mode, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(start_time)), desc))
+    
     # Run the specified command. This method must be passed a list containing
     # the command name and its arguments. The method returns 0 on success, 1 on
     # failure.
@@ -696,20 +1135,46 @@ class PlatShell:
         try: cmd_opts, cmd_args = getopt.getopt(input_arg_list[1:], cmd[2], cmd[3])
         except getopt.GetoptError, e:
             self.stderr.write("Command options error: %s.\n\n" % (str(e)))
-            self.stderr.write(cmd[5])
+            self.stderr.write(self.get_cmd_help_str(cmd))
             return 1
        
         # Verify the number of arguments.
         if cmd[1] != None and cmd[1] != len(cmd_args):
             self.stderr.write("Invalid number of arguments.\n\n")
-            self.stderr.write(cmd[5])
+            self.stderr.write(self.get_cmd_help_str(cmd))
             return 1
         
-        # Load the root configuration node.
-        if cmd[0] != "help": self.config.load_master_config()
-    
-        # Call the handler.
-        cmd[4](cmd_opts, cmd_args)
+        # Some commands cannot be batched.
+        if self.batch_flag and cmd[0] in self.no_batch_cmd_list:
+            self.stderr.write("Command %s cannot be run in batch mode.\n" % (cmd[0]))
+            return 1
+        
+        # Lock the configuration. In batch mode, the lock is held by the 'batch'
+        # command.
+        lock_flag = cmd[0] not in self.no_lock_cmd_list and not self.batch_flag
+        if lock_flag:
+            self.config.lock_master_config(not self.is_read_only_cmd(cmd[0], cmd_opts), self.lock_timeout,
+                                           "kplatshell " + cmd[0])
+        
+        try:
+            # Load the root configuration node. In batch mode, the node has
+            # already been loaded.
+            if cmd[0] != "help" and not self.batch_flag: self.config.load_master_config()
+        
+            # Call the handler with fresh network information.
+            self.net_info = None
+            res = cmd[4](cmd_opts, cmd_args)
+            
+            # Refresh the issue file. The 'setup' command refreshes it itself
+            # while it holds the lock, and the batched commands are covered by
+            # the 'batch' command.
+            if lock_flag and cmd[0] in self.issue_input_cmd_list:
+                self.net_info = None
+                self.refresh_issue()
+            return res
+        
+        finally:
+            if lock_flag: self.config.unlock_master_config()
 
     # This method implements a high-level exception handler.
     def high_level_exception_handler(self, e, ignore_error=0):
@@ -728,7 +1193,6 @@ class PlatShell:
 
     # Loop processing commands.
     def handle_shell_mode(self):
-        
         # Setup readline.
         self.setup_readline()
         
@@ -759,11 +1223,22 @@ def main():
     # Set the umask.
     os.umask(0022)
     
+    # Get the invokation name.
+    invoked_name = os.path.basename(sys.argv[0])
+    
+    # The issue script runs whenever the getty displays the issue. Exit before
+    # loading the configuration if none of the inputs of the issue changed.
+    if invoked_name == "issue.script" and len(sys.argv) == 1:
+        try:
+            if is_issue_fresh(): sys.exit(0)
+        except SystemExit: raise
+        except Exception: pass
+    
     # Create an instance of the shell.
     shell = PlatShell()
     
     # Parse the global options.
-    try: opts, args = getopt.getopt(sys.argv[1:], "hse", ["help", "syslog", "echo"])
+    try: opts, args = getopt.getopt(sys.argv[1:], "hsew:", ["help", "syslog", "echo", "wait="])
     except getopt.GetoptError, e:
 	sys.stderr.write("Options error: %s.\n\n" % (str(e)))
 	shell.print_usage(sys.stderr)
@@ -773,6 +1248,7 @@ def main():
 	if k == "-h" or k == "--help": help_flag = 1
 	elif k == "-s" or k == "--syslog": syslog_flag = 1
 	elif k == "-e" or k == "--echo": shell.echo_cmd_flag = 1
+	elif k == "-w" or k == "--wait": shell.lock_timeout = float(v)
     
     # Handle help.
     if help_flag:
@@ -782,9 +1258,6 @@ def main():
     # Setup syslog.
     if syslog_flag: shell.enable_syslog()
     
-    # Get the invokation name.
-    invoked_name = os.path.basename(sys.argv[0])
-    
     wait_for_return = 0
     
     # Dispatch.
@@ -795,8 +1268,10 @@ def main():
             cmd = invoked_name[7:]
             sys.exit(shell.run_command([cmd]))
         
-        # Handle issue.
+        # Handle issue. Don't hold the console for long if the configuration
+        # is being changed, the issue will be refreshed later.
         elif invoked_name == "issue.script":
+            shell.lock_timeout = min(shell.lock_timeout, 5)
             sys.exit(shell.run_command(["write-issue"]))
         
         # Handle shell_mode.
@@ -0,0 +1,102 @@
+import os, shutil, tempfile
+from krun import get_cmd_output, show_cmd_output
+
+# This class represents a multiplexed SSH connection to a host. A master
+# connection is established once and the commands and the file transfers go
+# through it, so that the SSH handshake is done only once. The remote port
+# forwardings specified are established by the master connection and last as
+# long as it does. The bulk transfers that run in parallel can use their own
+# connection instead, so that the encryption is not done by a single process.
+class SshConnection:
+    def __init__(self, host, user="root", compress_flag=0, forward_list=[]):
+
+        # Name or address of the remote host.
+        self.host = host
+
+        # Remote user.
+        self.user = user
+
+        # True if the traffic is compressed.
+        self.compress_flag = compress_flag
+
+        # List of remote port forwardings ('port:host:port').
+        self.forward_list = forward_list
+
+        # Directory containing the control socket, when the master connection
+        # is established.
+        self.control_dir = None
+
+    # Return the 'user@host' string of the remote host.
+    def get_target(self):
+        return self.user + "@" + self.host
+
+    # Return the path to the control socket.
+    def get_control_path(self):
+        return os.path.join(self.control_dir, "ctl")
+
+    # Return the options that make SSH use the master connection, or use its
+    # own connection if 'shared_flag' is false.
+    def get_control_opts(self, shared_flag=1):
+        if not shared_flag: return ["-o", "ControlMaster=no", "-o", "ControlPath=none"]
+        if not self.control_dir: return []
+        return ["-o", "ControlMaster=no", "-o", "ControlPath=" + self.get_control_path()]
+
+    # Establish the master connection. Nothing is done if it is already
+    # established.
+    def open(self):
+        if self.control_dir: return
+        self.control_dir = tempfile.mkdtemp(prefix="kssh-")
+        args = ["ssh", "-f", "-N", "-M", "-S", self.get_control_path()]
+        if self.compress_flag: args.append("-C")
+        for forward in self.forward_list: args += ["-R", forward]
+        args.append(self.get_target())
+        try:
+            show_cmd_output(args)
+        except:
+            shutil.rmtree(self.control_dir, True)
+            self.control_dir = None
+            raise
+
+    # Close the master connection, if it is established.
+    def close(self):
+        if not self.control_dir: return
+        try:
+            get_cmd_output(["ssh", "-S", self.get_control_path(), "-O", "exit", self.get_target()])
+        except Exception, e:
+            pass
+        shutil.rmtree(self.control_dir, True)
+        self.control_dir = None
+
+    # Return the arguments of the SSH command executing the command string
+    # specified on the remote host. The command uses its own connection if
+    # 'shared_flag' is false.
+    def get_ssh_args(self, cmd_string, shared_flag=1):
+        args = ["ssh"] + self.get_control_opts(shared_flag)
+        if self.compress_flag: args.append("-C")
+        return args + [self.get_target(), cmd_string]
+
+    # Return the arguments of the SCP command copying 'src' to 'dst'. The
+    # remote paths are prefixed by ':'.
+    def get_scp_args(self, src, dst):
+        l = []
+        for path in (src, dst):
+            if path.startswith(":"): path = self.get_target() + path
+            l.append(path)
+        return ["scp", "-r"] + self.get_control_opts() + l
+
+    # Return the value of the rsync '--rsh' option that makes rsync use the
+    # master connection, or its own connection if 'shared_flag' is false.
+    def get_rsync_rsh(self, shared_flag=1):
+        return " ".join(["ssh"] + self.get_control_opts(shared_flag))
+
+    # Execute a command string on the remote host.
+    def run(self, cmd_string):
+        show_cmd_output(self.get_ssh_args(cmd_string))
+
+    # Execute a command string on the remote host and return its output.
+    def get_output(self, cmd_string):
+        return get_cmd_output(self.get_ssh_args(cmd_string))
+
+    # Copy 'src' to 'dst'. The remote paths are prefixed by ':'.
+    def copy(self, src, dst):
+        show_cmd_output(self.get_scp_args(src, dst))
@@ -0,0 +1 @@
+../cfg/python/kssh.py
\ No newline at end of file
@@ -4,6 +4,7 @@ import sys, os, getopt
 import kprompt
 from kfile import *
 from krun import *
+from kssh import *
 
 # Name of the config file.
 stock_config_file_name = "config.ini.stock"
@@ -62,21 +63,16 @@ def create_source_file(source_list):
     write_file("sources.list", data)
 
 # Delete the target host paths specified.
-def delete_remote_paths(ip, paths):
-    show_cmd_output(["ssh", "root@" + ip, "rm -rf " + paths])
+def delete_remote_paths(ssh, paths):
+    ssh.run("rm -rf " + paths)
 
 # Copy the content of the current directory to the target host.
-def upload_cur_dir(ip):
-    show_cmd_output(["scp", "-r", "../" + get_cur_dir_name(), "root@" + ip + ":/"])
-
-# Establish the tunnel specified.
-def establish_tunnel(ip, tunnel):
-    show_cmd_output(["ssh", "-R", tunnel, "-N", "root@" + ip, "&"], shell_flag=1)
+def upload_cur_dir(ssh):
+    ssh.copy("../" + get_cur_dir_name(), ":/")
 
 # Run the setup script on the target host.
-def run_setup_script(ip, script_name, script_arg):
-    show_cmd_output(["ssh", "root@" + ip,
-                     "cd " + "/" + get_cur_dir_name() + " && ./" + script_name + " " + script_arg])
+def run_setup_script(ssh, script_name, script_arg):
+    ssh.run("cd " + "/" + get_cur_dir_name() + " && ./" + script_name + " " + script_arg)
 
 # Ask the confirmation to proceed.
 def ask_confirm(cfg):
@@ -183,22 +179,29 @@ def main():
 
         sys.stdout.write("Starting setup of " + ip + ".\n")
         
+        # The tunnels are established by the SSH connection used for all the
+        # remote operations. They are closed with it.
         for i in cfg.tunnel_list:
             sys.stdout.write("Establishing tunnel %s.\n" % (i))
-            establish_tunnel(ip, i)
-        
-        if cfg.delete_paths:
-            sys.stdout.write("Deleting " + cfg.delete_paths + "\n")
-            delete_remote_paths(ip, cfg.delete_paths)
+        ssh = SshConnection(ip, forward_list=cfg.tunnel_list)
+        ssh.open()
         
-        sys.stdout.write("Creating sources.list file.\n")
-        create_source_file(cfg.source_list)
-        
-        sys.stdout.write("Uploading '%s' directory.\n" % (get_cur_dir_name()))
-        upload_cur_dir(ip)
+        try:
+            if cfg.delete_paths:
+                sys.stdout.write("Deleting " + cfg.delete_paths + "\n")
+                delete_remote_paths(ssh, cfg.delete_paths)
+            
+            sys.stdout.write("Creating sources.list file.\n")
+            create_source_file(cfg.source_list)
+            
+            sys.stdout.write("Uploading '%s' directory.\n" % (get_cur_dir_name()))
+            upload_cur_dir(ssh)
+            
+            sys.stdout.write("Executing '" + cfg.script_name + " " + cfg.script_arg + "'.\n")
+            run_setup_script(ssh, cfg.script_name, cfg.script_arg)
         
-        sys.stdout.write("Executing '" + cfg.script_name + " " + cfg.script_arg + "'.\n")
-        run_setup_script(ip, cfg.script_name, cfg.script_arg)
+        finally:
+            ssh.close()
         
     except (KeyboardInterrupt, EOFError, SystemExit, Exception), e:
     
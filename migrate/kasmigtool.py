@@ -0,0 +1,1073 @@
+import os, re, sys, time, stat, zlib, errno, signal, shutil, hashlib, subprocess
+from kfile import read_file, write_file_atom
+from kasmodeltool import KFileLock
+
+# Types of the TOC entries that are restored after all the data is loaded.
+deferred_toc_type_list = [ "INDEX", "CONSTRAINT", "FK CONSTRAINT", "TRIGGER" ]
+
+# Regular expression matching a TOC entry line of 'pg_restore -l' whose type
+# is listed in deferred_toc_type_list. The line format is
+# '<id>; <table oid> <oid> <type> <schema> <name> <owner>'. The type and the
+# name can contain spaces, so the type is matched right after the oids.
+deferred_toc_entry_re = re.compile("^\d+; \d+ \d+ (%s) " % ("|".join([re.escape(t) for t in deferred_toc_type_list])))
+
+# Regular expression matching the COMMENT and ACL entries whose target is an
+# object of a deferred type. Their name starts with the type of the target,
+# e.g. 'COMMENT public INDEX foo_idx postgres'. They must be restored after
+# their target.
+deferred_toc_dep_re = re.compile("^\d+; \d+ \d+ (COMMENT|ACL) \S+ (%s) " % \
+                                 ("|".join([re.escape(t) for t in deferred_toc_type_list])))
+
+# Split the TOC listing of a custom format dump in two listings, one for the
+# schema and the data and one for the entries listed in
+# deferred_toc_type_list and the comments and ACLs of these entries. The
+# comment lines are kept in the first listing.
+def split_pg_toc(toc):
+    main_list = []
+    deferred_list = []
+    for line in toc.split("\n"):
+        if line == "": continue
+        if deferred_toc_entry_re.match(line) or deferred_toc_dep_re.match(line): deferred_list.append(line)
+        else: main_list.append(line)
+    return ("\n".join(main_list) + "\n", "\n".join(deferred_list) + "\n")
+
+# Return the number of parallel jobs to give to each of 'nb_task' concurrent
+# tasks sharing 'nb_job' jobs.
+def get_job_share(nb_job, nb_task):
+    if nb_task < 1: return nb_job
+    return max(1, nb_job / nb_task)
+
+# Move the entries of 'src_dir' to 'dst_dir', replacing the existing entries
+# with the same name. Return the list of names moved.
+def move_dir_entries(src_dir, dst_dir):
+    name_list = os.listdir(src_dir)
+    for name in name_list:
+        dst_path = os.path.join(dst_dir, name)
+        if os.path.isdir(dst_path) and not os.path.islink(dst_path): shutil.rmtree(dst_path)
+        os.rename(os.path.join(src_dir, name), dst_path)
+    return name_list
+
+# Delete the entries of 'dir' whose name is not in 'keep_list'.
+def delete_other_dir_entries(dir, keep_list):
+    for name in os.listdir(dir):
+        if name in keep_list: continue
+        path = os.path.join(dir, name)
+        if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+        else: os.unlink(path)
+
+# Return the command printing the manifest of the files under 'dir'. Each
+# entry is '<size> <mtime> <relative path>', terminated by a null character.
+def get_manifest_cmd(dir):
+    return "find %s -type f -printf '%%s %%T@ %%P\\0'" % (dir)
+
+# Parse a manifest. Return a dictionary mapping the relative paths to (size,
+# mtime) pairs.
+def parse_manifest(data):
+    manifest = {}
+    for entry in data.split("\0"):
+        if entry == "": continue
+        arr = entry.split(" ", 2)
+        if len(arr) != 3: raise Exception("invalid manifest entry '%s'" % (entry))
+        manifest[arr[2]] = (arr[0], arr[1])
+    return manifest
+
+# Return the string representation of a manifest.
+def format_manifest(manifest):
+    path_list = manifest.keys()
+    path_list.sort()
+    l = []
+    for path in path_list:
+        size, mtime = manifest[path]
+        l.append("%s %s %s\0" % (size, mtime, path))
+    return "".join(l)
+
+# Read the manifest stored at the path specified. Return None if there is no
+# manifest.
+def read_manifest(path):
+    if not os.path.isfile(path): return None
+    return parse_manifest(read_file(path))
+
+# Write a manifest atomically.
+def write_manifest(path, manifest):
+    write_file_atom(path, format_manifest(manifest))
+
+# Compare two manifests. Return the list of the paths that were added or
+# changed and the list of the paths that were removed, sorted.
+def diff_manifest(old, new):
+    changed_list = []
+    deleted_list = []
+    for path in new:
+        if old.get(path) != new[path]: changed_list.append(path)
+    for path in old:
+        if not new.has_key(path): deleted_list.append(path)
+    changed_list.sort()
+    deleted_list.sort()
+    return (changed_list, deleted_list)
+
+# Delete the files of 'dir' listed in 'path_list', then the directories that
+# became empty.
+def delete_manifest_files(dir, path_list):
+    parent_dict = {}
+    for path in path_list:
+        full_path = os.path.join(dir, path)
+        try: os.unlink(full_path)
+        except OSError, e:
+            if e.errno != errno.ENOENT: raise
+        parent_dict[os.path.dirname(path)] = 1
+
+    # Delete the deepest directories first.
+    parent_list = parent_dict.keys()
+    parent_list.sort()
+    parent_list.reverse()
+    for parent in parent_list:
+        while parent != "":
+            try: os.rmdir(os.path.join(dir, parent))
+            except OSError: break
+            parent = os.path.dirname(parent)
+
+# Return a human readable representation of a size in bytes.
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024: return "%.1f %s" % (size, unit)
+        size /= 1024.0
+    return "%.1f TB" % (size)
+
+# Split the (name, size) items specified in at most 'nb_shard' shards of
+# similar total size. The largest items are placed first, each in the
+# smallest shard. Among shards of the same size, the one with the fewest
+# items is used, so that items of unknown (zero) size are spread evenly.
+# Return a list of (name list, size) pairs.
+def get_shard_list(item_list, nb_shard):
+    item_list = list(item_list)
+    item_list.sort(lambda a, b: cmp(b[1], a[1]))
+    shard_list = []
+    for i in range(max(1, nb_shard)): shard_list.append([[], 0])
+    for name, size in item_list:
+        shard = shard_list[0]
+        for s in shard_list:
+            if (s[1], len(s[0])) < (shard[1], len(shard[0])): shard = s
+        shard[0].append(name)
+        shard[1] += size
+    res = []
+    for name_list, size in shard_list:
+        if len(name_list): res.append((name_list, size))
+    return res
+
+# Return the total size of the files of a manifest, per top level entry.
+def get_top_level_size_dict(manifest):
+    size_dict = {}
+    for path in manifest:
+        name = path.split("/", 1)[0]
+        size_dict[name] = size_dict.get(name, 0) + int(manifest[path][0])
+    return size_dict
+
+# Return the relative paths of the files under 'dir'.
+def get_local_file_list(dir):
+    path_list = []
+    for root, dir_list, file_list in os.walk(dir):
+        rel_root = root[len(dir):].lstrip("/")
+        for name in file_list: path_list.append(os.path.join(rel_root, name))
+    return path_list
+
+# Prefix of the commands run with a low CPU and I/O priority.
+low_priority_prefix = "nice -n 10 ionice -c2 -n7"
+
+# Return the command string copying its standard input to its standard
+# output at most 'rate' bytes per second. The command uses the Python
+# interpreter, which is available on the KAS hosts.
+def get_rate_limit_cmd(rate):
+    return "python -c 'import sys, time\n" + \
+           "r = %i; t = time.time(); n = 0\n" % (rate) + \
+           "while 1:\n" + \
+           " d = sys.stdin.read(65536)\n" + \
+           " if d == \"\": break\n" + \
+           " sys.stdout.write(d); n += len(d); w = n / float(r) - (time.time() - t)\n" + \
+           " if w > 0: time.sleep(w)'"
+
+# Return the command string piping the output of 'cmd' through
+# get_rate_limit_cmd(). The exit status is the one of 'cmd', since the shell
+# of the hosts does not support 'pipefail'.
+def get_rate_limited_cmd(cmd, rate):
+    return "exec 3>&1; s=$( { { (%s); echo $? >&4; } | %s >&3; } 4>&1 ); exit $s" % \
+           (cmd, get_rate_limit_cmd(rate))
+
+# Run the commands specified as a pipeline, the output of each command being
+# the input of the next one. Return the list of their exit statuses. Unlike a
+# shell pipeline without 'pipefail', the status of every command is known.
+def run_pipeline(args_list):
+    proc_list = []
+    stdin = None
+    for i in range(len(args_list)):
+        stdout = None
+        if i < len(args_list) - 1: stdout = subprocess.PIPE
+        proc = subprocess.Popen(args_list[i], stdin=stdin, stdout=stdout, close_fds=True)
+        if stdin != None: stdin.close()
+        stdin = proc.stdout
+        proc_list.append(proc)
+    return [proc.wait() for proc in proc_list]
+
+# Return the total size of the files under 'dir'.
+def get_tree_size(dir):
+    size = 0
+    for root, dir_list, file_list in os.walk(dir):
+        for name in file_list: size += os.lstat(os.path.join(root, name)).st_size
+    return size
+
+# Write the content of several files to the standard input of commands
+# concurrently. 'stream_list' contains (path, args list) tuples: each file is
+# read once and written to all the commands of its args list. The files are
+# read in turn, one chunk at a time. A command that stops reading does not stop
+# the others. Each file is read at most 'rate' bytes per second if 'rate' is
+# not zero. The reading stops while the LoadController 'controller', if any,
+# pauses the transfers; the time paused does not count against the rate.
+# Return the list of the exit statuses of the commands of each file.
+def stream_files_to_commands(stream_list, chunk_size=1024 * 1024, rate=0, controller=None):
+    if rate: chunk_size = max(4096, min(chunk_size, rate / 4))
+    
+    # Each state is a list [file, process list, open process list, bytes read].
+    state_list = []
+    try:
+        for path, args_list in stream_list:
+            f = open(path, "rb")
+            state = [f, [], [], 0]
+            state_list.append(state)
+            for args in args_list: state[1].append(subprocess.Popen(args, stdin=subprocess.PIPE, close_fds=True))
+            state[2] = list(state[1])
+        
+        start_time = time.time()
+        active_list = list(state_list)
+        while len(active_list):
+            if controller and controller.update():
+                pause_time = time.time()
+                while controller.update(): time.sleep(1)
+                start_time += time.time() - pause_time
+            for state in list(active_list):
+                f, proc_list, open_list, nb_read = state
+                data = ""
+                if len(open_list): data = f.read(chunk_size)
+                if data == "":
+                    active_list.remove(state)
+                    continue
+                for proc in list(open_list):
+                    try: proc.stdin.write(data)
+                    except IOError, e:
+                        if e.errno != errno.EPIPE: raise
+                        open_list.remove(proc)
+                state[3] += len(data)
+            if rate and len(active_list):
+                nb_read = max([state[3] for state in active_list])
+                delay = nb_read / float(rate) - (time.time() - start_time)
+                if delay > 0: time.sleep(delay)
+    finally:
+        for state in state_list:
+            state[0].close()
+            for proc in state[1]:
+                try: proc.stdin.close()
+                except IOError: pass
+    res = []
+    for state in state_list: res.append([proc.wait() for proc in state[1]])
+    return res
+
+# Write the content of a file to the standard input of several commands
+# concurrently, reading the file once. See stream_files_to_commands().
+def stream_file_to_commands(path, args_list, chunk_size=1024 * 1024, rate=0, controller=None):
+    return stream_files_to_commands([(path, args_list)], chunk_size, rate, controller)[0]
+
+# Return the SHA-1 of the content of a file.
+def get_file_checksum(path):
+    h = hashlib.sha1()
+    f = open(path, "rb")
+    try:
+        while 1:
+            data = f.read(1024 * 1024)
+            if data == "": break
+            h.update(data)
+    finally:
+        f.close()
+    return h.hexdigest()
+
+# This class represents the journal of an operation. The journal records the
+# steps that were completed, with a value identifying what was done, such as
+# the checksum of the file produced. The first line of the journal describes
+# the operation, so that a journal is not reused for another operation.
+class Journal:
+    def __init__(self, path, desc):
+        self.path = path
+        self.desc = desc
+
+        # Dictionary mapping the completed steps to their value.
+        self.step_dict = {}
+
+    # Open the journal. The steps recorded by a previous run of the operation
+    # are kept if 'resume_flag' is true, otherwise they are discarded.
+    def open(self, resume_flag):
+        self.step_dict = {}
+        if resume_flag and os.path.isfile(self.path):
+            line_list = read_file(self.path).split("\n")
+            if line_list[0] != self.desc:
+                raise Exception("the journal %s was written by another operation (%s)" % (self.path, line_list[0]))
+            for line in line_list[1:]:
+                if line == "": continue
+                arr = line.split(" ", 1)
+                if len(arr) == 1: arr.append("")
+                self.step_dict[arr[0]] = arr[1]
+        else:
+            write_file_atom(self.path, self.desc + "\n")
+
+    # Return the value recorded for the step specified, or None if the step
+    # was not completed.
+    def get_step(self, step):
+        return self.step_dict.get(step)
+
+    # Return true if the step specified was completed with the value
+    # specified.
+    def is_done(self, step, value=""):
+        return self.step_dict.get(step) == value
+
+    # Record the completion of a step. The journal is synced to the disk.
+    def mark_done(self, step, value=""):
+        f = open(self.path, "a")
+        try:
+            f.write("%s %s\n" % (step, value))
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        self.step_dict[step] = value
+
+    # Delete the journal once the operation is completed.
+    def remove(self):
+        if os.path.exists(self.path): os.unlink(self.path)
+        self.step_dict = {}
+
+# This class decides whether the jobs of a JobRunner must be paused to spare
+# the source host of the transfers. 'read_func' returns the content of
+# /proc/loadavg followed by the content of /proc/diskstats of that host. The
+# jobs are paused when the load average exceeds 'max_load' or when the
+# average latency of the disk requests exceeds 'max_latency' milliseconds.
+# They are resumed when both are back under 80% of these thresholds.
+class LoadController:
+    def __init__(self, read_func, max_load=0, max_latency=0, interval=5, tell_user=None):
+        self.read_func = read_func
+        self.max_load = max_load
+        self.max_latency = max_latency
+        self.interval = interval
+        self.tell_user = tell_user
+
+        # True if the jobs are paused.
+        self.pause_flag = 0
+
+        # Time of the last sample.
+        self.sample_time = 0
+
+        # Dictionary mapping the disks to their (request count, milliseconds
+        # spent) pair, as of the last sample.
+        self.disk_dict = None
+
+    # Parse a sample. Return the load average and the disk dictionary.
+    def parse_sample(self, data):
+        line_list = data.split("\n")
+        load = float(line_list[0].split()[0])
+        disk_dict = {}
+        for line in line_list[1:]:
+            arr = line.split()
+            if len(arr) < 11 or arr[2].startswith("loop") or arr[2].startswith("ram"): continue
+            disk_dict[arr[2]] = (int(arr[3]) + int(arr[7]), int(arr[6]) + int(arr[10]))
+        return (load, disk_dict)
+
+    # Return the highest average latency of the requests of a disk since the
+    # last sample, in milliseconds.
+    def get_latency(self, disk_dict):
+        latency = 0
+        if self.disk_dict == None: return latency
+        for disk in disk_dict:
+            if not self.disk_dict.has_key(disk): continue
+            nb_req = disk_dict[disk][0] - self.disk_dict[disk][0]
+            nb_ms = disk_dict[disk][1] - self.disk_dict[disk][1]
+            if nb_req > 0: latency = max(latency, nb_ms / float(nb_req))
+        return latency
+
+    # Sample the host if the interval has elapsed and update the pause flag.
+    # Return the pause flag. A sample that cannot be obtained is ignored.
+    def update(self):
+        now = time.time()
+        if now - self.sample_time < self.interval: return self.pause_flag
+        self.sample_time = now
+        try: load, disk_dict = self.parse_sample(self.read_func())
+        except Exception, e: return self.pause_flag
+        latency = self.get_latency(disk_dict)
+        self.disk_dict = disk_dict
+
+        ratio = 1
+        if self.pause_flag: ratio = 0.8
+        over_flag = (self.max_load and load > self.max_load * ratio) or \
+                    (self.max_latency and latency > self.max_latency * ratio)
+        if over_flag and not self.pause_flag:
+            self.pause_flag = 1
+            self.tell("Pausing the transfers (load %.2f, disk latency %.1f ms).\n" % (load, latency))
+        elif not over_flag and self.pause_flag:
+            self.pause_flag = 0
+            self.tell("Resuming the transfers (load %.2f, disk latency %.1f ms).\n" % (load, latency))
+        return self.pause_flag
+
+    # Display a string to the user, if possible.
+    def tell(self, s):
+        if self.tell_user: self.tell_user(s)
+
+# This class represents a command executed by a JobRunner.
+class Job:
+    def __init__(self, name, args, output_path=None, size=0):
+
+        # Name of the job, shown to the user.
+        self.name = name
+
+        # Command arguments.
+        self.args = args
+
+        # Path to the file receiving the output of the command, if any. The
+        # output is written to a temporary file which is renamed when the
+        # command succeeds.
+        self.output_path = output_path
+
+        # Number of bytes handled by the job, if known.
+        self.size = size
+
+        # Number of times the job was started.
+        self.try_count = 0
+
+        # Process running the command, if it was started.
+        self.proc = None
+
+        # Exit status of the command, if it finished.
+        self.status = None
+
+        # Time at which the job was first started and time at which it
+        # finished.
+        self.start_time = None
+        self.end_time = None
+
+# This class runs commands concurrently, at most 'max_job' at a time. The
+# commands are started in the order they were added. A failed command is
+# started again at most 'retry_count' times.
+class JobRunner:
+    def __init__(self, max_job=1, tell_user=None, retry_count=0, done_callback=None):
+        self.max_job = max(1, max_job)
+        self.tell_user = tell_user
+        self.retry_count = retry_count
+        self.job_list = []
+
+        # Function called with the name of each job that succeeds.
+        self.done_callback = done_callback
+
+        # Names of the jobs that failed.
+        self.failed_name_list = []
+
+        # Number of bytes handled by the jobs that completed.
+        self.done_size = 0
+
+        # Time at which the jobs were started and completed.
+        self.start_time = None
+        self.end_time = None
+
+        # LoadController deciding when the jobs are paused, if any. The
+        # running jobs are stopped while they are paused and no job is
+        # started.
+        self.controller = None
+        self.pause_flag = 0
+
+    # Add a job to run.
+    def add(self, name, args, output_path=None, size=0):
+        self.job_list.append(Job(name, args, output_path, size))
+
+    # Display a string to the user, if possible.
+    def tell(self, s):
+        if self.tell_user: self.tell_user(s)
+
+    # Return the total number of bytes handled by the jobs.
+    def get_total_size(self):
+        total = 0
+        for job in self.job_list: total += job.size
+        return total
+
+    # Return a string describing the throughput of the completed jobs.
+    def get_throughput_string(self):
+        elapsed = max(0.001, self.end_time - self.start_time)
+        return "%s in %.1f seconds (%s/s)" % \
+               (format_size(self.done_size), elapsed, format_size(self.done_size / elapsed))
+
+    # Return the status of the jobs for a phase report.
+    def get_status(self):
+        if len(self.failed_name_list): return "failed"
+        return "ok"
+
+    # Start the job specified.
+    def start_job(self, job):
+        job.try_count += 1
+        job.status = None
+        if job.start_time == None: job.start_time = time.time()
+        if job.try_count > 1: self.tell("Retrying %s.\n" % (job.name))
+        else: self.tell("Starting %s.\n" % (job.name))
+        if job.output_path:
+            f = open(job.output_path + ".tmp", "wb")
+            try: job.proc = subprocess.Popen(job.args, stdout=f, close_fds=True)
+            finally: f.close()
+        else:
+            job.proc = subprocess.Popen(job.args, close_fds=True)
+
+    # Complete the job specified once its command has exited.
+    def finish_job(self, job, status):
+        job.proc.returncode = status
+        job.status = status
+        job.end_time = time.time()
+        if job.output_path:
+            if status: os.unlink(job.output_path + ".tmp")
+            else:
+                os.rename(job.output_path + ".tmp", job.output_path)
+                if not job.size: job.size = os.path.getsize(job.output_path)
+
+    # Send a signal to the jobs that are still running.
+    def signal_running_jobs(self, sig):
+        for job in self.job_list:
+            if job.proc and job.status == None:
+                try: os.kill(job.proc.pid, sig)
+                except OSError: pass
+
+    # Pause or resume the running jobs according to the controller.
+    def update_pause(self):
+        pause_flag = self.controller.update()
+        if pause_flag == self.pause_flag: return
+        self.pause_flag = pause_flag
+        if pause_flag: self.signal_running_jobs(signal.SIGSTOP)
+        else: self.signal_running_jobs(signal.SIGCONT)
+
+    # Wait for one of the jobs of 'running_list' to exit. Return the PID and
+    # the exit status. Only the PIDs of the jobs are waited for, so that the
+    # other children of the process are not reaped. The pause state is updated
+    # while waiting if there is a controller.
+    def wait_job(self, running_list):
+        if not self.controller and len(running_list) == 1:
+            return os.waitpid(running_list[0].proc.pid, 0)
+        while 1:
+            if self.controller: self.update_pause()
+            for job in running_list:
+                pid, status = os.waitpid(job.proc.pid, os.WNOHANG)
+                if pid: return (pid, status)
+            time.sleep(0.1)
+
+    # Kill the jobs that are still running.
+    def kill_running_jobs(self):
+        if self.pause_flag: self.signal_running_jobs(signal.SIGCONT)
+        for job in self.job_list:
+            if job.proc and job.status == None:
+                try:
+                    os.kill(job.proc.pid, 15)
+                    job.proc.wait()
+                except OSError: pass
+                if job.output_path and os.path.exists(job.output_path + ".tmp"):
+                    os.unlink(job.output_path + ".tmp")
+
+    # Run all the jobs and wait for their completion. If 'raise_flag' is
+    # true, an exception is raised if a job failed, after the other jobs have
+    # completed.
+    def run(self, raise_flag=1):
+        pending_list = list(self.job_list)
+        running_list = []
+        failed_list = self.failed_name_list
+        nb_done = 0
+        total_size = self.get_total_size()
+        self.start_time = time.time()
+
+        try:
+            while len(pending_list) or len(running_list):
+                if self.controller: self.update_pause()
+                while len(pending_list) and len(running_list) < self.max_job and not self.pause_flag:
+                    job = pending_list.pop(0)
+                    self.start_job(job)
+                    running_list.append(job)
+
+                if not len(running_list):
+                    time.sleep(0.5)
+                    continue
+                pid, status = self.wait_job(running_list)
+                for job in running_list:
+                    if job.proc.pid != pid: continue
+                    self.finish_job(job, status)
+                    running_list.remove(job)
+                    if not status:
+                        nb_done += 1
+                        self.done_size += job.size
+                        progress = "%i/%i" % (nb_done, len(self.job_list))
+                        if total_size: progress += ", %s of %s" % (format_size(self.done_size), format_size(total_size))
+                        self.tell("Finished %s (%s).\n" % (job.name, progress))
+                        if self.done_callback: self.done_callback(job.name)
+                    elif job.try_count <= self.retry_count:
+                        pending_list.append(job)
+                    else:
+                        failed_list.append(job.name)
+                        self.tell("Failed %s.\n" % (job.name))
+                    break
+
+        except:
+            self.kill_running_jobs()
+            raise
+
+        self.end_time = time.time()
+        if len(failed_list) and raise_flag: raise Exception("failed to complete %s" % (", ".join(failed_list)))
+
+# This class represents a timed phase of an operation.
+class Phase:
+    def __init__(self, name, level=0):
+        self.name = name
+
+        # Nesting level of the phase. The jobs of a phase have level 1.
+        self.level = level
+
+        # Time at which the phase started and ended.
+        self.start_time = time.time()
+        self.end_time = None
+
+        # Number of bytes handled by the phase.
+        self.size = 0
+
+        # Number of times the phase was attempted.
+        self.try_count = 1
+
+        # Status of the phase ("ok", "failed" or "interrupted"), None if it
+        # is not finished.
+        self.status = None
+
+    # Mark the phase as finished.
+    def finish(self, size=0, status="ok"):
+        self.end_time = time.time()
+        self.size = size
+        self.status = status
+
+    # Return the duration of the phase in seconds.
+    def get_duration(self):
+        end_time = self.end_time
+        if end_time == None: end_time = time.time()
+        return max(0, end_time - self.start_time)
+
+    # Return the throughput of the phase in bytes per second, 0 if unknown.
+    def get_throughput(self):
+        duration = self.get_duration()
+        if not self.size or duration <= 0: return 0
+        return self.size / duration
+
+# This class records the duration, the size and the status of the phases of
+# an operation and of the jobs run by its job runners.
+class PhaseReport:
+    def __init__(self, desc):
+
+        # Description of the operation.
+        self.desc = desc
+
+        # Time at which the operation started and ended.
+        self.start_time = time.time()
+        self.end_time = None
+
+        # Phases started explicitly.
+        self.phase_list = []
+
+        # Job runners whose jobs are reported.
+        self.runner_list = []
+
+    # Start a phase and return it.
+    def start(self, name, level=0):
+        phase = Phase(name, level)
+        self.phase_list.append(phase)
+        return phase
+
+    # Report the jobs of a job runner.
+    def add_runner(self, runner):
+        self.runner_list.append(runner)
+
+    # Mark the operation as finished. The phases that are not finished are
+    # marked as interrupted.
+    def finish(self):
+        self.end_time = time.time()
+        for phase in self.phase_list:
+            if phase.status == None: phase.finish(phase.size, "interrupted")
+
+    # Return the phases and the jobs that were started, sorted by start time.
+    def get_phase_list(self):
+        phase_list = list(self.phase_list)
+        for runner in self.runner_list:
+            for job in runner.job_list:
+                if job.start_time == None: continue
+                phase = Phase(job.name, 1)
+                phase.start_time = job.start_time
+                phase.end_time = job.end_time
+                phase.try_count = job.try_count
+                if job.status == None:
+                    phase.end_time = self.end_time
+                    phase.status = "interrupted"
+                elif job.status: phase.status = "failed"
+                else:
+                    phase.size = job.size
+                    phase.status = "ok"
+                phase_list.append(phase)
+        phase_list.sort(lambda a, b: cmp(a.start_time, b.start_time))
+        return phase_list
+
+    # Return the number of bytes handled by the top level phases.
+    def get_total_size(self):
+        size = 0
+        for phase in self.phase_list:
+            if phase.level == 0: size += phase.size
+        return size
+
+    # Return the report as a table.
+    def format_table(self):
+        s = "%-44s %10s %10s %12s  %s\n" % ("Phase", "Time", "Size", "Throughput", "Status")
+        l = self.get_phase_list()
+        total = Phase("Total")
+        total.start_time = self.start_time
+        total.end_time = self.end_time
+        total.size = self.get_total_size()
+        l.append(total)
+        for phase in l:
+            size = "-"
+            throughput = "-"
+            if phase.size: size = format_size(phase.size)
+            if phase.get_throughput(): throughput = format_size(phase.get_throughput()) + "/s"
+            status = phase.status or ""
+            if phase.try_count > 1: status += " (%i tries)" % (phase.try_count)
+            s += "%-44s %8.1f s %10s %12s  %s\n" % \
+                 ("  " * phase.level + phase.name, phase.get_duration(), size, throughput, status)
+        return s
+
+    # Return the report in a format readable by ConfigParser. Each phase has
+    # its own section.
+    def format(self):
+        s = "[report]\n"
+        s += "operation=%s\n" % (self.desc)
+        s += "start=%.3f\n" % (self.start_time)
+        s += "duration=%.3f\n" % (self.end_time - self.start_time)
+        s += "bytes=%i\n" % (self.get_total_size())
+        l = self.get_phase_list()
+        for i in range(len(l)):
+            phase = l[i]
+            s += "\n[phase %i]\n" % (i + 1)
+            s += "name=%s\n" % (phase.name)
+            s += "level=%i\n" % (phase.level)
+            s += "start=%.3f\n" % (phase.start_time)
+            s += "duration=%.3f\n" % (phase.get_duration())
+            s += "bytes=%i\n" % (phase.size)
+            s += "throughput=%i\n" % (phase.get_throughput())
+            s += "tries=%i\n" % (phase.try_count)
+            s += "status=%s\n" % (phase.status)
+        return s
+
+    # Write the report to the path specified.
+    def write(self, path):
+        write_file_atom(path, self.format())
+
+# Size of the chunks of the files stored in chunks in a snapshot store.
+# Minimum and maximum size of the chunks of the files stored in chunks in a
+# snapshot store.
+snapshot_min_chunk_size = 512 * 1024
+snapshot_max_chunk_size = 16 * 1024 * 1024
+
+# A chunk ends after a line whose CRC has these bits cleared, once the chunk
+# has the minimum size. With lines of 100 bytes, the chunks have about 1 MB.
+snapshot_chunk_mask = 0x1fff
+
+# Return the offsets of the ends of the chunks found in 'data', which starts
+# at the beginning of a chunk. The boundaries depend on the content, so that
+# inserting data in a file only changes the chunks around the insertion. The
+# data after the last offset belongs to a chunk that is not complete yet.
+def get_chunk_end_list(data):
+    end_list = []
+    start = 0
+    pos = 0
+    while 1:
+        nl = data.find("\n", pos)
+        if nl == -1: break
+        end = nl + 1
+
+        # Cut the chunks that reach the maximum size inside the line.
+        while end - start > snapshot_max_chunk_size:
+            start += snapshot_max_chunk_size
+            end_list.append(start)
+            pos = max(pos, start)
+
+        if end - start >= snapshot_min_chunk_size and not zlib.crc32(data[pos:end]) & snapshot_chunk_mask:
+            end_list.append(end)
+            start = end
+        pos = end
+
+    while len(data) - start >= snapshot_max_chunk_size:
+        start += snapshot_max_chunk_size
+        end_list.append(start)
+    return end_list
+
+# This class represents a file of a snapshot.
+class SnapshotEntry:
+    def __init__(self, path, kind, mode, size, mtime, hash_list):
+
+        # Path of the file, relative to the repository directory.
+        self.path = path
+
+        # 'f' if the file is stored as a single object, 'c' if it is stored
+        # in chunks.
+        self.kind = kind
+
+        # Permission bits, size and modification time of the file.
+        self.mode = mode
+        self.size = size
+        self.mtime = mtime
+
+        # Hashes of the objects storing the content of the file.
+        self.hash_list = hash_list
+
+    # Return the string representation of the entry, terminated by a null
+    # character.
+    def format(self):
+        hash_str = ",".join(self.hash_list)
+        if hash_str == "": hash_str = "-"
+        return "%s %o %i %i %s %s\0" % (self.kind, self.mode, self.size, self.mtime, hash_str, self.path)
+
+# Parse the string representation of a snapshot entry.
+def parse_snapshot_entry(s):
+    arr = s.split(" ", 5)
+    if len(arr) != 6 or arr[0] not in ("f", "c"): raise Exception("invalid snapshot entry '%s'" % (s))
+    hash_list = []
+    if arr[4] != "-": hash_list = arr[4].split(",")
+    return SnapshotEntry(arr[5], arr[0], int(arr[1], 8), int(arr[2]), int(arr[3]), hash_list)
+
+# This class manages a store of content-addressed objects shared by the
+# repositories of a pull directory, and the snapshots of these repositories.
+# The objects are named after the SHA-1 of their content. The files of a
+# repository that match 'link_re' are linked in the store, so storing them
+# costs no space. They must only be replaced by renaming a new file over
+# them, as rsync does, never rewritten in place. The files that match
+# 'chunk_re' are copied in the store in chunks of variable size, so that the
+# unchanged parts of a database dump are stored once. The other files are
+# copied in the store. A snapshot is a manifest of the files of a
+# repository, stored in the 'snapshots' directory of the repository. The
+# objects are checked when a snapshot is recreated, see materialize().
+#
+# Creating and recreating snapshots holds a shared lock on the store, and
+# deleting the unreferenced objects holds an exclusive lock, so that the
+# objects added for a snapshot being created are not deleted.
+class SnapshotStore:
+    def __init__(self, root_dir, chunk_re="^data/[^/]+\.db$", link_re="^kfs/"):
+        self.root_dir = root_dir
+        self.object_dir = os.path.join(root_dir, "objects")
+        self.chunk_re = re.compile(chunk_re)
+        self.link_re = re.compile(link_re)
+        self.lock = KFileLock(os.path.join(root_dir, "snapshot.lock"))
+
+    # Acquire the lock of the store. A shared lock waits for a garbage
+    # collection that may take a while.
+    def acquire_lock(self, exclusive_flag):
+        timeout = 3600
+        if exclusive_flag: timeout = 60
+        self.lock.acquire(exclusive_flag, timeout, "kasmig")
+
+    # Return the path of the snapshot directory of a repository.
+    def get_snapshot_dir(self, repos):
+        return os.path.join(self.root_dir, repos, "snapshots")
+
+    # Return the path of the object having the hash specified.
+    def get_object_path(self, hash):
+        return os.path.join(self.object_dir, hash[:2], hash)
+
+    # Create the directory of the object path specified.
+    def make_object_parent(self, path):
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent): os.makedirs(parent)
+
+    # Store the data specified as an object. Return its hash.
+    def add_object_data(self, data):
+        hash = hashlib.sha1(data).hexdigest()
+        path = self.get_object_path(hash)
+        if not os.path.exists(path):
+            self.make_object_parent(path)
+            write_file_atom(path, data)
+        return hash
+
+    # Store the file specified as an object, by linking it in the store if
+    # 'link_flag' is true and by copying it otherwise. Return its hash.
+    def add_object_file(self, file_path, link_flag):
+        hash = get_file_checksum(file_path)
+        path = self.get_object_path(hash)
+        if os.path.exists(path): return hash
+        self.make_object_parent(path)
+        if link_flag:
+            try: os.link(file_path, path)
+            except OSError, e:
+                if e.errno != errno.EEXIST: raise
+            return hash
+
+        # Copy the file, then check that it did not change meanwhile.
+        shutil.copyfile(file_path, path + ".tmp")
+        if get_file_checksum(path + ".tmp") != hash:
+            os.unlink(path + ".tmp")
+            raise Exception("file %s changed while it was stored" % (file_path))
+        os.rename(path + ".tmp", path)
+        return hash
+
+    # Store the file specified in chunks. Return the list of hashes of the
+    # chunks.
+    def add_chunked_file(self, file_path):
+        hash_list = []
+        buf = ""
+        f = open(file_path, "rb")
+        try:
+            while 1:
+                data = f.read(snapshot_max_chunk_size)
+                buf += data
+                end_list = get_chunk_end_list(buf)
+                if data == "" and buf != "": end_list.append(len(buf))
+                start = 0
+                for end in end_list:
+                    hash_list.append(self.add_object_data(buf[start:end]))
+                    start = end
+                buf = buf[start:]
+                if data == "": break
+        finally:
+            f.close()
+        return hash_list
+
+    # Return the sorted list of the snapshots of a repository.
+    def get_snapshot_list(self, repos):
+        dir = self.get_snapshot_dir(repos)
+        if not os.path.isdir(dir): return []
+        snapshot_list = os.listdir(dir)
+        snapshot_list.sort()
+        return snapshot_list
+
+    # Return the list of entries of a snapshot.
+    def read_snapshot(self, repos, snapshot):
+        path = os.path.join(self.get_snapshot_dir(repos), snapshot)
+        if not os.path.isfile(path): raise Exception("no snapshot '%s' in repository '%s'" % (snapshot, repos))
+        entry_list = []
+        for s in read_file(path).split("\0"):
+            if s != "": entry_list.append(parse_snapshot_entry(s))
+        return entry_list
+
+    # Create a snapshot of the files of a repository located under the
+    # relative paths specified. The content of a file is not read again if
+    # its size and its modification time did not change since the previous
+    # snapshot. Return the name of the snapshot.
+    def create_snapshot(self, repos, rel_path_list):
+        self.acquire_lock(0)
+        try: return self.create_snapshot_locked(repos, rel_path_list)
+        finally: self.lock.release()
+
+    # Create a snapshot while holding the lock.
+    def create_snapshot_locked(self, repos, rel_path_list):
+        repos_dir = os.path.join(self.root_dir, repos)
+
+        prev_dict = {}
+        snapshot_list = self.get_snapshot_list(repos)
+        if len(snapshot_list):
+            for entry in self.read_snapshot(repos, snapshot_list[-1]): prev_dict[entry.path] = entry
+
+        file_list = []
+        for rel_path in rel_path_list:
+            path = os.path.join(repos_dir, rel_path)
+            if os.path.isdir(path):
+                for name in get_local_file_list(path): file_list.append(os.path.join(rel_path, name))
+            elif os.path.exists(path):
+                file_list.append(rel_path)
+        file_list.sort()
+
+        l = []
+        for rel_path in file_list:
+            path = os.path.join(repos_dir, rel_path)
+            st = os.lstat(path)
+            if not stat.S_ISREG(st.st_mode): continue
+            kind = "f"
+            if self.chunk_re.match(rel_path): kind = "c"
+            mtime = int(st.st_mtime)
+            prev = prev_dict.get(rel_path)
+            if prev and prev.kind == kind and prev.size == st.st_size and prev.mtime == mtime:
+                hash_list = prev.hash_list
+            elif kind == "c":
+                hash_list = self.add_chunked_file(path)
+            else:
+                hash_list = [ self.add_object_file(path, self.link_re.match(rel_path)) ]
+            l.append(SnapshotEntry(rel_path, kind, stat.S_IMODE(st.st_mode), st.st_size, mtime, hash_list).format())
+
+        snapshot_dir = self.get_snapshot_dir(repos)
+        if not os.path.isdir(snapshot_dir): os.makedirs(snapshot_dir)
+        snapshot = time.strftime("%Y%m%d-%H%M%S")
+        if os.path.exists(os.path.join(snapshot_dir, snapshot)):
+            i = 2
+            while os.path.exists(os.path.join(snapshot_dir, "%s-%i" % (snapshot, i))): i += 1
+            snapshot = "%s-%i" % (snapshot, i)
+        write_file_atom(os.path.join(snapshot_dir, snapshot), "".join(l))
+        return snapshot
+
+    # Recreate the files of a snapshot in 'dst_dir'. The objects of the files
+    # matching 'link_re' are linked, the other objects are copied and the
+    # chunked files are rebuilt, and the copies get the permissions and the
+    # modification time recorded in the snapshot. The chunks are verified as
+    # they are read. The other objects are only checked for their size unless
+    # 'verify_flag' is true, since reading the KFS files may take hours. An
+    # exception is raised if an object does not match.
+    def materialize(self, repos, snapshot, dst_dir, verify_flag=0):
+        self.acquire_lock(0)
+        try: self.materialize_locked(repos, snapshot, dst_dir, verify_flag)
+        finally: self.lock.release()
+
+    # Recreate the files of a snapshot while holding the lock.
+    def materialize_locked(self, repos, snapshot, dst_dir, verify_flag=0):
+        for entry in self.read_snapshot(repos, snapshot):
+            path = os.path.join(dst_dir, entry.path)
+            parent = os.path.dirname(path)
+            if not os.path.isdir(parent): os.makedirs(parent)
+            if entry.kind == "f":
+                object_path = self.get_object_path(entry.hash_list[0])
+                if os.path.getsize(object_path) != entry.size or \
+                   (verify_flag and get_file_checksum(object_path) != entry.hash_list[0]):
+                    raise Exception("object of %s in snapshot %s is corrupted" % (entry.path, snapshot))
+                if self.link_re.match(entry.path):
+                    os.link(object_path, path)
+                    continue
+                shutil.copyfile(object_path, path)
+            else:
+                f = open(path, "wb")
+                try:
+                    for hash in entry.hash_list:
+                        data = read_file(self.get_object_path(hash))
+                        if hashlib.sha1(data).hexdigest() != hash:
+                            raise Exception("chunk %s of %s in snapshot %s is corrupted" % (hash, entry.path, snapshot))
+                        f.write(data)
+                finally:
+                    f.close()
+            os.chmod(path, entry.mode)
+            os.utime(path, (entry.mtime, entry.mtime))
+
+    # Delete the objects that are not referenced by any snapshot. Return the
+    # number of objects deleted and their total size.
+    def collect_garbage(self):
+        self.acquire_lock(1)
+        try: return self.collect_garbage_locked()
+        finally: self.lock.release()
+
+    # Delete the unreferenced objects while holding the lock.
+    def collect_garbage_locked(self):
+        ref_dict = {}
+        for repos in os.listdir(self.root_dir):
+            for snapshot in self.get_snapshot_list(repos):
+                for entry in self.read_snapshot(repos, snapshot):
+                    for hash in entry.hash_list: ref_dict[hash] = 1
+
+        nb_deleted = 0
+        size_deleted = 0
+        if not os.path.isdir(self.object_dir): return (nb_deleted, size_deleted)
+        for prefix in os.listdir(self.object_dir):
+            prefix_dir = os.path.join(self.object_dir, prefix)
+            for hash in os.listdir(prefix_dir):
+                if ref_dict.has_key(hash): continue
+                path = os.path.join(prefix_dir, hash)
+                size_deleted += os.lstat(path).st_size
+                nb_deleted += 1
+                os.unlink(path)
+            try: os.rmdir(prefix_dir)
+            except OSError: pass
+        return (nb_deleted, size_deleted)